@@ -152,7 +152,8 @@ fetch_actions_once() {
   TMP_PAY=/data/local/tmp/actions_payload.$$
   rm -f "$TMP_RAW" "$TMP_PAY" 2>/dev/null || true
 
-  ( "$BB" echo "DEVICE=$DEV_ID"; "$BB" echo ) | \
+  # RUN= lets the server answer an older run_id coalesced into the latest result
+  ( "$BB" echo "DEVICE=$DEV_ID"; [ -n "$EXPECT_RUN" ] && "$BB" echo "RUN=$EXPECT_RUN"; "$BB" echo ) | \
   "$DB" -y -I 6 -p "$SSH_PORT" -i "$KEY" -B "127.0.0.1:$ACTIONS_PORT" "$SSH_USER@$HOST" >"$TMP_RAW" 2>>"$DB_ERR"
 
   DBRC=$?
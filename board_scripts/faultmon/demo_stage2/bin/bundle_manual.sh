@@ -230,11 +230,29 @@ collect_pidstat "$PROC_SNAPSHOT" "$PIDSTAT0" 120
 sleep 2
 collect_pidstat "$PROC_SNAPSHOT" "$PIDSTAT1" 120
 
-OUT_PATH="$BASE_DIR/${RUN_ID}__bundle.tar.gz"
-if tar -czf "$OUT_PATH" -C "$TMP_ROOT" "$RUN_ID"; then
-  echo "run_id=$RUN_ID"
-  echo "bundle_path=$OUT_PATH"
-  exit 0
+# BUNDLE_ZSTD=1 / ZSTD_BIN / ZSTD_LEVEL / ZSTD_DICT: same as bundle_real_upload.sh
+ZSTD_BIN="${ZSTD_BIN:-/data/local/tmp/zstd}"
+if [ "${BUNDLE_ZSTD:-0}" = "1" ] && [ -x "$ZSTD_BIN" ]; then
+  OUT_PATH="$BASE_DIR/${RUN_ID}__bundle.tar.zst"
+  zstd_dict=""
+  [ -n "${ZSTD_DICT:-}" ] && [ -r "$ZSTD_DICT" ] && zstd_dict="-D $ZSTD_DICT"
+  TAR_RC_FILE="$TMP_ROOT/.tar_rc_${RUN_ID}"
+  if { tar -cf - -C "$TMP_ROOT" "$RUN_ID"; echo $? > "$TAR_RC_FILE"; } \
+      | "$ZSTD_BIN" -q -f "-${ZSTD_LEVEL:-3}" $zstd_dict -o "$OUT_PATH" \
+      && [ "$(cat "$TAR_RC_FILE" 2>/dev/null)" = "0" ]; then
+    rm -f "$TAR_RC_FILE"
+    echo "run_id=$RUN_ID"
+    echo "bundle_path=$OUT_PATH"
+    exit 0
+  fi
+  rm -f "$TAR_RC_FILE" "$OUT_PATH"
+else
+  OUT_PATH="$BASE_DIR/${RUN_ID}__bundle.tar.gz"
+  if tar -czf "$OUT_PATH" -C "$TMP_ROOT" "$RUN_ID"; then
+    echo "run_id=$RUN_ID"
+    echo "bundle_path=$OUT_PATH"
+    exit 0
+  fi
 fi
 
 log "ERROR: failed to create bundle"
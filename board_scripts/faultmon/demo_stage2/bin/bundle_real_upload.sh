@@ -238,31 +238,150 @@ cat /proc/meminfo > "$SNAP_DIR/meminfo.txt" 2>/dev/null || true
 ps > "$SNAP_DIR/ps.txt" 2>/dev/null || true
 (dmesg | /data/local/tmp/busybox tail -n 200) > "$SNAP_DIR/dmesg_tail.txt" 2>/dev/null || true
 
+# delta upload (BUNDLE_DELTA=1, default): today's sys/events files only grow, so if the server
+# already holds a copy (same bytes up to its length, checked via the sha256 of its last 4 KiB)
+# only the appended bytes go into the bundle as <file>.delta. delta_manifest.json tells
+# ingest_bundle.py how to rebuild the full file; full entries let the server seed its copy.
+DELTA_TAIL=4096
+FULL_DIR="$TMP_ROOT/.full_${RUN_ID}"
+DELTA_BASES=""
+DELTA_SPEC=""
+DELTA_RELS=""
+DELTA_ENTRIES=""
+FULL_ENTRIES=""
+
+sha256_stdin() {
+  s="$("$BB" sha256sum 2>/dev/null || true)"
+  set -- $s
+  echo "${1:-}"
+}
+
+prepare_delta() {
+  rel="$1"
+  f="$RUN_DIR/$rel"
+  name="${rel##*/}"
+  [ -f "$f" ] || return 0
+  len="$("$BB" wc -c < "$f" 2>/dev/null || echo 0)"
+  set -- $len
+  len="${1:-0}"
+  full_entry="{\"path\": \"$rel\", \"mode\": \"full\", \"len\": $len}"
+  FULL_ENTRIES="${FULL_ENTRIES:+$FULL_ENTRIES, }$full_entry"
+
+  entry="$(printf '%s\n' "$DELTA_BASES" | "$BB" awk -F= -v n="$name" '$1 == n { print; exit }')"
+  base_len="${entry#*=}"
+  base_len="${base_len%%:*}"
+  base_tail="${entry##*:}"
+  case "$base_len" in ''|*[!0-9]*) base_len=0 ;; esac
+  if [ -z "$entry" ] || [ "$base_len" -le 0 ] || [ "$base_len" -gt "$len" ]; then
+    DELTA_ENTRIES="${DELTA_ENTRIES:+$DELTA_ENTRIES, }$full_entry"
+    return 0
+  fi
+  my_tail="$("$BB" head -c "$base_len" "$f" | "$BB" tail -c "$DELTA_TAIL" | sha256_stdin)"
+  if [ "$my_tail" != "$base_tail" ]; then
+    log "delta: $name differs from the server copy, sending it in full"
+    DELTA_ENTRIES="${DELTA_ENTRIES:+$DELTA_ENTRIES, }$full_entry"
+    return 0
+  fi
+  sha="$(sha256_stdin < "$f")"
+  mkdir -p "$FULL_DIR/${rel%/*}"
+  "$BB" tail -c +$((base_len + 1)) "$f" > "$f.delta"
+  mv "$f" "$FULL_DIR/$rel"
+  DELTA_RELS="$DELTA_RELS $rel"
+  DELTA_SPEC="${DELTA_SPEC:+$DELTA_SPEC,}$name:$base_len:$base_tail"
+  DELTA_ENTRIES="${DELTA_ENTRIES:+$DELTA_ENTRIES, }{\"path\": \"$rel\", \"mode\": \"delta\", \"base_len\": $base_len, \"base_tail_sha256\": \"$base_tail\", \"len\": $len, \"sha256\": \"$sha\"}"
+  log "delta: $name sends $((len - base_len)) of $len bytes"
+}
+
+write_delta_manifest() {
+  printf '{"schema": 1, "device_id": "%s", "files": [%s]}\n' "$DEVICE_ID" "$1" > "$RUN_DIR/delta_manifest.json"
+}
+
+undo_delta() {
+  for rel in $DELTA_RELS; do
+    [ -f "$FULL_DIR/$rel" ] && mv "$FULL_DIR/$rel" "$RUN_DIR/$rel"
+    rm -f "$RUN_DIR/$rel.delta"
+  done
+  DELTA_RELS=""
+  DELTA_SPEC=""
+  write_delta_manifest "$FULL_ENTRIES"
+}
+
+if [ "${BUNDLE_DELTA:-1}" = "1" ]; then
+  DELTA_BASES="$("$UPLOADER" --delta_query "${SYS_FILE##*/},${EV_FILE##*/}" --device "$DEVICE_ID" 2>/dev/null || true)"
+  prepare_delta "metrics/${SYS_FILE##*/}"
+  prepare_delta "events/${EV_FILE##*/}"
+  write_delta_manifest "$DELTA_ENTRIES"
+fi
+
+# optional zstd bundle (BUNDLE_ZSTD=1 + a zstd binary): smaller and much cheaper than gzip on
+# the board; ZSTD_DICT=<file.zdict> (server_B/tcp/bundle_codec_bench.py --train_dict_dir) shrinks it further
+ZSTD_BIN="${ZSTD_BIN:-/data/local/tmp/zstd}"
+use_zstd=0
+if [ "${BUNDLE_ZSTD:-0}" = "1" ] && [ -x "$ZSTD_BIN" ]; then
+  use_zstd=1
+fi
+
 bundle_path="$BASE_DIR/${RUN_ID}__bundle.tar.gz"
+[ "$use_zstd" -eq 1 ] && bundle_path="$BASE_DIR/${RUN_ID}__bundle.tar.zst"
 tar_err="$BASE_DIR/tar_err_${RUN_ID}.txt"
-rm -f "$bundle_path" "$tar_err" 2>/dev/null || true
 cd "$TMP_ROOT" || exit 2
 
-tar -czf "$bundle_path" "$RUN_ID" 2>"$tar_err"
-tar_rc=$?
-if [ "$tar_rc" -ne 0 ]; then
-  echo "error:tar_failed rc=$tar_rc err=$tar_err" >&2
-  exit "$tar_rc"
-fi
+make_bundle() {
+  rm -f "$bundle_path" "$tar_err" 2>/dev/null || true
+  if [ "$use_zstd" -eq 1 ]; then
+    zstd_dict=""
+    [ -n "${ZSTD_DICT:-}" ] && [ -r "$ZSTD_DICT" ] && zstd_dict="-D $ZSTD_DICT"
+    tar_rc_file="$BASE_DIR/tar_rc_${RUN_ID}.txt"
+    # no pipefail in sh: carry tar's exit code out of the pipeline through a file
+    tar_rc=0
+    { tar -cf - "$RUN_ID" 2>"$tar_err"; echo $? > "$tar_rc_file"; } \
+      | "$ZSTD_BIN" -q -f "-${ZSTD_LEVEL:-3}" $zstd_dict -o "$bundle_path" 2>>"$tar_err" || tar_rc=$?
+    rc_tar="$(cat "$tar_rc_file" 2>/dev/null || echo 1)"
+    rm -f "$tar_rc_file" 2>/dev/null || true
+    [ "$tar_rc" -ne 0 ] || tar_rc="$rc_tar"
+  else
+    tar_rc=0
+    tar -czf "$bundle_path" "$RUN_ID" 2>"$tar_err" || tar_rc=$?
+  fi
+  if [ "$tar_rc" -ne 0 ]; then
+    echo "error:tar_failed rc=$tar_rc err=$tar_err" >&2
+    return "$tar_rc"
+  fi
 
-size="$(wc -c < "$bundle_path" 2>/dev/null || echo 0)"
-case "$size" in ''|*[!0-9]*) size=0 ;; esac
-if [ "$size" -le 0 ]; then
-  echo "error:bundle_size_zero" >&2
-  exit 2
-fi
+  size="$(wc -c < "$bundle_path" 2>/dev/null || echo 0)"
+  case "$size" in ''|*[!0-9]*) size=0 ;; esac
+  if [ "$size" -le 0 ]; then
+    echo "error:bundle_size_zero" >&2
+    return 2
+  fi
+  return 0
+}
+
+upload_bundle() {
+  rc=0
+  if [ -n "$DELTA_SPEC" ]; then
+    "$UPLOADER" --file "$bundle_path" --type bundle --device "$DEVICE_ID" --run "$RUN_ID" --delta "$DELTA_SPEC" || rc=$?
+  else
+    "$UPLOADER" --file "$bundle_path" --type bundle --device "$DEVICE_ID" --run "$RUN_ID" || rc=$?
+  fi
+}
+
+make_bundle || exit $?
 
 echo "run_id=$RUN_ID"
 echo "bundle_path=$bundle_path"
 echo "bundle_size=$size"
 
-"$UPLOADER" --file "$bundle_path" --type bundle --device "$DEVICE_ID" --run "$RUN_ID"
-rc=$?
+upload_bundle
+if [ "$rc" -eq 3 ] && [ -n "$DELTA_SPEC" ]; then
+  # the server lost/rotated its copy since the query: fall back to the full files
+  log "delta rejected by server, re-bundling with full files"
+  undo_delta
+  make_bundle || exit $?
+  echo "bundle_size_full=$size"
+  upload_bundle
+fi
+rm -rf "$FULL_DIR" 2>/dev/null || true
 echo "upload_rc=$rc"
 if [ "$rc" -eq 0 ]; then
   echo "$RUN_ID" > "$BASE_DIR/latest_bundle_run_id.txt"
@@ -242,7 +242,7 @@ wait_actions_ready() {
   last_resp_len=""
   log "wait_actions_ready start run_id=$run_id timeout=$timeout"
   while [ "$waited" -lt "$timeout" ]; do
-    out_h="$($BIN_DIR/actions_poller_nc.sh --once --verbose --header-only 2>&1)"
+    out_h="$($BIN_DIR/actions_poller_nc.sh --once --verbose --header-only --expect-run "$run_id" 2>&1)"
     rc=$?
     parse_poller_output "$out_h"
     last_resp_run="$resp_run"
@@ -10,6 +10,9 @@ SSH_KEY="${ACTIONS_SSH_KEY:-/data/faultmon/ssh/id_dropbear}"
 
 # ingest server listens on server side
 INGEST_PORT="${INGEST_PORT:-18080}"
+# sharded server_B: shard_router.py --redirect answers header-only requests with
+# REDIRECT=host:port (the owner node, as seen from the ssh host); payloads then go there
+INGEST_TARGET="127.0.0.1:$INGEST_PORT"
 
 BASE_DIR=/data/faultmon/demo_stage2
 LOG_DIR=$BASE_DIR/logs
@@ -100,18 +103,24 @@ $line"
 }
 
 usage(){
-  echo "Usage: $0 --file <path> --type <bundle|action_result> --device <id> --run <run_id>" >&2
-  echo "Env: ACTIONS_SSH_HOST ACTIONS_SSH_PORT ACTIONS_SSH_USER ACTIONS_SSH_KEY INGEST_PORT" >&2
+  echo "Usage: $0 --file <path> --type <bundle|action_result> --device <id> --run <run_id> [--delta <spec>]" >&2
+  echo "       $0 --delta_query <name>[,<name>...] --device <id>   (prints <name>=<len>:<tail_sha256> lines)" >&2
+  echo "Exit: 0 ok, 1 failed, 2 usage, 3 server has no matching delta base (resend full files), 4 server busy (not sent)" >&2
+  echo "Env: ACTIONS_SSH_HOST ACTIONS_SSH_PORT ACTIONS_SSH_USER ACTIONS_SSH_KEY INGEST_PORT UPLOAD_SHA256(1|0) UPLOAD_RESUME(1|0) UPLOAD_RETRIES UPLOAD_BUSY_MAX_SEC" >&2
 }
 
 FILE=""
 TYPE=""
 DEVICE=""
 RUN_ID=""
+DELTA=""
+DELTA_QUERY=""
 
 while [ $# -gt 0 ]; do
   case "$1" in
     --file) shift; FILE="$1" ;;
+    --delta) shift; DELTA="$1" ;;
+    --delta_query) shift; DELTA_QUERY="$1" ;;
     --type) shift; TYPE="$1" ;;
     --device) shift; DEVICE="$1" ;;
     --run) shift; RUN_ID="$1" ;;
@@ -125,6 +134,37 @@ done
 [ -x "$DB" ] || { log "ERROR: missing $DB"; exit 127; }
 [ -r "$SSH_KEY" ] || { log "ERROR: missing key $SSH_KEY"; exit 127; }
 
+# delta uploads: which prefix of our append-only daily files does the server already hold?
+if [ -n "$DELTA_QUERY" ]; then
+  [ -n "$DEVICE" ] || { usage; exit 2; }
+  export HOME=/data/faultmon
+  mkdir -p "$LOG_DIR" 2>/dev/null || true
+  RESP=/data/local/tmp/delta_resp.$$
+  for hop in 1 2; do
+    {
+      "$BB" echo "OP=delta_query"
+      "$BB" echo "DEVICE=$DEVICE"
+      "$BB" echo "FILES=$DELTA_QUERY"
+      "$BB" echo
+    } | "$DB" -y -I 20 -p "$SSH_PORT" -i "$SSH_KEY" -B "$INGEST_TARGET" "$SSH_USER@$SSH_HOST" > "$RESP" 2>>"$DB_ERR"
+    rc=$?
+    FIRST="$("$BB" head -n 1 "$RESP" 2>/dev/null | "$BB" tr -d '\r')"
+    case "$FIRST" in
+      REDIRECT=*) [ "$hop" -eq 1 ] && INGEST_TARGET="${FIRST#REDIRECT=}" && continue ;;
+    esac
+    break
+  done
+  compact_db_err
+  if [ "$rc" -ne 0 ] || [ "$("$BB" head -n 1 "$RESP" 2>/dev/null | "$BB" tr -d '\r')" != "OK" ]; then
+    # old servers answer ERR: no delta support
+    rm -f "$RESP" 2>/dev/null || true
+    exit 1
+  fi
+  "$BB" tail -n +2 "$RESP" | "$BB" tr -d '\r'
+  rm -f "$RESP" 2>/dev/null || true
+  exit 0
+fi
+
 [ -n "$FILE" ] || { usage; exit 2; }
 [ -r "$FILE" ] || { log "ERROR: file not readable: $FILE"; exit 2; }
 [ -n "$TYPE" ] || { usage; exit 2; }
@@ -147,24 +187,160 @@ mkdir -p "$LOG_DIR" 2>/dev/null || true
 
 [ "$LEN" -lt 104857600 ] || log "WARN: large upload len=$LEN"
 
-# header + binary payload -> dbclient -B (acts like nc)
-{
-  "$BB" echo "DEVICE=$DEVICE"
-  "$BB" echo "TYPE=$TYPE"
-  "$BB" echo "RUN=$RUN_ID"
-  "$BB" echo "LEN=$LEN"
-  "$BB" echo
-  "$BB" cat "$FILE"
-} | "$DB" -y -I 20 -p "$SSH_PORT" -i "$SSH_KEY" -B "127.0.0.1:$INGEST_PORT" "$SSH_USER@$SSH_HOST" > /dev/null 2>>"$DB_ERR"
-
-rc=$?
-if [ "$rc" -ne 0 ]; then
-  log "ERROR: dbclient upload rc=$rc"
-  "$BB" tail -n 10 "$DB_ERR" >&2 2>/dev/null || true
-  compact_db_err
-  exit 1
+# optional integrity check: the server verifies SHA256= before publishing the file
+SHA=""
+if [ "${UPLOAD_SHA256:-1}" = "1" ]; then
+  SHA="$("$BB" sha256sum "$FILE" 2>/dev/null)"
+  set -- $SHA; SHA="${1:-}"
+  case "$SHA" in *[!0-9a-f]*) SHA="" ;; esac
+  [ "${#SHA}" -eq 64 ] || SHA=""
 fi
+RESP=/data/local/tmp/upload_resp.$$
+
+# zstd bundles (bundle_*.sh with BUNDLE_ZSTD=1) are announced with ENC=zstd
+ENC=""
+case "$FILE" in
+  *.tar.zst|*.tzst) ENC=zstd ;;
+esac
+
+# resumable uploads: ask the server how many bytes of this (DEVICE, RUN, TYPE) it already
+# keeps from a dropped attempt and send only the rest. Servers without the extension
+# answer the query with ERR, which means "start from 0".
+UPLOAD_RESUME="${UPLOAD_RESUME:-1}"
+UPLOAD_RETRIES="${UPLOAD_RETRIES:-3}"
+case "$UPLOAD_RETRIES" in ''|*[!0-9]*) UPLOAD_RETRIES=3 ;; esac
+[ "$UPLOAD_RETRIES" -gt 0 ] || UPLOAD_RETRIES=1
+
+# $1 = offset to send the payload from, or "" for OP=query (headers only); sets REPLY
+ingest_send() {
+  off="$1"
+  # header + binary payload -> dbclient -B (acts like nc)
+  {
+    "$BB" echo "DEVICE=$DEVICE"
+    "$BB" echo "TYPE=$TYPE"
+    "$BB" echo "RUN=$RUN_ID"
+    "$BB" echo "LEN=$LEN"
+    if [ -n "$SHA" ]; then
+      "$BB" echo "SHA256=$SHA"
+    fi
+    if [ -n "$ENC" ]; then
+      "$BB" echo "ENC=$ENC"
+    fi
+    if [ -n "$DELTA" ]; then
+      "$BB" echo "DELTA=$DELTA"
+    fi
+    if [ -z "$off" ]; then
+      "$BB" echo "OP=query"
+    elif [ "$UPLOAD_RESUME" = "1" ]; then
+      "$BB" echo "RESUME=1"
+      [ "$off" -eq 0 ] || "$BB" echo "OFFSET=$off"
+    fi
+    "$BB" echo
+    if [ -n "$off" ]; then
+      if [ "$off" -gt 0 ]; then
+        "$BB" tail -c +$((off + 1)) "$FILE"
+      else
+        "$BB" cat "$FILE"
+      fi
+    fi
+  } | "$DB" -y -I 20 -p "$SSH_PORT" -i "$SSH_KEY" -B "$INGEST_TARGET" "$SSH_USER@$SSH_HOST" > "$RESP" 2>>"$DB_ERR"
+  send_rc=$?
+  REPLY="$("$BB" head -n 1 "$RESP" 2>/dev/null | "$BB" tr -d '\r')"
+  rm -f "$RESP" 2>/dev/null || true
+  return $send_rc
+}
+
+# admission control: the server answers "BUSY RETRY_AFTER=<sec>" instead of taking a bundle
+# it would only discard as stale. Wait as asked (not counted as a retry) up to
+# UPLOAD_BUSY_MAX_SEC in total, then give up with exit 4. The deadline is kept in
+# BUSY_FILE so the next trigger does not even connect before it.
+UPLOAD_BUSY_MAX_SEC="${UPLOAD_BUSY_MAX_SEC:-120}"
+case "$UPLOAD_BUSY_MAX_SEC" in ''|*[!0-9]*) UPLOAD_BUSY_MAX_SEC=120 ;; esac
+BUSY_FILE=$BASE_DIR/ingest_busy_until
+BUSY_WAITED=0
+
+# $1 = seconds to wait; returns 1 when that would exceed the busy budget
+busy_wait() {
+  sec="$1"
+  case "$sec" in ''|*[!0-9]*) sec=30 ;; esac
+  now="$("$BB" date +%s 2>/dev/null || echo 0)"
+  echo $((now + sec)) > "$BUSY_FILE" 2>/dev/null || true
+  if [ $((BUSY_WAITED + sec)) -gt "$UPLOAD_BUSY_MAX_SEC" ]; then
+    log "server busy: retry_after=${sec}s waited=${BUSY_WAITED}s budget=${UPLOAD_BUSY_MAX_SEC}s, not sending run=$RUN_ID"
+    return 1
+  fi
+  log "server busy: waiting ${sec}s (waited=${BUSY_WAITED}s)"
+  "$BB" sleep "$sec"
+  BUSY_WAITED=$((BUSY_WAITED + sec))
+  return 0
+}
+
+if [ "$TYPE" = "bundle" ] && [ -r "$BUSY_FILE" ]; then
+  until_ts="$("$BB" cat "$BUSY_FILE" 2>/dev/null)"
+  now="$("$BB" date +%s 2>/dev/null || echo 0)"
+  case "$until_ts" in ''|*[!0-9]*) until_ts=0 ;; esac
+  if [ "$until_ts" -gt "$now" ]; then
+    busy_wait $((until_ts - now)) || exit 4
+  fi
+fi
+
+attempt=1
+while :; do
+  OFF=0
+  # ask the router again on every attempt: the owner may have changed or be down
+  INGEST_TARGET="127.0.0.1:$INGEST_PORT"
+  if [ "$UPLOAD_RESUME" = "1" ] && ingest_send ""; then
+    case "$REPLY" in
+      REDIRECT=*)
+        INGEST_TARGET="${REPLY#REDIRECT=}"
+        log "redirect: owner node $INGEST_TARGET"
+        # owner unreachable from here: let the router relay this attempt
+        ingest_send "" || { REPLY=""; INGEST_TARGET="127.0.0.1:$INGEST_PORT"; }
+        ;;
+    esac
+    case "$REPLY" in
+      "BUSY RETRY_AFTER="*)
+        compact_db_err
+        busy_wait "${REPLY#BUSY RETRY_AFTER=}" || exit 4
+        continue
+        ;;
+    esac
+    case "$REPLY" in OFFSET=*) OFF="${REPLY#OFFSET=}" ;; esac
+    case "$OFF" in ''|*[!0-9]*) OFF=0 ;; esac
+    [ "$OFF" -le "$LEN" ] || OFF=0
+    [ "$OFF" -eq 0 ] || log "resume: server has $OFF/$LEN bytes"
+  fi
+
+  ingest_send "$OFF"
+  rc=$?
+  if [ "$rc" -ne 0 ]; then
+    log "ERROR: dbclient upload rc=$rc attempt=$attempt/$UPLOAD_RETRIES offset=$OFF"
+    "$BB" tail -n 10 "$DB_ERR" >&2 2>/dev/null || true
+  else
+    case "$REPLY" in
+      OK*) break ;;
+      "BUSY RETRY_AFTER="*)
+        compact_db_err
+        busy_wait "${REPLY#BUSY RETRY_AFTER=}" || exit 4
+        continue
+        ;;
+      "ERR delta_base_mismatch"*)
+        log "delta base mismatch: caller must resend full files"
+        compact_db_err
+        exit 3
+        ;;
+      *) log "ERROR: server rejected upload reply='$REPLY' len=$LEN offset=$OFF sha256=${SHA:-none}" ;;
+    esac
+  fi
+  compact_db_err
+  if [ "$attempt" -ge "$UPLOAD_RETRIES" ]; then
+    exit 1
+  fi
+  attempt=$((attempt + 1))
+  "$BB" sleep $((attempt * 2))
+done
 compact_db_err
+[ "$TYPE" != "bundle" ] || rm -f "$BUSY_FILE" 2>/dev/null || true
 
 log "OK: uploaded type=$TYPE device=$DEVICE run=$RUN_ID len=$LEN"
 exit 0
@@ -18,11 +18,27 @@ import os
 import re
 import subprocess
 import sys
+import threading
 import time
 import traceback
 from pathlib import Path
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import fault_triage
+import feature_cache
+import load_ladder
+import proc_timeseries
+import redaction
+import stage_deadline
+from work_lease import Lease, try_acquire
+
+try:
+    import metrics_features
+except Exception:  # numpy missing: prompt keeps the min/max summary only
+    metrics_features = None
 
 try:
     CLK_TCK = os.sysconf(os.sysconf_names.get("SC_CLK_TCK", "SC_CLK_TCK"))
@@ -79,15 +95,11 @@ def atomic_write_json(path: Path, obj: Any) -> None:
 def now_utc_iso() -> str:
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
-def try_acquire_infer_lock(out_dir: Path) -> Optional[Path]:
-    lock = out_dir / ".infer_lock"
+def try_acquire_infer_lock(out_dir: Path) -> Optional[Lease]:
+    # lease with heartbeat (work_lease.py): a lock left by a crashed run expires after
+    # WK_LEASE_TTL_SEC instead of blocking this out_dir forever
     try:
-        fd = os.open(str(lock), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-        os.write(fd, (now_utc_iso() + "\n").encode("utf-8"))
-        os.close(fd)
-        return lock
-    except FileExistsError:
-        return None
+        return try_acquire(out_dir / ".infer_lock", owner="closed_loop_infer_run")
     except Exception:
         return None
 
@@ -128,83 +140,20 @@ def sanitize_meta_for_llm(meta: Dict[str, Any]) -> Dict[str, Any]:
     Remove fields that can leak labels / scripted scenario info into LLM input.
     Keep only operational metadata needed for context.
     """
-    if not isinstance(meta, dict):
-        return {}
-
-    drop_keys = {
-        "scenario_tag",
-        "fault_type",
-        "family",
-        "severity",
-        "gt_family",
-        "gt_severity",
-        "gt_fault",
-        "gt_label",
-        "labels",
-        "scenario",
-        "obs_primary",
-        "obs_fault",
-    }
-
-    out: Dict[str, Any] = {}
-    for k, v in meta.items():
-        if not isinstance(k, str):
-            continue
-        ks = k.strip()
-        # drop anything starting with obs_ (obs_fault_state/obs_cpu_hotspot/obs_mem_pressure ...)
-        if ks.startswith("obs_"):
-            continue
-        if ks in drop_keys:
-            continue
-        out[ks] = v
-
-    return out
+    return redaction.sanitize_meta(meta)
 
 def sanitize_event_msg_for_llm(msg: Any) -> str:
     """
     Remove label-leaking tokens from events (e.g. cli poke / run_end containing scenario tag).
     Keep as much useful context as possible.
     """
-    if msg is None:
-        return ""
-    s = str(msg)
-
-    # If it's a cli poke style line, it often embeds scenario_tag/fault_type twice
-    # Example: "run_end:...:cpu_busy_loop:cpu_busy_loop"
-    if "poke" in s or "run_end" in s or "run_begin" in s:
-        # redact common scenario-like tokens (cpu_*/mem_*/bg_*/net_*/background_*)
-        s = re.sub(r"\b(cpu|mem|bg|net|background)_[A-Za-z0-9_]+\b", "<redacted_scenario>", s)
-        # redact obs_* tokens if any
-        s = re.sub(r"\bobs_[A-Za-z0-9_]+\b", "<redacted_obs>", s)
-
-        # also redact " :xxx:xxx " tail patterns conservatively
-        # keep first two ':' groups, redact later groups
-        parts = s.split(":")
-        if len(parts) >= 6:
-            s = ":".join(parts[:4] + ["<redacted>"] * (len(parts) - 4))
-
-    return s
+    return redaction.redact_event_msg(msg)
 
 def event_has_label_leak(ev: Any) -> bool:
-    if not isinstance(ev, dict):
-        return False
-    for k, v in ev.items():
-        if isinstance(k, str):
-            if "obs_" in k or k in ("scenario_tag", "fault_type"):
-                return True
-        if isinstance(v, str):
-            if "obs_" in v or "scenario_tag" in v or "fault_type" in v:
-                return True
-    return False
+    return redaction.event_has_label_leak(ev)
 
 def redact_label_leaks(text: str) -> str:
-    if not text:
-        return text
-    s = str(text)
-    s = re.sub(r"\bobs_[A-Za-z0-9_]+\b", "<redacted_obs>", s)
-    s = s.replace("scenario_tag", "<redacted_meta>")
-    s = s.replace("fault_type", "<redacted_meta>")
-    return s
+    return redaction.redact_label_leaks(text)
 
 def query_gpu_mem() -> Tuple[Optional[Dict[str, int]], Optional[str]]:
     try:
@@ -539,6 +488,9 @@ def compact_diagnosis(diag: Dict[str, Any], actions_obj: Optional[Dict[str, Any]
     risk_flags = _limit_list(diag.get("risk_flags"), 8)
     if risk_flags:
         compact["risk_flags"] = [_truncate_text(x, 60) for x in risk_flags if x]
+    for key in ("fidelity", "deadline_exceeded", "coalesced"):
+        if isinstance(diag.get(key), dict):
+            compact[key] = diag.get(key)
 
     return compact
 
@@ -811,6 +763,15 @@ def build_process_evidence(candidates: List[Dict[str, Any]], top_n: int = 8) ->
         cpu_pct = item.get("cpu_pct")
         if cpu_pct is not None:
             parts.append(f"cpu_pct={cpu_pct}")
+        rss_delta = item.get("rss_delta_kb")
+        if rss_delta is not None:
+            parts.append(f"rss_delta_kb={rss_delta}")
+        rss_slope = item.get("rss_slope_kb_per_min")
+        if rss_slope is not None:
+            parts.append(f"rss_slope_kb_per_min={rss_slope}")
+        score = item.get("score")
+        if score is not None:
+            parts.append(f"score={score}")
         line = f"  - {name}(" + ", ".join(parts) + ")"
         lines.append(line)
     return lines
@@ -844,7 +805,13 @@ def build_user_message(run_id: str,
                        dmesg_lines: List[str],
                        hilog_lines: List[str],
                        run_window_start_ms: Optional[int],
-                       run_window_end_ms: Optional[int]) -> str:
+                       run_window_end_ms: Optional[int],
+                       metrics_feature_block: Optional[Dict[str, Any]] = None,
+                       prefiltered: bool = False) -> str:
+    """
+    prefiltered=True: events are already leak-filtered and dmesg/hilog lines already
+    redacted (RunContext does both once at load time), so they are used as-is.
+    """
     lines: List[str] = []
 
     lines.append(f"[run_id] {run_id}")
@@ -882,6 +849,10 @@ def build_user_message(run_id: str,
         )
         lines.append(f"  mem_free_kb: min={mem_free_stats['min']} max={mem_free_stats['max']}")
 
+        if metrics_feature_block and metrics_feature_block.get("columns") and metrics_features is not None:
+            lines.append('[metrics features] (per column: window stats, slope, z vs pre-window baseline, change point, sustained)')
+            lines.extend(metrics_features.format_feature_lines(metrics_feature_block))
+
         # sampled points
         lines.append('[metrics samples] (relative seconds, mem_available_kb, load1_x100, cpu_util_total_x100)')
         start_ms = run_window_start_ms or (safe_int(metrics_rows[0].get('ts_ms')) if metrics_rows else None)
@@ -903,7 +874,7 @@ def build_user_message(run_id: str,
         lines.append('[metrics] no valid metrics rows')
 
     # events summary (filter obs_ / scenario_tag / fault_type leakage)
-    safe_events = [ev for ev in events if not event_has_label_leak(ev)]
+    safe_events = events if prefiltered else [ev for ev in events if not event_has_label_leak(ev)]
     if safe_events:
         total = len(safe_events)
         tag_counts: Dict[str, int] = {}
@@ -945,11 +916,11 @@ def build_user_message(run_id: str,
     if dmesg_lines:
         lines.append('[dmesg excerpt] (truncated)')
         for ln in dmesg_lines[:20]:
-            lines.append('  ' + redact_label_leaks(ln))
+            lines.append('  ' + (ln if prefiltered else redact_label_leaks(ln)))
     if hilog_lines:
         lines.append('[hilog excerpt] (truncated)')
         for ln in hilog_lines[:20]:
-            lines.append('  ' + redact_label_leaks(ln))
+            lines.append('  ' + (ln if prefiltered else redact_label_leaks(ln)))
 
     lines.append('')
     lines.append('Please answer:')
@@ -1062,26 +1033,624 @@ def parse_summary_to_struct(summary: str, fallback_severity: str) -> Tuple[Dict[
         "summary": summary.strip(),
     }
     return diagnosis, notes
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--run_dir", required=True)
-    ap.add_argument("--out_dir", required=True)
-    ap.add_argument("--min_free_mib", type=int, default=None)
-    ap.add_argument("--min_free_mib_stage2", type=int, default=None)
-    ap.add_argument("--low_vram_wait_sec", type=int, default=None)
-    ap.add_argument("--low_vram_policy", type=str, default=None, choices=["skip", "try", "wait"])
-    ap.add_argument("--enable_stage2", type=int, default=None, choices=[0, 1])
+# ---------------- run context (single-pass loader) ----------------
+
+RUN_LOADER_WORKERS = int(os.environ.get("WK_RUN_LOADER_WORKERS", "6"))
+RUN_LOG_TAIL_LINES = 200
+FEATURE_CACHE_ENABLED = os.environ.get("WK_FEATURE_CACHE", "1") != "0"
+# bump when parsing/derivation changes so stale per-run caches are ignored
+RUN_CONTEXT_VERSION = "run_context/2|{}|{}|clk_tck={}".format(
+    metrics_features.FEATURES_SCHEMA if metrics_features is not None else "no_metrics_features",
+    proc_timeseries.TIMESERIES_SCHEMA,
+    CLK_TCK,
+)
+
+
+def _latest_match(entries: List[str], prefix: str, suffix: str) -> Optional[str]:
+    hits = sorted(n for n in entries if n.startswith(prefix) and n.endswith(suffix))
+    return hits[-1] if hits else None
 
-    ap.add_argument("--wait_poll_sec", type=int, default=None)
-    ap.add_argument("--wait_max_sec", type=int, default=None)
-    ap.add_argument("--stage2_wait_poll_sec", type=int, default=None)
-    ap.add_argument("--stage2_wait_max_sec", type=int, default=None)
-    ap.add_argument("--stage2_tail_bytes", type=int, default=None)
-    ap.add_argument("--stage2_tail_lines", type=int, default=None)
-    args = ap.parse_args()
 
-    run_dir = Path(args.run_dir).resolve()
-    out_dir = Path(args.out_dir).resolve()
+@dataclass(slots=True)
+class RunFiles:
+    run_dir: Path
+    meta: Optional[Path] = None
+    metrics: Optional[Path] = None
+    events: Optional[Path] = None
+    procs_dir: Optional[Path] = None
+    procs_files: List[Path] = field(default_factory=list)
+    dmesg_after: Optional[Path] = None
+    hilog_full: Optional[Path] = None
+
+    @classmethod
+    def scan(cls, run_dir: Path) -> "RunFiles":
+        """One directory listing per level; no repeated globbing downstream."""
+        files = cls(run_dir=run_dir)
+        try:
+            top = {e.name: e for e in os.scandir(run_dir)}
+        except OSError:
+            return files
+
+        def _file(name: str) -> Optional[Path]:
+            e = top.get(name)
+            return Path(e.path) if e is not None and e.is_file() else None
+
+        def _sub(name: str) -> List[str]:
+            e = top.get(name)
+            if e is None or not e.is_dir():
+                return []
+            try:
+                return [c.name for c in os.scandir(e.path) if c.is_file()]
+            except OSError:
+                return []
+
+        files.meta = _file("_run_meta.json")
+        files.dmesg_after = _file("dmesg_after.utf8.log")
+        files.hilog_full = _file("hilog_text_full.log")
+        m = _latest_match(_sub("metrics"), "sys_", ".csv")
+        files.metrics = run_dir / "metrics" / m if m else None
+        ev = _latest_match(_sub("events"), "events_", ".jsonl")
+        files.events = run_dir / "events" / ev if ev else None
+        if "procs" in top and top["procs"].is_dir():
+            files.procs_dir = run_dir / "procs"
+            files.procs_files = [files.procs_dir / n for n in sorted(_sub("procs"))]
+        return files
+
+    def sources(self) -> List[Path]:
+        single = [self.meta, self.metrics, self.events, self.dmesg_after, self.hilog_full]
+        return [p for p in single if p is not None] + list(self.procs_files)
+
+
+@dataclass(slots=True)
+class RunContext:
+    run_dir: Path
+    run_id: str
+    files: RunFiles
+    meta: Dict[str, Any] = field(default_factory=dict)
+    meta_llm: Dict[str, Any] = field(default_factory=dict)
+    labels: Dict[str, str] = field(default_factory=dict)
+    window_start_ms: Optional[int] = None
+    window_end_ms: Optional[int] = None
+    metrics_fields: List[str] = field(default_factory=list)
+    metrics_rows_all: List[Dict[str, Any]] = field(default_factory=list)
+    metrics_rows: List[Dict[str, Any]] = field(default_factory=list)
+    metrics_feature_block: Optional[Dict[str, Any]] = None
+    events: List[Dict[str, Any]] = field(default_factory=list)
+    prompt_events: List[Dict[str, Any]] = field(default_factory=list)  # events minus label leaks
+    proc_ts: Dict[str, Any] = field(default_factory=dict)
+    candidate_processes: List[Dict[str, Any]] = field(default_factory=list)
+    primary_suspect: Optional[Dict[str, Any]] = None
+    secondary_suspects: List[Dict[str, Any]] = field(default_factory=list)
+    pidstat_interval_ms: Optional[int] = None
+    # dmesg/hilog tails, label leaks already redacted (one scan per buffer)
+    dmesg_lines: List[str] = field(default_factory=list)
+    hilog_lines: List[str] = field(default_factory=list)
+    dmesg_tail: str = ""
+    hilog_tail: str = ""
+    redactions: Dict[str, Dict[str, int]] = field(default_factory=dict)  # source -> rule -> count
+    observations: List[str] = field(default_factory=list)
+    timings: Dict[str, float] = field(default_factory=dict)  # ms per input / stage
+    errors: Dict[str, str] = field(default_factory=dict)
+    cache_hit: bool = False
+    coalesced_run_ids: List[str] = field(default_factory=list)  # older bundles merged in (load_coalesced_context)
+
+    def user_message(self) -> str:
+        return build_user_message(
+            run_id=self.run_id,
+            meta=self.meta_llm,
+            labels={},  # avoid leaking label fields into the prompt
+            metrics_rows=self.metrics_rows,
+            events=self.prompt_events,
+            process_candidates=self.candidate_processes,
+            dmesg_lines=self.dmesg_lines,
+            hilog_lines=self.hilog_lines,
+            run_window_start_ms=self.window_start_ms,
+            run_window_end_ms=self.window_end_ms,
+            metrics_feature_block=self.metrics_feature_block,
+            prefiltered=True,
+        )
+
+    def prompt_material(self) -> Dict[str, Any]:
+        return {
+            "run_meta": self.meta_llm,  # sanitized
+            "metrics_fields": self.metrics_fields,
+            "metrics_features": self.metrics_feature_block,
+            "events_count": len(self.events),
+            "dmesg_after_tail": self.dmesg_tail,
+            "hilog_tail": self.hilog_tail,
+            "candidate_processes": self.candidate_processes,
+            "primary_suspect": self.primary_suspect,
+            "secondary_suspects": self.secondary_suspects,
+            "pidstat_interval_ms": self.pidstat_interval_ms,
+            "clk_tck": CLK_TCK,
+            "load_timings_ms": self.timings,
+            "redactions": self.redactions,
+        }
+
+
+def _load_meta(p: Optional[Path]) -> Dict[str, Any]:
+    if p is None:
+        return {}
+    meta = json.loads(p.read_text(encoding="utf-8"))
+    return meta if isinstance(meta, dict) else {}
+
+
+def _resolve_run_window(meta: Dict[str, Any]) -> Tuple[Any, Any]:
+    start_ms = meta.get("run_window_host_epoch_ms_start")
+    end_ms = meta.get("run_window_host_epoch_ms_end")
+    if start_ms in (0, None):
+        start_ms = parse_dotnet_date(meta.get("run_start")) or meta.get("host_epoch_ms_start")
+    if end_ms in (0, None):
+        end_ms = parse_dotnet_date(meta.get("run_end"))
+    return start_ms, end_ms
+
+
+def read_run_window(run_dir: Path) -> Tuple[Optional[int], Optional[int]]:
+    """(start_ms, end_ms) of an ingested run from its _run_meta.json; None where unknown."""
+    try:
+        start_ms, end_ms = _resolve_run_window(_load_meta(run_dir / "_run_meta.json"))
+    except Exception:
+        return None, None
+    start_i, end_i = safe_int(start_ms), safe_int(end_ms)
+    return (start_i if start_i and start_i > 0 else None), (end_i if end_i and end_i > 0 else None)
+
+
+def windows_touch(a: Tuple[Optional[int], Optional[int]],
+                  b: Tuple[Optional[int], Optional[int]],
+                  gap_ms: int) -> bool:
+    """Windows overlap, or the later one starts at most gap_ms after the earlier one ends."""
+    if None in a or None in b:
+        return False
+    return a[0] <= b[1] + gap_ms and b[0] <= a[1] + gap_ms
+
+
+def _load_metrics_merged(paths: Sequence[Path]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Rows of several metrics CSVs, one per ts_ms (first path wins), in time order."""
+    if len(paths) <= 1:
+        return load_metrics_csv(paths[0]) if paths else ([], [])
+    by_ts: Dict[int, Dict[str, Any]] = {}
+    fields: List[str] = []
+    for p in paths:
+        rows, f = load_metrics_csv(p)
+        fields = fields or f
+        for row in rows:
+            ts = safe_int(row.get("ts_ms"))
+            if ts is not None:
+                by_ts.setdefault(ts, row)
+    return [by_ts[ts] for ts in sorted(by_ts)], fields
+
+
+def _load_events(p: Optional[Path],
+                 start_ms: Any,
+                 end_ms: Any,
+                 report: Optional[redaction.RedactionReport] = None) -> List[Dict[str, Any]]:
+    events: List[Dict[str, Any]] = []
+    if p is None:
+        return events
+    try:
+        with p.open("r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    obj = json.loads(line)
+                    ts = safe_int(obj.get("ts"))
+                    if start_ms and end_ms and ts is not None:
+                        if not (start_ms <= ts <= end_ms):
+                            continue
+                    obj["msg"] = redaction.redact_event_msg(obj.get("msg"), report)
+                    events.append(obj)
+                except Exception:
+                    continue
+    except Exception:
+        pass
+    return events
+
+
+def _load_log_tail(p: Optional[Path],
+                   max_lines: int,
+                   report: Optional[redaction.RedactionReport] = None,
+                   source: str = "log") -> Tuple[List[str], str]:
+    """Single read + single redaction pass serving both the prompt lines and the prompt_material text."""
+    if p is None:
+        return [], ""
+    try:
+        with p.open("r", encoding="utf-8", errors="ignore") as f:
+            lines = f.readlines()[-max_lines:]
+    except Exception:
+        return [], ""
+    return redaction.redact_log_tail(lines, report, source)
+
+
+def _build_observations(ctx: RunContext) -> List[str]:
+    observations: List[str] = []
+    if ctx.metrics_rows:
+        observations.append(f"run_window 内 metrics 行数={len(ctx.metrics_rows)}")
+    if ctx.events:
+        observations.append(f"run_window 内 events 条数={len(ctx.events)}")
+    if ctx.proc_ts.get("last_snapshot_entries"):
+        observations.append(
+            f"进程快照条数={ctx.proc_ts.get('last_snapshot_entries')} (快照文件数={ctx.proc_ts.get('snapshots')})"
+        )
+    pidstat_counts = ctx.proc_ts.get("pidstat_counts") or []
+    if any(pidstat_counts):
+        observations.append(
+            "pidstat 覆盖进程数: " + " ".join(f"pidstat_{i}={n}" for i, n in enumerate(pidstat_counts))
+        )
+    else:
+        observations.append("pidstat_0/1 缺失或为空")
+    return observations
+
+
+# RunContext fields persisted in the per-run feature cache (proc_ts keeps its summary only)
+CACHED_CONTEXT_FIELDS = (
+    "meta", "meta_llm", "labels", "window_start_ms", "window_end_ms",
+    "metrics_fields", "metrics_rows", "metrics_feature_block", "events",
+    "candidate_processes", "pidstat_interval_ms",
+    "dmesg_lines", "hilog_lines", "dmesg_tail", "hilog_tail", "redactions", "observations",
+)
+PROC_SUMMARY_KEYS = ("snapshots", "pidstat_counts", "last_snapshot_entries", "pidstat_interval_ms")
+
+
+def _context_to_cache(ctx: RunContext) -> Dict[str, Any]:
+    data = {name: getattr(ctx, name) for name in CACHED_CONTEXT_FIELDS}
+    data["proc_summary"] = {k: ctx.proc_ts.get(k) for k in PROC_SUMMARY_KEYS}
+    return data
+
+
+def _context_from_cache(ctx: RunContext, data: Dict[str, Any]) -> bool:
+    if any(name not in data for name in CACHED_CONTEXT_FIELDS):
+        return False
+    for name in CACHED_CONTEXT_FIELDS:
+        setattr(ctx, name, data[name])
+    ctx.proc_ts = dict(data.get("proc_summary") or {})
+    ctx.prompt_events = redaction.split_leaky_events(ctx.events)
+    ctx.primary_suspect = ctx.candidate_processes[0] if ctx.candidate_processes else None
+    ctx.secondary_suspects = ctx.candidate_processes[1:6]
+    return True
+
+
+def _parse_run_inputs(ctx: RunContext, max_workers: int, members: Sequence[RunFiles] = ()) -> None:
+    """members: inputs of coalesced bundles; the window becomes the union, metrics/events/procs are merged."""
+    files = ctx.files
+    t0 = time.perf_counter()
+    ctx.meta = _load_meta(files.meta)
+    ctx.window_start_ms, ctx.window_end_ms = _resolve_run_window(ctx.meta)
+    if members:
+        starts = [safe_int(ctx.window_start_ms)]
+        ends = [safe_int(ctx.window_end_ms)]
+        for m in members:
+            try:
+                m_start, m_end = _resolve_run_window(_load_meta(m.meta))
+            except Exception as exc:
+                ctx.errors["meta_" + m.run_dir.name] = repr(exc)
+                continue
+            starts.append(safe_int(m_start))
+            ends.append(safe_int(m_end))
+        starts = [v for v in starts if v and v > 0]
+        ends = [v for v in ends if v and v > 0]
+        if starts and ends:
+            ctx.window_start_ms, ctx.window_end_ms = min(starts), max(ends)
+        ctx.meta = dict(ctx.meta)
+        ctx.meta["run_window_host_epoch_ms_start"] = ctx.window_start_ms or 0
+        ctx.meta["run_window_host_epoch_ms_end"] = ctx.window_end_ms or 0
+        ctx.meta["coalesced_run_ids"] = list(ctx.coalesced_run_ids)
+    ctx.timings["meta"] = round((time.perf_counter() - t0) * 1000.0, 3)
+    report = redaction.RedactionReport()
+    ctx.meta_llm = redaction.sanitize_meta(ctx.meta, report)
+    ctx.labels = parse_label_kv(ctx.meta.get("labels") or [])
+    start_i = safe_int(ctx.window_start_ms)
+    end_i = safe_int(ctx.window_end_ms)
+    metrics_paths = [f.metrics for f in (files, *members) if f.metrics]
+    events_paths = [f.events for f in (files, *members) if f.events]
+    procs_extra = [f.procs_dir for f in members if f.procs_dir]
+
+    def _events_merged(rep: Optional[redaction.RedactionReport]) -> List[Dict[str, Any]]:
+        if len(events_paths) <= 1:
+            return _load_events(events_paths[0] if events_paths else None, ctx.window_start_ms, ctx.window_end_ms, rep)
+        seen = set()
+        out: List[Dict[str, Any]] = []
+        for p in events_paths:
+            for ev in _load_events(p, ctx.window_start_ms, ctx.window_end_ms, rep):
+                key = (ev.get("ts"), ev.get("tag"), ev.get("msg"))
+                if key not in seen:
+                    seen.add(key)
+                    out.append(ev)
+        out.sort(key=lambda ev: safe_int(ev.get("ts")) or 0)
+        return out
+
+    def _timed(name: str, fn: Any) -> Tuple[str, Any, float]:
+        t = time.perf_counter()
+        try:
+            res = fn()
+        except Exception as exc:
+            ctx.errors[name] = repr(exc)
+            res = None
+        return name, res, (time.perf_counter() - t) * 1000.0
+
+    # one report per task (tasks run concurrently), merged below
+    task_reports = {name: redaction.RedactionReport() for name in ("events", "dmesg", "hilog")}
+    tasks = [
+        ("metrics", lambda: _load_metrics_merged(metrics_paths)),
+        ("events", lambda: _events_merged(task_reports["events"])),
+        ("procs", lambda: proc_timeseries.load_process_timeseries(files.procs_dir or ctx.run_dir / "procs", start_i, end_i,
+                                                                  procs_extra)),
+        ("dmesg", lambda: _load_log_tail(files.dmesg_after, RUN_LOG_TAIL_LINES, task_reports["dmesg"], "dmesg")),
+        ("hilog", lambda: _load_log_tail(files.hilog_full, RUN_LOG_TAIL_LINES, task_reports["hilog"], "hilog")),
+    ]
+    results: Dict[str, Any] = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="run_load") as pool:
+        futs = [pool.submit(_timed, name, fn) for name, fn in tasks]
+        for fut in futs:
+            name, res, ms = fut.result()
+            results[name] = res
+            ctx.timings[name] = round(ms, 3)
+
+    ctx.metrics_rows_all, ctx.metrics_fields = results.get("metrics") or ([], [])
+    ctx.metrics_rows = compute_metrics_window(ctx.metrics_rows_all, ctx.window_start_ms, ctx.window_end_ms)
+    ctx.events = results.get("events") or []
+    ctx.proc_ts = results.get("procs") or {}
+    ctx.dmesg_lines, ctx.dmesg_tail = results.get("dmesg") or ([], "")
+    ctx.hilog_lines, ctx.hilog_tail = results.get("hilog") or ([], "")
+    ctx.prompt_events = redaction.split_leaky_events(ctx.events, report)
+    for task_report in task_reports.values():
+        report.merge(task_report)
+    ctx.redactions = report.as_dict()
+
+    if metrics_features is not None and ctx.metrics_rows_all:
+        t0 = time.perf_counter()
+        try:
+            ctx.metrics_feature_block = metrics_features.compute_metrics_features(ctx.metrics_rows_all, start_i, end_i)
+        except Exception as exc:
+            ctx.errors["metrics_features"] = repr(exc)
+        ctx.timings["metrics_features"] = round((time.perf_counter() - t0) * 1000.0, 3)
+
+    t0 = time.perf_counter()
+    ctx.pidstat_interval_ms = ctx.proc_ts.get("pidstat_interval_ms")
+    ctx.candidate_processes = proc_timeseries.rank_process_candidates(ctx.proc_ts, CLK_TCK, limit=80) if ctx.proc_ts else []
+    ctx.primary_suspect = ctx.candidate_processes[0] if ctx.candidate_processes else None
+    ctx.secondary_suspects = ctx.candidate_processes[1:6]
+    ctx.timings["rank"] = round((time.perf_counter() - t0) * 1000.0, 3)
+
+    ctx.observations = _build_observations(ctx)
+
+
+def load_run_context(run_dir: Path,
+                     max_workers: int = RUN_LOADER_WORKERS,
+                     log_fn: Any = None,
+                     use_cache: Optional[bool] = None) -> RunContext:
+    """
+    Parse every run input once. _run_meta.json is read first (the run window
+    depends on it); metrics, events, procs/pidstat and the dmesg/hilog tails
+    are then read concurrently. Per-input wall time lands in ctx.timings.
+    With the feature cache enabled, unchanged inputs (same size/mtime/hash and
+    RUN_CONTEXT_VERSION) are restored from run_dir/.feature_cache.json.gz.
+    """
+    t_all = time.perf_counter()
+    files = RunFiles.scan(run_dir)
+    ctx = RunContext(run_dir=run_dir, run_id=run_dir.name, files=files)
+    if use_cache is None:
+        use_cache = FEATURE_CACHE_ENABLED
+
+    sources: Optional[Dict[str, Any]] = None
+    if use_cache:
+        t0 = time.perf_counter()
+        sources = feature_cache.fingerprint_sources(run_dir, files.sources())
+        cached = feature_cache.load_cache(run_dir, RUN_CONTEXT_VERSION, sources)
+        ctx.cache_hit = cached is not None and _context_from_cache(ctx, cached)
+        ctx.timings["cache_lookup"] = round((time.perf_counter() - t0) * 1000.0, 3)
+
+    if not ctx.cache_hit:
+        _parse_run_inputs(ctx, max_workers)
+        # partial parses are not cached: the next run should retry the failed input
+        if sources is not None and not ctx.errors:
+            t0 = time.perf_counter()
+            stored = feature_cache.store_cache(run_dir, RUN_CONTEXT_VERSION, sources, _context_to_cache(ctx))
+            if not stored:
+                ctx.errors["feature_cache"] = "store failed (read-only run_dir?)"
+            ctx.timings["cache_store"] = round((time.perf_counter() - t0) * 1000.0, 3)
+
+    ctx.timings["total"] = round((time.perf_counter() - t_all) * 1000.0, 3)
+    if log_fn is not None:
+        for name, err in ctx.errors.items():
+            log_fn(f"[load] {name} failed: {err}")
+        log_fn(f"[load] feature_cache={'hit' if ctx.cache_hit else 'miss'} timings_ms "
+               + " ".join(f"{k}={v}" for k, v in ctx.timings.items()))
+    return ctx
+
+def load_coalesced_context(run_dir: Path,
+                           member_dirs: Sequence[Path],
+                           max_workers: int = RUN_LOADER_WORKERS,
+                           log_fn: Any = None) -> RunContext:
+    """
+    One RunContext for a burst of bundles from the same device: run_dir (the newest, its
+    dmesg/hilog tails are used) plus member_dirs, older runs whose windows overlap or touch it.
+    The window is the union of all of them; metrics rows, events and process samples of every
+    run are merged. Never cached: the inputs span several run dirs.
+    """
+    if not member_dirs:
+        return load_run_context(run_dir, max_workers, log_fn)
+    t_all = time.perf_counter()
+    ctx = RunContext(run_dir=run_dir, run_id=run_dir.name, files=RunFiles.scan(run_dir))
+    ctx.coalesced_run_ids = [d.name for d in member_dirs]
+    _parse_run_inputs(ctx, max_workers, [RunFiles.scan(d) for d in member_dirs])
+    ctx.observations.append(
+        f"合并了同一设备的 {len(member_dirs) + 1} 个重叠 run: {', '.join([ctx.run_id] + ctx.coalesced_run_ids)}")
+    ctx.timings["total"] = round((time.perf_counter() - t_all) * 1000.0, 3)
+    if log_fn is not None:
+        for name, err in ctx.errors.items():
+            log_fn(f"[load] {name} failed: {err}")
+        log_fn(f"[load] coalesced run_ids={','.join(ctx.coalesced_run_ids)} window_ms={ctx.window_start_ms}..{ctx.window_end_ms} "
+               + "timings_ms " + " ".join(f"{k}={v}" for k, v in ctx.timings.items()))
+    return ctx
+
+@dataclass
+class InferOptions:
+    """Per-call overrides of the CLI flags; None falls back to the WK_QWEN3_* environment."""
+    min_free_mib: Optional[int] = None
+    min_free_mib_stage2: Optional[int] = None
+    low_vram_wait_sec: Optional[int] = None
+    low_vram_policy: Optional[str] = None
+    enable_stage2: Optional[int] = None
+    wait_poll_sec: Optional[int] = None
+    wait_max_sec: Optional[int] = None
+    stage2_wait_poll_sec: Optional[int] = None
+    stage2_wait_max_sec: Optional[int] = None
+    stage2_tail_bytes: Optional[int] = None
+    stage2_tail_lines: Optional[int] = None
+    # overload ladder rung (load_ladder.LEVELS, default WK_DEGRADE_LEVEL) and the queue wait behind it
+    degrade_level: Optional[int] = None
+    queue_wait_sec: Optional[float] = None
+    # polled between stages and once per generated token; True aborts the run (status "cancelled")
+    cancel: Optional[Callable[[], bool]] = None
+    # stage -> seconds (stage_deadline.STAGES), on top of the WK_STAGE_DEADLINE* budgets
+    deadlines: Optional[Dict[str, float]] = None
+
+
+class InferCancelled(RuntimeError):
+    """opts.cancel() turned true; args[0] is the stage it was noticed after."""
+
+
+@dataclass
+class InferResult:
+    """
+    status: ok | fallback (inference failed, fallback outputs written) | cancelled (opts.cancel
+    fired, e.g. a newer bundle superseded this one) | skipped_locked (another inference holds
+    out_dir/.infer_lock, nothing written).
+    """
+    run_dir: Path
+    out_dir: Path
+    status: str
+    exit_code: int = 0
+    error: str = ""
+    stage2: str = ""
+    model_cached: bool = False
+    degrade_level: int = 0
+    deadline_exceeded: List[str] = field(default_factory=list)
+
+    @property
+    def diagnosis_path(self) -> Path:
+        return self.out_dir / "diagnosis.json"
+
+    @property
+    def actions_path(self) -> Path:
+        return self.out_dir / "actions.json"
+
+
+# build_model() result per process: in-process callers (watch_and_infer via
+# server_B/orchestrator/run_closed_loop.py) pay the model load once, not per bundle
+MODEL_CACHE_ENABLED = os.environ.get("WK_INFER_KEEP_MODEL", "1") != "0"
+_MODEL_CACHE: Dict[str, Any] = {}
+_MODEL_LOCK = threading.Lock()
+# one generate() at a time on the cached model; taken by the job, released by the generate
+# thread itself, so a hung call that run_with_deadline abandoned keeps it until it really ends
+_GENERATE_LOCK = threading.Lock()
+# generation budget from the short_tokens rung of the overload ladder on
+DEGRADE_MAX_NEW_TOKENS = int(os.environ.get("WK_DEGRADE_MAX_NEW_TOKENS", "96"))
+
+def load_model_cached(log: Any) -> Tuple[Any, Any, bool]:
+    """(tokenizer, model, from_cache); retries with device_map=cuda:0 when offloading is refused."""
+    with _MODEL_LOCK:
+        cached = _MODEL_CACHE.get("model")
+        if cached is not None:
+            return cached[0], cached[1], True
+        from infer_qwen3_fault_2stage import build_model
+        try:
+            tokenizer, model = build_model()
+        except Exception as exc:
+            msg = str(exc)
+            if "dispatched on the CPU or the disk" in msg:
+                log("[closed_loop] retry build_model with device_map=cuda:0")
+                try:
+                    import gc
+                    import torch
+                    gc.collect()
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+                except Exception:
+                    pass
+                if build_model_supports_device_map(build_model):
+                    tokenizer, model = build_model(device_map={"": 0})
+                else:
+                    log("[closed_loop] build_model has no device_map kw; rethrow")
+                    raise
+            else:
+                raise
+        if MODEL_CACHE_ENABLED:
+            _MODEL_CACHE["model"] = (tokenizer, model)
+        return tokenizer, model, False
+
+def model_resident() -> bool:
+    """True when this process already holds the model (its VRAM shows up as used by nvidia-smi)."""
+    with _MODEL_LOCK:
+        return _MODEL_CACHE.get("model") is not None
+
+def free_cuda_cache() -> None:
+    try:
+        import gc
+        import torch
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except Exception:
+        pass
+
+def release_model() -> None:
+    """Drop the cached model and return its GPU memory (e.g. before another process needs it)."""
+    with _MODEL_LOCK:
+        _MODEL_CACHE.clear()
+    free_cuda_cache()
+
+def generation_stopper(should_stop: Callable[[], bool]) -> Any:
+    """
+    StoppingCriteriaList ending generate() as soon as should_stop() is true (None without
+    transformers). Its criterion keeps the latest ids, so partial_text() can decode what was
+    generated so far, also for a generate call that had to be abandoned.
+    """
+    try:
+        import torch
+        from transformers import StoppingCriteria, StoppingCriteriaList
+    except Exception:
+        return None
+
+    class _Stop(StoppingCriteria):
+        def __init__(self) -> None:
+            self.ids = None
+            self.prompt_len = 0
+
+        def reset(self) -> None:
+            self.ids = None
+
+        def partial_text(self, tokenizer: Any) -> str:
+            if self.ids is None:
+                return ""
+            try:
+                return tokenizer.decode(self.ids[0][self.prompt_len:], skip_special_tokens=True).strip()
+            except Exception:
+                return ""
+
+        def __call__(self, input_ids, scores, **kwargs):
+            if self.ids is None:
+                self.prompt_len = input_ids.shape[-1] - 1  # first call comes after one new token
+            self.ids = input_ids
+            return torch.full((input_ids.shape[0],), bool(should_stop()), dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([_Stop()])
+
+def run_inference(run_dir: Path,
+                  out_dir: Path,
+                  opts: Optional[InferOptions] = None,
+                  run_ctx: Optional[RunContext] = None) -> InferResult:
+    """
+    run_dir -> out_dir/{diagnosis,actions,notes}[_v2].json + logs. Inference errors never
+    raise: fallback outputs are written and status="fallback". run_ctx (load_run_context
+    of the same run_dir) skips re-parsing the inputs.
+    """
+    if opts is None:
+        opts = InferOptions()
+    run_dir = Path(run_dir).resolve()
+    out_dir = Path(out_dir).resolve()
     out_dir.mkdir(parents=True, exist_ok=True)
 
     infer_log = out_dir / "infer.log"
@@ -1111,37 +1680,13 @@ def main():
         except Exception:
             pass
         print(msg, flush=True)
-        return
-
-    meta_path = run_dir / "_run_meta.json"
-    dmesg_after = run_dir / "dmesg_after.utf8.log"
-    hilog_full = run_dir / "hilog_text_full.log"
-    metrics_dir = run_dir / "metrics"
-    events_dir = run_dir / "events"
-    procs_dir = run_dir / "procs"
-
-    payload = {
-        "ts": datetime.utcnow().isoformat() + "Z",
-        "run_dir": str(run_dir),
-        "run_id": run_dir.name,
-        "has_run_meta": meta_path.exists(),
-    }
-
-    meta = None
-    if meta_path.exists():
-        meta = json.loads(meta_path.read_text(encoding="utf-8"))
-        payload["meta"] = {
-            "scenario_tag": meta.get("scenario_tag"),
-            "fault_type": meta.get("fault_type"),
-            "labels": meta.get("labels", []),
-            "obs_fault_state": meta.get("obs_fault_state"),
-            "metrics_summary": meta.get("metrics_summary"),
-            "obs_multi": meta.get("obs_multi"),
-        }
-    else:
-        meta = {}
+        return InferResult(run_dir, out_dir, "skipped_locked")
+    if lock_path.reclaimed:
+        log(f"[closed_loop] reclaimed expired infer lock out_dir={out_dir}")
 
     exit_code = 0
+    err_out = ""
+    model_cached = False
     diagnosis = {
         "schema_version": 1,
         "fault_state": "unknown",
@@ -1170,11 +1715,23 @@ def main():
     notes_v2 = {"schema_version": 1, "actions_manual": [], "summary": ""}
     skip_stage2 = False
     skip_stage2_reason = ""
-    candidate_processes: List[Dict[str, Any]] = []
-    primary_suspect: Optional[Dict[str, Any]] = None
-    secondary_suspects: List[Dict[str, Any]] = []
-    pidstat_interval_ms: Optional[int] = None
-    observations: List[str] = []
+    degrade_level = load_ladder.clamp_level(
+        opts.degrade_level if opts.degrade_level is not None
+        else load_ladder.parse_level(os.environ.get("WK_DEGRADE_LEVEL", "0"))
+    )
+    ctx: Optional[RunContext] = None
+    cancelled_at = ""
+    try:
+        budgets = stage_deadline.policy_from_env().budgets()
+    except Exception:
+        budgets = dict(stage_deadline.DEFAULT_BUDGETS)
+    budgets.update(opts.deadlines or {})
+    clock = stage_deadline.StageClock(budgets)
+
+    def check_cancel(stage: str) -> None:
+        if opts.cancel is not None and opts.cancel():
+            raise InferCancelled(stage)
+
     try:
         log(f"[meta] run_dir={run_dir}")
         log(f"[meta] out_dir={out_dir}")
@@ -1192,169 +1749,22 @@ def main():
         system_prompt = load_system_prompt_safe(Path(sp_path))
         log(f"[prompt] system_prompt_source={sp_path} len={len(system_prompt)}")
 
-        labels = parse_label_kv(meta.get("labels") or [])
-        run_window_start_ms = meta.get("run_window_host_epoch_ms_start")
-        run_window_end_ms = meta.get("run_window_host_epoch_ms_end")
-
-        run_start_ms = parse_dotnet_date(meta.get("run_start")) or meta.get("host_epoch_ms_start")
-        run_end_ms = parse_dotnet_date(meta.get("run_end"))
-        if run_window_start_ms in (0, None):
-            run_window_start_ms = run_start_ms
-        if run_window_end_ms in (0, None):
-            run_window_end_ms = run_end_ms
-
-        metrics_file = None
-        if metrics_dir.exists():
-            candidates = sorted(metrics_dir.glob("sys_*.csv"))
-            metrics_file = candidates[-1] if candidates else None
-        metrics_rows, metrics_fields = load_metrics_csv(metrics_file) if metrics_file else ([], [])
-        metrics_rows = compute_metrics_window(metrics_rows, run_window_start_ms, run_window_end_ms)
-
-        events: List[Dict[str, Any]] = []
-        if events_dir.exists():
-            ev_files = sorted(events_dir.glob("events_*.jsonl"))
-            if ev_files:
-                try:
-                    with ev_files[-1].open("r", encoding="utf-8") as f:
-                        for line in f:
-                            line = line.strip()
-                            if not line:
-                                continue
-                            try:
-                                obj = json.loads(line)
-                                obj["msg"] = sanitize_event_msg_for_llm(obj.get("msg"))
-                                ts = safe_int(obj.get("ts"))
-                                if run_window_start_ms and run_window_end_ms and ts is not None:
-                                    if not (run_window_start_ms <= ts <= run_window_end_ms):
-                                        continue
-                                events.append(obj)
-                            except Exception:
-                                continue
-                except Exception:
-                    pass
-
-        proc_lines: List[str] = []
-        if procs_dir.exists():
-            proc_files = sorted(procs_dir.glob("procs_*.txt"))
-            if proc_files:
-                proc_lines = read_lines_tail(proc_files[-1], 200)
-                # drop header lines
-                proc_lines = [ln for ln in proc_lines if ln.strip() and not ln.startswith("PID ")]
-
-        proc_entries = parse_proc_snapshot_lines(proc_lines)
-        pidstat0, pidstat0_ms = parse_pidstat_file(procs_dir / "pidstat_0.txt")
-        pidstat1, pidstat1_ms = parse_pidstat_file(procs_dir / "pidstat_1.txt")
-        pidstat_interval_ms = None
-        if pidstat0_ms is not None and pidstat1_ms is not None and pidstat1_ms > pidstat0_ms:
-            pidstat_interval_ms = pidstat1_ms - pidstat0_ms
-        elif pidstat0 and pidstat1:
-            pidstat_interval_ms = 1000
-
-        candidate_processes: List[Dict[str, Any]] = []
-        for proc in proc_entries:
-            pid = proc.get("pid")
-            if pid is None:
-                continue
-            info0 = pidstat0.get(pid) if pidstat0 else None
-            info1 = pidstat1.get(pid) if pidstat1 else None
-            cpu_delta = None
-            if info0 and info1:
-                u0 = info0.get("utime")
-                s0 = info0.get("stime")
-                u1 = info1.get("utime")
-                s1 = info1.get("stime")
-                if None not in (u0, s0, u1, s1):
-                    delta = (u1 + s1) - (u0 + s0)
-                    if delta >= 0:
-                        cpu_delta = delta
-
-            cpu_pct = None
-            if cpu_delta is not None and pidstat_interval_ms and pidstat_interval_ms > 0:
-                cpu_pct = round((cpu_delta / (CLK_TCK * (pidstat_interval_ms / 1000.0))) * 100.0, 2)
-
-            score = cpu_delta if cpu_delta is not None else None
-            signals: List[str] = []
-            if cpu_delta is not None:
-                signals.append("cpu_delta_jiffies")
-            if proc.get("rss_kb") is not None:
-                signals.append("rss_kb")
-            if proc.get("stat"):
-                signals.append("stat")
-
-            candidate_processes.append({
-                "pid": pid,
-                "name": proc.get("comm"),
-                "comm": proc.get("comm"),
-                "cmd": proc.get("comm"),
-                "stat": proc.get("stat"),
-                "rss_kb": proc.get("rss_kb"),
-                "cpu_delta_jiffies": cpu_delta,
-                "cpu_pct": cpu_pct,
-                "score": score,
-                "signals": signals,
-                "source": "pidstat" if cpu_delta is not None else "procs",
-            })
-
-        def _cand_sort_key(item: Dict[str, Any]) -> Tuple[int, float, float]:
-            cpu = item.get("cpu_delta_jiffies")
-            rss = item.get("rss_kb") or 0
-            if cpu is None:
-                return (0, float(rss), 0.0)
-            return (1, float(cpu), float(rss))
-
-        candidate_processes.sort(key=_cand_sort_key, reverse=True)
-        if len(candidate_processes) > 80:
-            candidate_processes = candidate_processes[:80]
-
-        primary_suspect = candidate_processes[0] if candidate_processes else None
-        secondary_suspects = candidate_processes[1:6] if len(candidate_processes) > 1 else []
-        observations: List[str] = []
-        if metrics_rows:
-            observations.append(f"run_window 内 metrics 行数={len(metrics_rows)}")
-        if events:
-            observations.append(f"run_window 内 events 条数={len(events)}")
-        if proc_entries:
-            observations.append(f"进程快照条数={len(proc_entries)}")
-        if pidstat0 or pidstat1:
-            observations.append(f"pidstat 覆盖进程数: pidstat_0={len(pidstat0)} pidstat_1={len(pidstat1)}")
+        if run_ctx is not None:
+            ctx = run_ctx
+            log(f"[load] run context passed in (feature_cache={'hit' if ctx.cache_hit else 'miss'})")
         else:
-            observations.append("pidstat_0/1 缺失或为空")
-
-        dmesg_lines = read_lines_tail(dmesg_after, 200)
-        hilog_lines = read_lines_tail(hilog_full, 200)
-
-        meta_llm = sanitize_meta_for_llm(meta)
-
-        user_message = build_user_message(
-            run_id=run_dir.name,
-            meta=meta_llm,
-            labels={},  # avoid leaking label fields into the prompt
-            metrics_rows=metrics_rows,
-            events=events,
-            process_candidates=candidate_processes,
-            dmesg_lines=dmesg_lines,
-            hilog_lines=hilog_lines,
-            run_window_start_ms=run_window_start_ms,
-            run_window_end_ms=run_window_end_ms,
-        )
+            clock.start("features")
+            ctx = stage_deadline.run_with_deadline(lambda: load_run_context(run_dir, log_fn=log),
+                                                   clock.remaining(), "features")
+        labels = ctx.labels
+        user_message = ctx.user_message()
 
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_message},
         ]
 
-        prompt_material = {
-            "run_meta": meta_llm,  # sanitized
-            "metrics_fields": metrics_fields,
-            "events_count": len(events),
-            "dmesg_after_tail": redact_label_leaks(read_text_tail(dmesg_after, 200)),
-            "hilog_tail": redact_label_leaks(read_text_tail(hilog_full, 200)),
-            "candidate_processes": candidate_processes,
-            "primary_suspect": primary_suspect,
-            "secondary_suspects": secondary_suspects,
-            "pidstat_interval_ms": pidstat_interval_ms,
-            "clk_tck": CLK_TCK,
-        }
+        prompt_material = ctx.prompt_material()
 
         (out_dir / "prompt_material.json").write_text(
             json.dumps(prompt_material, ensure_ascii=False, indent=2),
@@ -1365,13 +1775,14 @@ def main():
         input_jsonl.write_text(json.dumps({"messages": messages}, ensure_ascii=False) + "\n", encoding="utf-8")
         log(f"[closed_loop] wrote: {input_jsonl}")
 
+        check_cancel("features")
         gpu_info, gpu_err = query_gpu_mem()
         if gpu_info:
             log(f"[gpu] free_mib={gpu_info['free_mib']} used_mib={gpu_info['used_mib']} total_mib={gpu_info.get('total_mib')}")
         else:
             log(f"[gpu] nvidia-smi unavailable: {gpu_err}")
         # ===== stage2 enable/disable (default: disabled) =====
-        enable_stage2 = args.enable_stage2 if args.enable_stage2 is not None else int(
+        enable_stage2 = opts.enable_stage2 if opts.enable_stage2 is not None else int(
             os.environ.get("WK_QWEN3_ENABLE_STAGE2", "0")
         )
         enable_stage2 = 1 if int(enable_stage2) != 0 else 0
@@ -1379,38 +1790,44 @@ def main():
             skip_stage2 = True
             skip_stage2_reason = "disabled_by_config"
             log("[closed_loop] stage2 disabled by config (WK_QWEN3_ENABLE_STAGE2=0)")
-
-        min_free_mib = args.min_free_mib if args.min_free_mib is not None else int(
+        if degrade_level > load_ladder.LEVEL_FULL:
+            log(f"[degrade] level={degrade_level} ({load_ladder.LEVELS[degrade_level]}) "
+                f"queue_wait_sec={opts.queue_wait_sec}")
+            if not skip_stage2:
+                skip_stage2 = True
+                skip_stage2_reason = "load_shed"
+
+        min_free_mib = opts.min_free_mib if opts.min_free_mib is not None else int(
             os.environ.get("WK_QWEN3_MIN_FREE_MIB", "8140")
         )
-        low_vram_wait_sec = args.low_vram_wait_sec if args.low_vram_wait_sec is not None else int(
+        low_vram_wait_sec = opts.low_vram_wait_sec if opts.low_vram_wait_sec is not None else int(
             os.environ.get("WK_QWEN3_LOW_VRAM_WAIT_SEC", "15")
         )
-        low_vram_policy = args.low_vram_policy or os.environ.get("WK_QWEN3_LOW_VRAM_POLICY", "skip")
+        low_vram_policy = opts.low_vram_policy or os.environ.get("WK_QWEN3_LOW_VRAM_POLICY", "skip")
         low_vram_policy = low_vram_policy.strip().strip('"').strip("'").lower()
         if low_vram_policy not in ("skip", "try", "wait"):
             low_vram_policy = "skip"
 
-        wait_poll_sec = args.wait_poll_sec if args.wait_poll_sec is not None else int(
+        wait_poll_sec = opts.wait_poll_sec if opts.wait_poll_sec is not None else int(
             os.environ.get("WK_QWEN3_WAIT_POLL_SEC", "15")
         )
-        wait_max_sec = args.wait_max_sec if args.wait_max_sec is not None else int(
+        wait_max_sec = opts.wait_max_sec if opts.wait_max_sec is not None else int(
             os.environ.get("WK_QWEN3_WAIT_MAX_SEC", "0")  # 0 means wait forever
         )
         # stage2 headroom only; keep smaller threshold than stage1
-        min_free_mib_stage2 = args.min_free_mib_stage2 if args.min_free_mib_stage2 is not None else int(
+        min_free_mib_stage2 = opts.min_free_mib_stage2 if opts.min_free_mib_stage2 is not None else int(
             os.environ.get("WK_QWEN3_MIN_FREE_MIB_STAGE2", "4096")
         )
-        stage2_wait_poll_sec = args.stage2_wait_poll_sec if args.stage2_wait_poll_sec is not None else int(
+        stage2_wait_poll_sec = opts.stage2_wait_poll_sec if opts.stage2_wait_poll_sec is not None else int(
             os.environ.get("WK_QWEN3_STAGE2_WAIT_POLL_SEC", str(wait_poll_sec))
         )
-        stage2_wait_max_sec = args.stage2_wait_max_sec if args.stage2_wait_max_sec is not None else int(
+        stage2_wait_max_sec = opts.stage2_wait_max_sec if opts.stage2_wait_max_sec is not None else int(
             os.environ.get("WK_QWEN3_STAGE2_WAIT_MAX_SEC", "900")  # 榛樿鏈€澶氱瓑 15 鍒嗛挓
         )
-        stage2_tail_bytes = args.stage2_tail_bytes if args.stage2_tail_bytes is not None else int(
+        stage2_tail_bytes = opts.stage2_tail_bytes if opts.stage2_tail_bytes is not None else int(
             os.environ.get("WK_QWEN3_STAGE2_TAIL_BYTES", "40000")
         )
-        stage2_tail_lines = args.stage2_tail_lines if args.stage2_tail_lines is not None else int(
+        stage2_tail_lines = opts.stage2_tail_lines if opts.stage2_tail_lines is not None else int(
             os.environ.get("WK_QWEN3_STAGE2_TAIL_LINES", "1200")
         )
         log(f"[stage2] tail_limits: bytes={stage2_tail_bytes} lines={stage2_tail_lines}")
@@ -1425,7 +1842,12 @@ def main():
         if low_vram_policy == "wait":
             log(f"[gpu] wait_policy: poll_sec={wait_poll_sec} max_wait_sec={wait_max_sec} (0=forever)")
 
-        if gpu_info and gpu_info["free_mib"] < min_free_mib:
+        resident = model_resident()
+        if resident:
+            # the "used" memory is our own model: nothing to wait for before stage1
+            log("[gpu] model resident in this process; pre-load free memory check skipped")
+        if (gpu_info and gpu_info["free_mib"] < min_free_mib and not resident
+                and degrade_level < load_ladder.LEVEL_TRIAGE):
             log(f"[gpu] low free memory ({gpu_info['free_mib']} MiB < {min_free_mib} MiB), policy={low_vram_policy}")
             if low_vram_policy == "skip":
                 log(f"[gpu] waiting {low_vram_wait_sec}s before stage2 skip...")
@@ -1444,61 +1866,111 @@ def main():
 
             elif low_vram_policy == "wait":
                 # wait before loading model to reduce stage1 OOM probability
-                ok = wait_for_gpu(min_free_mib, wait_poll_sec, wait_max_sec, log)
+                t_wait = time.time()
+                ok = wait_for_gpu(min_free_mib, wait_poll_sec, clock.cap_wait("gpu_wait", wait_max_sec), log)
+                if not ok and 0 < clock.budget("gpu_wait") <= time.time() - t_wait:
+                    clock.exceed("gpu_wait")
                 if not ok:
                     # if wait failed (no nvidia-smi or timeout), continue but mark risk; stage1 may still OOM
                     log("[gpu_wait] wait failed; continue with best-effort inference (may OOM)")
 
-        log("[closed_loop] loading model...")
-        from infer_qwen3_fault_2stage import build_model, stage1_reason, stage2_summarize
-        try:
-            tokenizer, model = build_model()
-        except Exception as exc:
-            msg = str(exc)
-            if "dispatched on the CPU or the disk" in msg:
-                log("[closed_loop] retry build_model with device_map=cuda:0")
+        if degrade_level >= load_ladder.LEVEL_TRIAGE:
+            # no model: rule-based triage on the already parsed run context
+            diagnosis, notes = fault_triage.triage(
+                ctx.metrics_feature_block, ctx.events, ctx.primary_suspect, labels.get("severity", "unknown")
+            )
+            raw_out.write_text("### triage\n" + notes["summary"] + "\n", encoding="utf-8")
+            log(f"[degrade] {notes['summary']}")
+        else:
+            log("[closed_loop] loading model...")
+            from infer_qwen3_fault_2stage import stage1_reason, stage2_summarize
+            clock.start("model_load")
+            tokenizer, model, model_cached = stage_deadline.run_with_deadline(
+                lambda: load_model_cached(log), clock.remaining(), "model_load"
+            )
+            if model_cached:
+                log("[closed_loop] model reused from this process")
+            # log model / cuda state (helps explain 18GiB cases)
+            try:
+                import torch
+                info_after, _ = query_gpu_mem()
+                if info_after:
+                    log(f"[gpu] after_load: free_mib={info_after['free_mib']} used_mib={info_after['used_mib']} total_mib={info_after['total_mib']}")
+                is4 = bool(getattr(model, "is_loaded_in_4bit", False))
+                is8 = bool(getattr(model, "is_loaded_in_8bit", False))
+                dt = None
                 try:
-                    import gc
-                    import torch
-                    gc.collect()
-                    if torch.cuda.is_available():
-                        torch.cuda.empty_cache()
+                    dt = str(next(model.parameters()).dtype)
                 except Exception:
-                    pass
-                if build_model_supports_device_map(build_model):
-                    tokenizer, model = build_model(device_map={"": 0})
-                else:
-                    log("[closed_loop] build_model has no device_map kw; rethrow")
-                    raise
-            else:
-                raise
-        # log model / cuda state (helps explain 18GiB cases)
-        try:
-            import torch
-            info_after, _ = query_gpu_mem()
-            if info_after:
-                log(f"[gpu] after_load: free_mib={info_after['free_mib']} used_mib={info_after['used_mib']} total_mib={info_after['total_mib']}")
-            is4 = bool(getattr(model, "is_loaded_in_4bit", False))
-            is8 = bool(getattr(model, "is_loaded_in_8bit", False))
-            dt = None
-            try:
-                dt = str(next(model.parameters()).dtype)
+                    dt = str(getattr(getattr(model, "config", None), "torch_dtype", None))
+                log(f"[model] dtype={dt} is_loaded_in_4bit={is4} is_loaded_in_8bit={is8}")
+                log(f"[torch] cuda_alloc_mib={torch.cuda.memory_allocated()//(1024**2)} cuda_reserved_mib={torch.cuda.memory_reserved()//(1024**2)}")
             except Exception:
-                dt = str(getattr(getattr(model, "config", None), "torch_dtype", None))
-            log(f"[model] dtype={dt} is_loaded_in_4bit={is4} is_loaded_in_8bit={is8}")
-            log(f"[torch] cuda_alloc_mib={torch.cuda.memory_allocated()//(1024**2)} cuda_reserved_mib={torch.cuda.memory_reserved()//(1024**2)}")
-        except Exception:
-            pass
-        analysis = stage1_reason(tokenizer, model, messages)
-        summary = stage2_summarize(tokenizer, model, analysis)
+                pass
+            check_cancel("model_load")
+            stopper = generation_stopper(lambda: clock.expired() or (opts.cancel is not None and opts.cancel()))
+            gen_kw = {
+                "max_new_tokens": DEGRADE_MAX_NEW_TOKENS if degrade_level >= load_ladder.LEVEL_SHORT_TOKENS else None,
+                "stopping_criteria": stopper,
+            }
+
+            def generate(stage_fn: Callable[..., str], material: Any) -> str:
+                """One generate call under the current stage deadline; raises with the partial text when it ran out."""
+                if stopper is not None:
+                    stopper[0].reset()
+                remaining = clock.remaining()
+                hang_after = None if remaining is None else max(0.0, remaining) + stage_deadline.HANG_GRACE_SEC
+                if not _GENERATE_LOCK.acquire(timeout=-1 if hang_after is None else hang_after):
+                    log(f"[deadline] {clock.stage}: model still busy with an abandoned generate")
+                    raise stage_deadline.StageDeadlineExceeded(clock.stage, "")
+
+                def locked_generate() -> str:
+                    try:
+                        return stage_fn(tokenizer, model, material, **gen_kw)
+                    finally:
+                        _GENERATE_LOCK.release()
 
-        raw_out.write_text(
-            "### stage1_analysis\n" + analysis + "\n\n### stage2_summary\n" + summary + "\n",
-            encoding="utf-8",
-        )
+                try:
+                    text = stage_deadline.run_with_deadline(locked_generate, hang_after, clock.stage)
+                except stage_deadline.StageDeadlineExceeded as exc:
+                    exc.partial = stopper[0].partial_text(tokenizer) if stopper is not None else ""
+                    log(f"[deadline] {clock.stage}: generate hung, abandoned (partial_chars={len(exc.partial)})")
+                    raise
+                check_cancel(clock.stage)
+                if clock.expired():
+                    raise stage_deadline.StageDeadlineExceeded(clock.stage, text)
+                return text
 
-        summary_clean = sanitize_llm_text(summary)
-        diagnosis, notes = parse_summary_to_struct(summary_clean, labels.get("severity", "unknown"))
+            try:
+                if degrade_level >= load_ladder.LEVEL_SINGLE_PASS:
+                    # one generate call: the structured summary straight from the run material
+                    analysis = "(skipped: single_pass)"
+                    clock.start("stage2")
+                    summary = generate(stage2_summarize, user_message)
+                else:
+                    clock.start("stage1")
+                    analysis = generate(stage1_reason, messages)
+                    clock.start("stage2")
+                    summary = generate(stage2_summarize, analysis)
+            except stage_deadline.StageDeadlineExceeded as exc:
+                # salvage: whatever was decoded goes through the normal parser, the v2 pass is skipped
+                clock.exceed(exc.stage)
+                if exc.stage == "stage1":
+                    analysis = exc.partial
+                summary = exc.partial
+                skip_stage2 = True
+                skip_stage2_reason = "deadline_exceeded"
+                log(f"[deadline] {exc.stage} exceeded {clock.budget(exc.stage):g}s; salvaged {len(exc.partial)} chars")
+
+            raw_out.write_text(
+                "### stage1_analysis\n" + analysis + "\n\n### stage2_summary\n" + summary + "\n",
+                encoding="utf-8",
+            )
+
+            summary_clean = sanitize_llm_text(summary)
+            diagnosis, notes = parse_summary_to_struct(summary_clean, labels.get("severity", "unknown"))
+            if clock.exceeded and not diagnosis.get("root_cause"):
+                diagnosis["root_cause"] = _truncate_text(summary_clean, 500)
         actions = {"schema_version": 1, "actions": build_collect_actions()}
 
         # stage2: v2 inference (prompt_material + llm_input + actions_exec.log tail)
@@ -1508,6 +1980,8 @@ def main():
             notes_v2 = copy.deepcopy(notes)
 
             reason = skip_stage2_reason or "disabled_by_config"
+            if reason == "load_shed":
+                reason = f"load_shed ({load_ladder.LEVELS[degrade_level]})"
             notes_v2["summary"] = f"stage2_skipped: {reason}"
 
             # only low_vram skip should set GPU risk flag
@@ -1521,7 +1995,11 @@ def main():
                     free3 = info3.get("free_mib", 0) if info3 else 0
                     if free3 < min_free_mib_stage2:
                         log(f"[gpu_wait] stage2 precheck low free_mib={free3} need>={min_free_mib_stage2}; entering stage2 wait...")
-                        ok2 = wait_for_gpu(min_free_mib_stage2, stage2_wait_poll_sec, stage2_wait_max_sec, log)
+                        t_wait = time.time()
+                        ok2 = wait_for_gpu(min_free_mib_stage2, stage2_wait_poll_sec,
+                                           clock.cap_wait("gpu_wait", stage2_wait_max_sec), log)
+                        if not ok2 and 0 < clock.budget("gpu_wait") <= time.time() - t_wait:
+                            clock.exceed("gpu_wait")
                         if not ok2:
                             skip_stage2 = True
                             if not skip_stage2_reason:
@@ -1563,8 +2041,9 @@ def main():
                         {"role": "user", "content": stage2_user},
                     ]
 
-                    analysis_v2 = stage1_reason(tokenizer, model, messages_v2)
-                    summary_v2 = stage2_summarize(tokenizer, model, analysis_v2)
+                    clock.start("v2")
+                    analysis_v2 = generate(stage1_reason, messages_v2)
+                    summary_v2 = generate(stage2_summarize, analysis_v2)
                     summary_v2_clean = sanitize_llm_text(summary_v2)
 
                     with raw_out.open("a", encoding="utf-8") as f:
@@ -1590,6 +2069,18 @@ def main():
                     )
 
 
+            except InferCancelled:
+                raise
+            except stage_deadline.StageDeadlineExceeded as exc:
+                clock.exceed(exc.stage)
+                diagnosis_v2 = copy.deepcopy(diagnosis)
+                actions_v2 = copy.deepcopy(actions)
+                notes_v2 = copy.deepcopy(notes)
+                notes_v2["summary"] = "stage2_deadline_exceeded: inherit stage1"
+                notes_v2["partial_text"] = exc.partial
+                with raw_out.open("a", encoding="utf-8") as f:
+                    f.write("\n### stage2_partial_v2 (deadline_exceeded)\n" + exc.partial + "\n")
+                log(f"[deadline] v2 exceeded {clock.budget('v2'):g}s; inherit stage1 (partial_chars={len(exc.partial)})")
             except Exception as exc:
                 err_msg_v2 = str(exc)
                 diagnosis_v2 = copy.deepcopy(diagnosis)
@@ -1604,8 +2095,28 @@ def main():
 
                 log(f"[closed_loop] stage2_failed: {err_msg_v2}")
 
+    except InferCancelled as exc:
+        cancelled_at = str(exc)
+        diagnosis, actions = build_fallback_result("cancelled_superseded")
+        diagnosis_v2, actions_v2 = build_fallback_result("cancelled_superseded")
+        notes = {"schema_version": 1, "actions_manual": [], "summary": f"cancelled after {cancelled_at}"}
+        notes_v2 = copy.deepcopy(notes)
+        log(f"[closed_loop] cancelled after {cancelled_at}")
+        free_cuda_cache()  # activations / KV cache of the aborted generate; the cached model stays
+
+    except stage_deadline.StageDeadlineExceeded as exc:
+        # features / model_load ran out of time (the worker thread is left behind): fallback outputs
+        clock.exceed(exc.stage)
+        err_out = str(exc)
+        diagnosis, actions = build_fallback_result("deadline_exceeded")
+        diagnosis_v2, actions_v2 = build_fallback_result("deadline_exceeded")
+        notes = {"schema_version": 1, "actions_manual": [], "summary": f"deadline_exceeded: {exc.stage}"}
+        notes_v2 = copy.deepcopy(notes)
+        log(f"[deadline] {exc.stage} exceeded {clock.budget(exc.stage):g}s; fallback outputs")
+
     except Exception as exc:
         err_msg = str(exc)
+        err_out = err_msg or type(exc).__name__
         err_trace = traceback.format_exc()
         err_is_oom = is_torch_oom(exc) or is_cuda_oom(err_msg)
         err_type = "cuda_oom" if err_is_oom else "infer_failed"
@@ -1657,6 +2168,11 @@ def main():
         if diagnosis_v2.get("fault_state") == "normal" and diagnosis_v2.get("severity") not in ("normal", "none"):
             diagnosis_v2["severity"] = "normal"
 
+        candidate_processes = ctx.candidate_processes if ctx is not None else []
+        primary_suspect = ctx.primary_suspect if ctx is not None else None
+        secondary_suspects = ctx.secondary_suspects if ctx is not None else []
+        observations = ctx.observations if ctx is not None else []
+        pidstat_interval_ms = ctx.pidstat_interval_ms if ctx is not None else None
         inject_process_candidates(diagnosis, candidate_processes, primary_suspect, secondary_suspects)
         inject_process_candidates(diagnosis_v2, candidate_processes, primary_suspect, secondary_suspects)
         suspects_list = build_suspects_list(candidate_processes, primary_suspect, secondary_suspects, limit=5)
@@ -1688,6 +2204,17 @@ def main():
         if pidstat_interval_ms is not None:
             diagnosis["pidstat_interval_ms"] = pidstat_interval_ms
             diagnosis_v2["pidstat_interval_ms"] = pidstat_interval_ms
+        diagnosis["fidelity"] = load_ladder.fidelity(degrade_level, opts.queue_wait_sec)
+        diagnosis_v2["fidelity"] = load_ladder.fidelity(degrade_level, opts.queue_wait_sec)
+        if ctx is not None and ctx.coalesced_run_ids:
+            coalesced = {"run_ids": [ctx.run_id] + ctx.coalesced_run_ids,
+                         "window_ms": [ctx.window_start_ms, ctx.window_end_ms]}
+            diagnosis["coalesced"] = coalesced
+            diagnosis_v2["coalesced"] = coalesced
+        if clock.exceeded:
+            for diag in (diagnosis, diagnosis_v2):
+                append_risk_flag(diag, "deadline_exceeded")
+                diag["deadline_exceeded"] = clock.info()
 
         diagnosis_full = diagnosis_v2
         diagnosis_compact = compact_diagnosis(diagnosis_full, actions_v2)
@@ -1710,10 +2237,46 @@ def main():
         print(f"[closed_loop] wrote: {notes_v2_path}")
 
         if lock_path:
-            try:
-                lock_path.unlink()
-            except Exception:
-                pass
+            if lock_path.lost.is_set():
+                log(f"[closed_loop] warn: infer lock lease lost during inference out_dir={out_dir}")
+            lock_path.release()
+
+    return InferResult(
+        run_dir=run_dir,
+        out_dir=out_dir,
+        status="cancelled" if cancelled_at else ("fallback" if err_out else "ok"),
+        exit_code=exit_code,
+        error=err_out,
+        stage2=str(notes_v2.get("summary") or ""),
+        model_cached=model_cached,
+        degrade_level=degrade_level,
+        deadline_exceeded=list(clock.exceeded),
+    )
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--run_dir", required=True)
+    ap.add_argument("--out_dir", required=True)
+    ap.add_argument("--min_free_mib", type=int, default=None)
+    ap.add_argument("--min_free_mib_stage2", type=int, default=None)
+    ap.add_argument("--low_vram_wait_sec", type=int, default=None)
+    ap.add_argument("--low_vram_policy", type=str, default=None, choices=["skip", "try", "wait"])
+    ap.add_argument("--enable_stage2", type=int, default=None, choices=[0, 1])
+
+    ap.add_argument("--wait_poll_sec", type=int, default=None)
+    ap.add_argument("--wait_max_sec", type=int, default=None)
+    ap.add_argument("--stage2_wait_poll_sec", type=int, default=None)
+    ap.add_argument("--stage2_wait_max_sec", type=int, default=None)
+    ap.add_argument("--stage2_tail_bytes", type=int, default=None)
+    ap.add_argument("--stage2_tail_lines", type=int, default=None)
+    ap.add_argument("--degrade_level", type=load_ladder.parse_level, default=None,
+                    help="overload ladder rung: 0-4 or " + "/".join(load_ladder.LEVELS))
+    ap.add_argument("--queue_wait_sec", type=float, default=None)
+    ap.add_argument("--deadlines", type=stage_deadline.parse_budgets, default=None,
+                    help="per-stage budgets in seconds, e.g. stage1=300,stage2=180 (0 = unbounded)")
+    args = ap.parse_args()
+    opts = InferOptions(**{k: v for k, v in vars(args).items() if k not in ("run_dir", "out_dir")})
+    run_inference(Path(args.run_dir), Path(args.out_dir), opts)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+fault_triage.py
+- Input : RunContext fields (metrics feature block, events, ranked candidate processes)
+- Output: (diagnosis, notes) in the parse_summary_to_struct shape, without any LLM
+Used as the last rung of the overload ladder (load_ladder.py "triage"): a family is
+picked from sustained/z-scored metric excursions, board rule events and the top
+process signals. Confidence is capped at MAX_CONFIDENCE, the result is a first guess.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+# (family, feature columns, board event tags)
+FAMILY_RULES = [
+    ("cpu", ("load1_x100", "cpu_util_total_x100", "cpu_idle_x100"), ("cpu_hotspot",)),
+    ("mem", ("mem_available_kb", "mem_free_kb", "swap_used_kb"), ("mem_pressure", "mem_oom")),
+    ("io", ("io_psi_avg10_x100", "disk_read_kBps", "disk_write_kBps"), ("io_pressure",)),
+]
+SUSTAINED_SEC = 30.0
+Z_PEAK = 3.0
+EVENT_SCORE = 0.5
+EVENT_SCORE_MAX = 2.0
+LEAK_SCORE = 1.0
+FAULT_SCORE = 1.0
+MAX_CONFIDENCE = 0.6
+
+
+def _column_score(feats: Dict[str, Any]) -> Tuple[float, str]:
+    sustained = feats.get("sustained_sec") or 0.0
+    z_peak = feats.get("z_peak")
+    score = 0.0
+    if sustained >= SUSTAINED_SEC:
+        score += 1.0 + min(1.0, sustained / (4 * SUSTAINED_SEC))
+    if z_peak is not None and z_peak >= Z_PEAK:
+        score += min(1.0, z_peak / (3 * Z_PEAK))
+    if score <= 0:
+        return 0.0, ""
+    parts = [f"p95={feats.get('p95')}"]
+    if sustained:
+        parts.append(f"sustained_sec={sustained}")
+    if z_peak is not None:
+        parts.append(f"z_peak={z_peak}")
+    return score, " ".join(parts)
+
+
+def triage(feature_block: Optional[Dict[str, Any]],
+           events: List[Dict[str, Any]],
+           primary_suspect: Optional[Dict[str, Any]],
+           fallback_severity: str = "unknown") -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    columns = (feature_block or {}).get("columns") or {}
+    tag_counts: Dict[str, int] = {}
+    for ev in events or []:
+        tag = ev.get("tag") or ""
+        tag_counts[tag] = tag_counts.get(tag, 0) + 1
+
+    scores: Dict[str, float] = {}
+    evidence: Dict[str, List[str]] = {}
+    for family, cols, tags in FAMILY_RULES:
+        score = 0.0
+        lines: List[str] = []
+        for col in cols:
+            s, text = _column_score(columns.get(col) or {})
+            if s > 0:
+                score += s
+                lines.append(f"{col}: {text}")
+        n_events = sum(tag_counts.get(t, 0) for t in tags)
+        if n_events:
+            score += min(EVENT_SCORE_MAX, EVENT_SCORE * n_events)
+            lines.append(f"events {'/'.join(tags)} x{n_events}")
+        scores[family] = score
+        evidence[family] = lines
+
+    suspect_name = ""
+    if isinstance(primary_suspect, dict):
+        suspect_name = str(primary_suspect.get("name") or primary_suspect.get("comm") or "")
+        if "rss_growth" in (primary_suspect.get("signals") or []):
+            scores["mem"] += LEAK_SCORE
+            evidence["mem"].append(f"process {suspect_name} pid={primary_suspect.get('pid')} rss keeps growing")
+
+    family = max(scores, key=lambda k: scores[k])
+    best = scores[family]
+    if best < FAULT_SCORE:
+        fault_state, family = "normal", "background"
+        root_cause = "no sustained metric excursion or board rule event in the run window"
+        lines = []
+        confidence = round(min(MAX_CONFIDENCE, 0.3 + 0.3 * (FAULT_SCORE - best)), 2)
+    else:
+        fault_state = "fault"
+        lines = evidence[family]
+        root_cause = f"{family} pressure in the run window: " + "; ".join(lines[:3])
+        if suspect_name:
+            root_cause += f"; top process {suspect_name}"
+        total = sum(scores.values()) or best
+        confidence = round(min(MAX_CONFIDENCE, 0.2 + 0.4 * best / total), 2)
+
+    diagnosis = {
+        "schema_version": 1,
+        "fault_state": fault_state,
+        "family": family,
+        "severity": "normal" if fault_state == "normal" else (fallback_severity or "unknown"),
+        "root_cause": root_cause,
+        "evidence": [{"text": ln, "source": "triage_rules", "gaps": []} for ln in lines],
+        "evidence_text": lines,
+        "confidence": confidence,
+        "risk_flags": ["non_llm_triage"],
+    }
+    notes = {
+        "schema_version": 1,
+        "actions_manual": [],
+        "summary": "triage: {}/{} scores={}".format(
+            fault_state, family, {k: round(v, 2) for k, v in scores.items()}),
+    }
+    return diagnosis, notes
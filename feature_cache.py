@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+feature_cache.py
+- Input : run_dir + the source files one extractor read
+- Output: run_dir/.feature_cache.json.gz (parsed/derived features for replays)
+The cache is valid only while every source file keeps the same size, mtime and
+content hash, and the extractor version string is unchanged. Any mismatch (or a
+corrupt cache file) is reported as a miss and the caller re-parses.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+CACHE_NAME = ".feature_cache.json.gz"
+CACHE_SCHEMA = 1
+HASH_CHUNK = 1 << 20
+
+
+def file_fingerprint(p: Path) -> Optional[Dict[str, Any]]:
+    try:
+        st = p.stat()
+        h = hashlib.blake2b(digest_size=16)
+        with p.open("rb") as f:
+            while True:
+                chunk = f.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+    except OSError:
+        return None
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": h.hexdigest()}
+
+
+def fingerprint_sources(run_dir: Path, sources: Iterable[Path]) -> Dict[str, Any]:
+    """Map run_dir-relative path -> fingerprint (None for unreadable files)."""
+    out: Dict[str, Any] = {}
+    for p in sorted(set(sources)):
+        try:
+            key = p.relative_to(run_dir).as_posix()
+        except ValueError:
+            key = str(p)
+        out[key] = file_fingerprint(p)
+    return out
+
+
+def load_cache(run_dir: Path, version: str, sources: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    p = run_dir / CACHE_NAME
+    if not p.exists():
+        return None
+    try:
+        with gzip.open(p, "rt", encoding="utf-8") as f:
+            obj = json.load(f)
+    except Exception:
+        return None
+    if not isinstance(obj, dict) or obj.get("schema") != CACHE_SCHEMA:
+        return None
+    if obj.get("version") != version or obj.get("sources") != sources:
+        return None
+    data = obj.get("data")
+    return data if isinstance(data, dict) else None
+
+
+def store_cache(run_dir: Path, version: str, sources: Dict[str, Any], data: Dict[str, Any]) -> bool:
+    p = run_dir / CACHE_NAME
+    tmp = p.with_name(p.name + f".{os.getpid()}.tmp")
+    obj = {"schema": CACHE_SCHEMA, "version": version, "sources": sources, "data": data}
+    try:
+        with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=5) as f:
+            json.dump(obj, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, p)
+        return True
+    except Exception:
+        try:
+            tmp.unlink()
+        except Exception:
+            pass
+        return False
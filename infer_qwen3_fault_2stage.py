@@ -52,7 +52,7 @@ def build_model(device_map=None):
     return tokenizer, model
 
 
-def stage1_reason(tokenizer, model, messages_for_model):
+def stage1_reason(tokenizer, model, messages_for_model, max_new_tokens=None, stopping_criteria=None):
     """第一阶段：让模型自由思考，输出 <think> + 详细分析"""
     input_ids = tokenizer.apply_chat_template(
         messages_for_model,
@@ -67,10 +67,11 @@ def stage1_reason(tokenizer, model, messages_for_model):
         gen_ids = model.generate(
             input_ids=input_ids,
             attention_mask=attention_mask,
-            max_new_tokens=MAX_NEW_TOKENS,
+            max_new_tokens=max_new_tokens or MAX_NEW_TOKENS,
             do_sample=False,
             pad_token_id=tokenizer.pad_token_id,
             eos_token_id=tokenizer.eos_token_id,
+            stopping_criteria=stopping_criteria,
         )
 
     gen_ids = gen_ids[0][input_ids.shape[-1]:]
@@ -78,7 +79,7 @@ def stage1_reason(tokenizer, model, messages_for_model):
     return raw_pred.strip()
 
 
-def stage2_summarize(tokenizer, model, analysis_text):
+def stage2_summarize(tokenizer, model, analysis_text, max_new_tokens=None, stopping_criteria=None):
     """第二阶段：把上面的分析再喂给模型，让它只输出精简后的诊断结果"""
     sys_msg = {
         "role": "system",
@@ -129,10 +130,11 @@ def stage2_summarize(tokenizer, model, analysis_text):
         gen_ids = model.generate(
             input_ids=input_ids,
             attention_mask=attention_mask,
-            max_new_tokens=MAX_NEW_TOKENS,
+            max_new_tokens=max_new_tokens or MAX_NEW_TOKENS,
             do_sample=False,
             pad_token_id=tokenizer.pad_token_id,
             eos_token_id=tokenizer.eos_token_id,
+            stopping_criteria=stopping_criteria,
         )
 
     gen_ids = gen_ids[0][input_ids.shape[-1]:]
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+load_ladder.py
+- Overload degradation ladder for the inference worker: the longer bundles wait between
+  upload and inference, the cheaper each run gets, one rung at a time:
+    0 full          stage1 + stage2 (+ v2 pass when enabled)
+    1 no_v2         v2 pass skipped
+    2 short_tokens  generation budget cut to WK_DEGRADE_MAX_NEW_TOKENS
+    3 single_pass   one generate call on the run material (no stage1 analysis)
+    4 triage        no model at all: fault_triage.py rules on the metrics features
+- The level follows an EWMA of the observed queue waits. It climbs when the EWMA passes a
+  rung's threshold (WK_DEGRADE_WAIT_SEC) and drops back only once the EWMA is below
+  recover_ratio x that threshold, so it recovers by itself when the backlog drains
+  without flapping around a threshold.
+The level used is written into each diagnosis as "fidelity" (see fidelity()).
+"""
+
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+LEVELS = ("full", "no_v2", "short_tokens", "single_pass", "triage")
+LEVEL_FULL, LEVEL_NO_V2, LEVEL_SHORT_TOKENS, LEVEL_SINGLE_PASS, LEVEL_TRIAGE = range(len(LEVELS))
+DEFAULT_WAIT_SEC = "90,180,360,720"
+DEFAULT_RECOVER_RATIO = 0.5
+DEFAULT_ALPHA = 0.5
+
+
+def clamp_level(level: Any) -> int:
+    try:
+        return max(0, min(len(LEVELS) - 1, int(level)))
+    except (TypeError, ValueError):
+        return LEVEL_FULL
+
+
+def parse_level(text: str) -> int:
+    """Level number or name ("no_v2", "triage", ...)."""
+    text = (text or "").strip().lower()
+    if text in LEVELS:
+        return LEVELS.index(text)
+    return clamp_level(text or 0)
+
+
+def parse_thresholds(text: str) -> List[float]:
+    out: List[float] = []
+    for part in (text or "").split(","):
+        part = part.strip()
+        if part:
+            out.append(float(part))
+    return sorted(out)[:len(LEVELS) - 1]
+
+
+def fidelity(level: int, queue_wait_sec: Optional[float] = None) -> Dict[str, Any]:
+    level = clamp_level(level)
+    info: Dict[str, Any] = {"level": level, "name": LEVELS[level]}
+    if queue_wait_sec is not None:
+        info["queue_wait_sec"] = round(float(queue_wait_sec), 1)
+    return info
+
+
+class LoadLadder:
+    def __init__(self,
+                 thresholds: Sequence[float],
+                 recover_ratio: float = DEFAULT_RECOVER_RATIO,
+                 alpha: float = DEFAULT_ALPHA) -> None:
+        self.thresholds = sorted(float(t) for t in thresholds)[:len(LEVELS) - 1]
+        self.recover_ratio = min(1.0, max(0.0, recover_ratio))
+        self.alpha = min(1.0, max(0.01, alpha))
+        self.level = LEVEL_FULL
+        self.ewma: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def observe(self, wait_sec: float) -> int:
+        """Feed one job's queue wait; returns the level that job should run at."""
+        with self._lock:
+            wait_sec = max(0.0, float(wait_sec))
+            self.ewma = wait_sec if self.ewma is None else self.alpha * wait_sec + (1 - self.alpha) * self.ewma
+            up = sum(1 for t in self.thresholds if self.ewma >= t)
+            down = sum(1 for t in self.thresholds if self.ewma >= t * self.recover_ratio)
+            if up > self.level:
+                self.level = up
+            elif down < self.level:
+                self.level = down
+            return self.level
+
+
+def ladder_from_env() -> Optional[LoadLadder]:
+    """None when WK_DEGRADE=0 or no thresholds are configured."""
+    if os.environ.get("WK_DEGRADE", "1") == "0":
+        return None
+    try:
+        thresholds = parse_thresholds(os.environ.get("WK_DEGRADE_WAIT_SEC", DEFAULT_WAIT_SEC))
+        recover = float(os.environ.get("WK_DEGRADE_RECOVER_RATIO", str(DEFAULT_RECOVER_RATIO)))
+    except ValueError:
+        return None
+    if not thresholds:
+        return None
+    return LoadLadder(thresholds, recover)
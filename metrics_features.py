@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+metrics_features.py
+- Input : rows of metrics/sys_*.csv (csv.DictReader dicts) + run window (host epoch ms)
+- Output: fixed-size feature block per metrics column (prompt + non-LLM classifier)
+All columns are computed together on one float matrix (rows x columns); missing
+cells are NaN and never abort the computation.
+"""
+
+import math
+import warnings
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+FEATURES_SCHEMA = "metrics_features/v1"
+
+# raw columns written by faultmon.sh (ts_ms excluded) + derived columns
+RAW_COLUMNS = [
+    "mem_free_kb",
+    "load1_x100",
+    "io_psi_avg10_x100",
+    "cpu_util_total_x100",
+    "cpu_idle_x100",
+    "mem_total_kb",
+    "mem_available_kb",
+    "swap_total_kb",
+    "swap_free_kb",
+    "disk_read_kBps",
+    "disk_write_kBps",
+    "net_rx_kBps",
+    "net_tx_kBps",
+]
+DERIVED_COLUMNS = ["swap_used_kb"]
+METRIC_COLUMNS = RAW_COLUMNS + DERIVED_COLUMNS
+
+# +1: higher is worse, -1: lower is worse
+COLUMN_DIRECTION = {
+    "mem_free_kb": -1,
+    "load1_x100": 1,
+    "io_psi_avg10_x100": 1,
+    "cpu_util_total_x100": 1,
+    "cpu_idle_x100": -1,
+    "mem_total_kb": -1,
+    "mem_available_kb": -1,
+    "swap_total_kb": -1,
+    "swap_free_kb": -1,
+    "disk_read_kBps": 1,
+    "disk_write_kBps": 1,
+    "net_rx_kBps": 1,
+    "net_tx_kBps": 1,
+    "swap_used_kb": 1,
+}
+
+# absolute thresholds used when there is no usable pre-window baseline
+# (same units as the csv; load1 matches triggerd.sh CPU_LOAD1_X100_THRESHOLD)
+ABS_THRESHOLDS = {
+    "load1_x100": 300.0,
+    "cpu_util_total_x100": 8500.0,
+    "cpu_idle_x100": 1500.0,
+    "io_psi_avg10_x100": 1000.0,
+}
+
+FEATURE_KEYS = [
+    "last",
+    "min",
+    "max",
+    "mean",
+    "p50",
+    "p95",
+    "slope_per_min",
+    "base_mean",
+    "z_peak",
+    "cp_rel_sec",
+    "cp_shift",
+    "sustained_sec",
+]
+FEATURE_NAMES = ["window_rows", "baseline_rows", "window_sec"] + [
+    f"{col}.{key}" for col in METRIC_COLUMNS for key in FEATURE_KEYS
+]
+
+Z_THRESHOLD = 3.0
+MIN_BASELINE_ROWS = 5
+BASELINE_MAX_SEC = 600
+
+
+def _to_float(val: Any) -> float:
+    if val is None or val == "":
+        return math.nan
+    try:
+        return float(val)
+    except Exception:
+        return math.nan
+
+
+def rows_to_matrix(rows: List[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (ts_ms[n], values[n, len(METRIC_COLUMNS)]) sorted by ts; rows without ts are dropped."""
+    raw = np.array(
+        [[_to_float(r.get("ts_ms"))] + [_to_float(r.get(c)) for c in RAW_COLUMNS] for r in rows],
+        dtype=np.float64,
+    ).reshape(-1, 1 + len(RAW_COLUMNS))
+    raw = raw[~np.isnan(raw[:, 0])]
+    raw = raw[np.argsort(raw[:, 0], kind="stable")]
+    ts = raw[:, 0]
+    vals = raw[:, 1:]
+    swap_total = vals[:, RAW_COLUMNS.index("swap_total_kb")]
+    swap_free = vals[:, RAW_COLUMNS.index("swap_free_kb")]
+    swap_used = (swap_total - swap_free)[:, None]
+    return ts, np.hstack([vals, swap_used])
+
+
+def _split_window(ts: np.ndarray,
+                  start_ms: Optional[int],
+                  end_ms: Optional[int]) -> Tuple[np.ndarray, np.ndarray, bool]:
+    """Boolean masks (window, baseline, applied); mirrors compute_metrics_window() fallback rules."""
+    all_rows = np.ones(ts.shape[0], dtype=bool)
+    no_rows = np.zeros(ts.shape[0], dtype=bool)
+    if start_ms is None or end_ms is None or start_ms <= 0 or end_ms <= 0:
+        return all_rows, no_rows, False
+    win = (ts >= start_ms) & (ts <= end_ms)
+    if not win.any():
+        return all_rows, no_rows, False
+    base = (ts < start_ms) & (ts >= start_ms - BASELINE_MAX_SEC * 1000)
+    return win, base, True
+
+
+def _ffill(x: np.ndarray) -> np.ndarray:
+    """Forward/backward fill NaN along axis 0 (per column)."""
+    n = x.shape[0]
+    valid = ~np.isnan(x)
+    idx = np.where(valid, np.arange(n)[:, None], 0)
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    out = x[idx, np.arange(x.shape[1])]
+    first = np.argmax(valid, axis=0)
+    head = np.arange(n)[:, None] < first[None, :]
+    return np.where(head, x[first, np.arange(x.shape[1])][None, :], out)
+
+
+def _longest_run_sec(flags: np.ndarray, t_sec: np.ndarray) -> np.ndarray:
+    """Longest consecutive stretch (seconds) where flags[:, j] holds, per column."""
+    n, m = flags.shape
+    if n == 0:
+        return np.zeros(m)
+    f = flags.astype(np.int8)
+    padded = np.vstack([np.zeros((1, m), np.int8), f, np.zeros((1, m), np.int8)])
+    edges = np.diff(padded, axis=0)
+    out = np.zeros(m)
+    dt = np.median(np.diff(t_sec)) if n > 1 else 0.0
+    for j in np.nonzero(f.any(axis=0))[0]:
+        starts = np.nonzero(edges[:, j] == 1)[0]
+        ends = np.nonzero(edges[:, j] == -1)[0] - 1
+        out[j] = float(np.max(t_sec[ends] - t_sec[starts] + dt))
+    return out
+
+
+def compute_metrics_features(rows: List[Dict[str, Any]],
+                             start_ms: Optional[int],
+                             end_ms: Optional[int]) -> Dict[str, Any]:
+    """
+    Compute the per-column feature block for the run window.
+    rows must be the full (un-windowed) csv so the pre-window baseline is available.
+    """
+    block: Dict[str, Any] = {
+        "schema": FEATURES_SCHEMA,
+        "window": {"start_ms": start_ms, "end_ms": end_ms, "rows": 0, "baseline_rows": 0, "window_sec": 0.0},
+        "columns": {},
+    }
+    if not rows:
+        return block
+    ts, vals = rows_to_matrix(rows)
+    if ts.shape[0] == 0:
+        return block
+
+    win_mask, base_mask, applied = _split_window(ts, start_ms, end_ms)
+    w = vals[win_mask]
+    b = vals[base_mask]
+    t = ts[win_mask]
+    n, m = w.shape
+    t0 = float(start_ms) if applied else float(t[0])
+    t_sec = (t - t[0]) / 1000.0
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        valid = ~np.isnan(w)
+        count = valid.sum(axis=0)
+        w_min = np.nanmin(w, axis=0)
+        w_max = np.nanmax(w, axis=0)
+        w_mean = np.nanmean(w, axis=0)
+        p50, p95 = np.nanpercentile(w, [50, 95], axis=0)
+        filled = _ffill(w)
+        last = filled[-1]
+
+        # least squares slope vs time (per column, NaN cells excluded)
+        tt = np.where(valid, t_sec[:, None], 0.0)
+        xx = np.where(valid, w, 0.0)
+        st = tt.sum(axis=0)
+        sx = xx.sum(axis=0)
+        stt = (tt * tt).sum(axis=0)
+        stx = (tt * xx).sum(axis=0)
+        denom = count * stt - st * st
+        slope = np.where((count >= 2) & (denom > 0), (count * stx - st * sx) / np.where(denom > 0, denom, 1.0), np.nan)
+
+        # baseline z-scores (direction-aware: positive == worse)
+        direction = np.array([COLUMN_DIRECTION.get(c, 1) for c in METRIC_COLUMNS], dtype=np.float64)
+        base_n = (~np.isnan(b)).sum(axis=0) if b.shape[0] else np.zeros(m, dtype=int)
+        base_mean = np.nanmean(b, axis=0) if b.shape[0] else np.full(m, np.nan)
+        base_std = np.nanstd(b, axis=0) if b.shape[0] else np.full(m, np.nan)
+        has_base = base_n >= MIN_BASELINE_ROWS
+        # flat baselines (mem_total, idle swap) must not turn tiny wiggles into huge z
+        std_floor = np.maximum(np.nan_to_num(base_std), np.maximum(np.abs(np.nan_to_num(base_mean)) * 0.01, 1.0))
+        z = (w - base_mean[None, :]) / std_floor[None, :] * direction[None, :]
+        z = np.where(has_base[None, :], z, np.nan)
+        z_peak = np.nanmax(z, axis=0)
+
+        # sustained "bad" duration: z >= Z_THRESHOLD, or absolute threshold without baseline
+        abs_thr = np.array([ABS_THRESHOLDS.get(c, np.nan) for c in METRIC_COLUMNS], dtype=np.float64)
+        beyond_abs = (filled - abs_thr[None, :]) * direction[None, :] >= 0
+        beyond_abs &= ~np.isnan(abs_thr)[None, :]
+        beyond = np.where(has_base[None, :], np.nan_to_num(z, nan=-np.inf) >= Z_THRESHOLD, beyond_abs)
+        sustained = _longest_run_sec(beyond & valid, t_sec)
+
+        # single change point: argmax_k |mean(x[:k]) - mean(x[k:])| * sqrt(k(n-k)/n)
+        cp_rel = np.full(m, np.nan)
+        cp_shift = np.full(m, np.nan)
+        if n >= 4:
+            x = np.nan_to_num(filled, nan=0.0)
+            csum = np.cumsum(x, axis=0)
+            total = csum[-1]
+            k = np.arange(1, n)[:, None].astype(np.float64)
+            left = csum[:-1] / k
+            right = (total[None, :] - csum[:-1]) / (n - k)
+            stat = np.abs(left - right) * np.sqrt(k * (n - k) / n)
+            kbest = np.argmax(stat, axis=0)
+            cols = np.arange(m)
+            shift = right[kbest, cols] - left[kbest, cols]
+            usable = (count >= 4) & (w_max > w_min)
+            cp_rel = np.where(usable, (t[kbest + 1] - t0) / 1000.0, np.nan)
+            cp_shift = np.where(usable, shift, np.nan)
+
+    stacked = np.vstack([last, w_min, w_max, w_mean, p50, p95, slope * 60.0, base_mean, z_peak, cp_rel, cp_shift, sustained])
+    stacked[:, count == 0] = np.nan
+
+    block["window"].update({
+        "rows": int(n),
+        "baseline_rows": int(base_mask.sum()),
+        "window_sec": round(float(t_sec[-1]) if n else 0.0, 1),
+    })
+    columns: Dict[str, Dict[str, Optional[float]]] = {}
+    for j, col in enumerate(METRIC_COLUMNS):
+        columns[col] = {key: _round(stacked[i, j]) for i, key in enumerate(FEATURE_KEYS)}
+    block["columns"] = columns
+    return block
+
+
+def _round(v: float) -> Optional[float]:
+    if v is None or not np.isfinite(v):
+        return None
+    return round(float(v), 2) + 0.0
+
+
+def features_to_vector(block: Dict[str, Any]) -> List[float]:
+    """Flatten a feature block into a fixed-length vector aligned with FEATURE_NAMES (None -> 0.0)."""
+    win = block.get("window") or {}
+    vec = [float(win.get("rows") or 0), float(win.get("baseline_rows") or 0), float(win.get("window_sec") or 0.0)]
+    cols = block.get("columns") or {}
+    for col in METRIC_COLUMNS:
+        feats = cols.get(col) or {}
+        for key in FEATURE_KEYS:
+            v = feats.get(key)
+            vec.append(float(v) if v is not None else 0.0)
+    return vec
+
+
+def format_feature_lines(block: Dict[str, Any]) -> List[str]:
+    """Compact prompt lines: one per column that has data in the window."""
+    lines: List[str] = []
+    win = block.get("window") or {}
+    lines.append(
+        f"  window_rows={win.get('rows')} baseline_rows={win.get('baseline_rows')} window_sec={win.get('window_sec')}"
+    )
+    for col in METRIC_COLUMNS:
+        f = (block.get("columns") or {}).get(col) or {}
+        if f.get("mean") is None:
+            continue
+        parts = [
+            f"mean={f.get('mean')}",
+            f"p95={f.get('p95')}",
+            f"min={f.get('min')}",
+            f"max={f.get('max')}",
+            f"slope_per_min={f.get('slope_per_min')}",
+        ]
+        if f.get("z_peak") is not None:
+            parts.append(f"z_peak={f.get('z_peak')}")
+        if f.get("cp_rel_sec") is not None:
+            parts.append(f"change_at=+{f.get('cp_rel_sec')}s(shift={f.get('cp_shift')})")
+        if f.get("sustained_sec"):
+            parts.append(f"sustained_sec={f.get('sustained_sec')}")
+        lines.append(f"  {col}: " + " ".join(parts))
+    return lines
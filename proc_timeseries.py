@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+proc_timeseries.py
+- Input : run_dir/procs (every procs_*.txt ps snapshot + every pidstat_*.txt sample)
+- Output: per-process series keyed by (pid, start_time) and leak/hog ranked candidates
+A pid that is reused by a new process gets a new series (different start_time, or a
+different comm when only ps snapshots are available), so deltas never mix processes.
+"""
+
+import os
+import re
+from array import array
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+TIMESERIES_SCHEMA = "proc_timeseries/v1"
+
+SNAPSHOT_TS_RE = re.compile(r"ps snapshot at (\d+)\s*ms")
+PIDSTAT_TS_RE = re.compile(r"t_ms=(\d+)")
+FILE_TS_RE = re.compile(r"(\d{10,13})")
+KV_RE = re.compile(r'(\w+)=("([^"]*)"|\S+)')
+
+# combined score weights (sum to 1.0): CPU share in window, RSS growth, lifetime CPU share
+SCORE_WEIGHTS = {"cpu": 0.5, "leak": 0.35, "lifetime": 0.15}
+# RSS growth below this is treated as noise (kB per minute)
+MIN_LEAK_SLOPE_KB_PER_MIN = 64.0
+
+SeriesKey = Tuple[int, Any]
+
+
+class ProcSeries:
+    """Compact per-process samples (array('q') columns) for one (pid, start_time) identity."""
+
+    __slots__ = ("pid", "start_time", "comm", "ppid", "stat",
+                 "rss_t_ms", "rss_kb", "cpu_t_ms", "cpu_jiffies", "last_seen_ms")
+
+    def __init__(self, pid: int, start_time: Any, comm: str) -> None:
+        self.pid = pid
+        self.start_time = start_time
+        self.comm = comm
+        self.ppid: Optional[int] = None
+        self.stat: Optional[str] = None
+        self.rss_t_ms = array("q")
+        self.rss_kb = array("q")
+        self.cpu_t_ms = array("q")
+        self.cpu_jiffies = array("q")
+        self.last_seen_ms = -1
+
+    def add_rss(self, t_ms: int, rss_kb: int) -> None:
+        if self.rss_t_ms and self.rss_t_ms[-1] == t_ms:
+            self.rss_kb[-1] = rss_kb
+            return
+        self.rss_t_ms.append(t_ms)
+        self.rss_kb.append(rss_kb)
+
+    def add_cpu(self, t_ms: int, jiffies: int) -> None:
+        self.cpu_t_ms.append(t_ms)
+        self.cpu_jiffies.append(jiffies)
+
+    def touch(self, t_ms: int, stat: Optional[str], ppid: Optional[int]) -> None:
+        if t_ms >= self.last_seen_ms:
+            self.last_seen_ms = t_ms
+            if stat:
+                self.stat = stat
+            if ppid is not None:
+                self.ppid = ppid
+
+
+def _int(val: Any) -> Optional[int]:
+    if val is None:
+        return None
+    try:
+        return int(float(val))
+    except Exception:
+        return None
+
+
+def _file_ts_ms(path: Path) -> int:
+    m = FILE_TS_RE.search(path.stem)
+    if m:
+        ts = int(m.group(1))
+        return ts * 1000 if len(m.group(1)) == 10 else ts
+    try:
+        return int(path.stat().st_mtime * 1000)
+    except Exception:
+        return 0
+
+
+def parse_ps_snapshot(path: Path) -> Tuple[int, List[Dict[str, Any]]]:
+    """Parse one procs_*.txt; column layout follows the ps header (pid,ppid,stat,rss[,vsz],comm)."""
+    ts_ms: Optional[int] = None
+    rows: List[Dict[str, Any]] = []
+    cols = {"PID": 0, "PPID": 1, "STAT": 2, "RSS": 3, "COMM": 4}
+    try:
+        text = path.read_text(encoding="utf-8", errors="ignore")
+    except Exception:
+        return _file_ts_ms(path), rows
+    for ln in text.splitlines():
+        s = ln.strip()
+        if not s:
+            continue
+        if s.startswith("#"):
+            m = SNAPSHOT_TS_RE.search(s)
+            if m and ts_ms is None:
+                ts_ms = int(m.group(1))
+            continue
+        parts = s.split()
+        if "PID" in parts:
+            cols = {}
+            for idx, name in enumerate(parts):
+                name = name.upper()
+                if name in ("S", "STATE"):
+                    name = "STAT"
+                if name in ("NAME", "CMD", "COMMAND", "ARGS"):
+                    name = "COMM"
+                cols.setdefault(name, idx)
+            continue
+        pid = _int(parts[cols["PID"]]) if cols.get("PID") is not None and len(parts) > cols["PID"] else None
+        if pid is None:
+            continue
+        comm_idx = cols.get("COMM", len(parts) - 1)
+        rows.append({
+            "pid": pid,
+            "ppid": _int(parts[cols["PPID"]]) if "PPID" in cols and len(parts) > cols["PPID"] else None,
+            "stat": parts[cols["STAT"]] if "STAT" in cols and len(parts) > cols["STAT"] else None,
+            "rss_kb": _int(parts[cols["RSS"]]) if "RSS" in cols and len(parts) > cols["RSS"] else None,
+            "comm": " ".join(parts[comm_idx:]) if len(parts) > comm_idx else "",
+        })
+    return (ts_ms if ts_ms is not None else _file_ts_ms(path)), rows
+
+
+def parse_stat_line(raw: str) -> Optional[Dict[str, Any]]:
+    """Parse a /proc/<pid>/stat line (comm may contain spaces/parens)."""
+    l = raw.find("(")
+    r = raw.rfind(")")
+    if l < 0 or r <= l:
+        return None
+    head = raw[:l].split()
+    rest = raw[r + 2:].split()
+    if len(rest) < 20:
+        return None
+    utime = _int(rest[11])
+    stime = _int(rest[12])
+    return {
+        "pid": _int(head[-1]) if head else None,
+        "comm": raw[l + 1:r],
+        "stat": rest[0],
+        "ppid": _int(rest[1]),
+        "cpu_jiffies": (utime + stime) if utime is not None and stime is not None else None,
+        "start_time": _int(rest[19]),
+    }
+
+
+def parse_pidstat_sample(path: Path) -> Tuple[Optional[int], List[Dict[str, Any]]]:
+    """
+    Parse one pidstat_*.txt written by bundle_*.sh. Accepts both line formats:
+      pid=<pid> comm=<comm> rss_kb=<kb> stat="<raw stat>" cmd="<comm>"
+      <pid> <raw stat>
+    """
+    t_ms: Optional[int] = None
+    out: List[Dict[str, Any]] = []
+    try:
+        text = path.read_text(encoding="utf-8", errors="ignore")
+    except Exception:
+        return t_ms, out
+    for ln in text.splitlines():
+        s = ln.strip()
+        if not s:
+            continue
+        if s.startswith("#"):
+            m = PIDSTAT_TS_RE.search(s)
+            if m and t_ms is None:
+                t_ms = int(m.group(1))
+            continue
+        kv: Dict[str, str] = {}
+        if s.startswith("pid="):
+            for m in KV_RE.finditer(s):
+                kv[m.group(1)] = m.group(3) if m.group(3) is not None else m.group(2)
+            raw = kv.get("stat", "")
+        else:
+            raw = s
+        info = parse_stat_line(raw) if raw and raw != "NA" else None
+        pid = _int(kv.get("pid")) if kv else None
+        if pid is None and info:
+            pid = info.get("pid")
+        if pid is None:
+            continue
+        out.append({
+            "pid": pid,
+            "comm": (info or {}).get("comm") or kv.get("comm") or "",
+            "stat": (info or {}).get("stat"),
+            "ppid": (info or {}).get("ppid"),
+            "cpu_jiffies": (info or {}).get("cpu_jiffies"),
+            "start_time": (info or {}).get("start_time"),
+            "rss_kb": _int(kv.get("rss_kb")),
+        })
+    return t_ms, out
+
+
+def _in_window(ts: Optional[int], start_ms: Optional[int], end_ms: Optional[int]) -> bool:
+    if ts is None or not start_ms or not end_ms:
+        return True
+    return start_ms <= ts <= end_ms
+
+
+def _comm_match(a: str, b: str) -> bool:
+    # /proc/<pid>/stat truncates comm to 15 chars (TASK_COMM_LEN - 1)
+    a = (a or "").strip()
+    b = (b or "").strip()
+    if not a or not b:
+        return True
+    a = os.path.basename(a.split()[0])[:15]
+    b = os.path.basename(b.split()[0])[:15]
+    return a == b
+
+
+def load_process_timeseries(procs_dir: Path,
+                            start_ms: Optional[int] = None,
+                            end_ms: Optional[int] = None,
+                            extra_dirs: Sequence[Path] = ()) -> Dict[str, Any]:
+    """
+    Ingest all ps snapshots and pidstat samples into ProcSeries keyed by (pid, start_time).
+    Samples outside [start_ms, end_ms] are dropped unless that would leave nothing usable.
+    extra_dirs (procs/ of coalesced bundles) add the samples procs_dir lacks, by file name.
+    """
+    result: Dict[str, Any] = {
+        "series": {},
+        "snapshots": 0,
+        "pidstat_samples": 0,
+        "pidstat_counts": [],
+        "pidstat_interval_ms": None,
+        "last_snapshot_entries": 0,
+    }
+    dirs = [d for d in [procs_dir, *extra_dirs] if d and d.exists()]
+    if not dirs:
+        return result
+
+    def _files(pattern: str) -> List[Path]:
+        seen: Dict[str, Path] = {}
+        for d in dirs:
+            for p in d.glob(pattern):
+                seen.setdefault(p.name, p)
+        return [seen[n] for n in sorted(seen)]
+
+    snaps = [parse_ps_snapshot(p) for p in _files("procs_*.txt")]
+    samples = []
+    for p in _files("pidstat_*.txt"):
+        t_ms, rows = parse_pidstat_sample(p)
+        samples.append((t_ms if t_ms is not None else _file_ts_ms(p), rows))
+
+    snaps.sort(key=lambda x: x[0])
+    samples.sort(key=lambda x: x[0])
+    in_win = [s for s in snaps if _in_window(s[0], start_ms, end_ms)]
+    snaps = in_win if in_win else snaps[-1:]
+    in_win_samples = [s for s in samples if _in_window(s[0], start_ms, end_ms)]
+    if len(in_win_samples) >= 2 or len(samples) < 2:
+        samples = in_win_samples if in_win_samples else samples
+
+    series: Dict[SeriesKey, ProcSeries] = {}
+    by_pid: Dict[int, List[ProcSeries]] = {}
+
+    def _get(pid: int, start_time: Any, comm: str) -> ProcSeries:
+        key = (pid, start_time)
+        s = series.get(key)
+        if s is None:
+            s = ProcSeries(pid, start_time, comm)
+            series[key] = s
+            by_pid.setdefault(pid, []).append(s)
+        elif comm and (not s.comm or len(comm) > len(s.comm)):
+            s.comm = comm
+        return s
+
+    # pidstat first: it carries start_time, which anchors the identities
+    for t_ms, rows in samples:
+        for r in rows:
+            start = r.get("start_time")
+            key_start: Any = start if start is not None else "comm:" + (r.get("comm") or "")
+            s = _get(r["pid"], key_start, r.get("comm") or "")
+            s.touch(t_ms, r.get("stat"), r.get("ppid"))
+            if r.get("cpu_jiffies") is not None:
+                s.add_cpu(t_ms, r["cpu_jiffies"])
+            if r.get("rss_kb") is not None:
+                s.add_rss(t_ms, r["rss_kb"])
+
+    for ts_ms, rows in snaps:
+        for r in rows:
+            pid = r["pid"]
+            comm = r.get("comm") or ""
+            match = None
+            for cand in by_pid.get(pid, []):
+                if not _comm_match(cand.comm, comm):
+                    continue
+                # pid reused by the same binary: attach to the identity seen closest in time
+                if match is None or abs(cand.last_seen_ms - ts_ms) < abs(match.last_seen_ms - ts_ms):
+                    match = cand
+            s = match if match is not None else _get(pid, "comm:" + comm, comm)
+            s.touch(ts_ms, r.get("stat"), r.get("ppid"))
+            if r.get("rss_kb") is not None:
+                s.add_rss(ts_ms, r["rss_kb"])
+
+    for s in series.values():
+        if len(s.rss_t_ms) > 1:
+            # ps and pidstat may sample the same instant: keep one value per timestamp
+            merged = dict(zip(s.rss_t_ms, s.rss_kb))
+            order = sorted(merged)
+            s.rss_t_ms = array("q", order)
+            s.rss_kb = array("q", (merged[t] for t in order))
+
+    result["series"] = series
+    result["snapshots"] = len(snaps)
+    result["pidstat_samples"] = len(samples)
+    result["pidstat_counts"] = [len(rows) for _, rows in samples]
+    result["last_snapshot_entries"] = len(snaps[-1][1]) if snaps else 0
+    if len(samples) >= 2 and samples[-1][0] > samples[0][0]:
+        result["pidstat_interval_ms"] = samples[-1][0] - samples[0][0]
+    elif len(samples) >= 2:
+        result["pidstat_interval_ms"] = 1000
+    return result
+
+
+def _slope_per_min(t_ms: array, vals: array) -> Optional[float]:
+    n = len(t_ms)
+    if n < 2 or t_ms[-1] <= t_ms[0]:
+        return None
+    t0 = t_ms[0]
+    ts = [(t - t0) / 60000.0 for t in t_ms]
+    mt = sum(ts) / n
+    mv = sum(vals) / n
+    var = sum((t - mt) ** 2 for t in ts)
+    if var <= 0:
+        return None
+    cov = sum((t - mt) * (v - mv) for t, v in zip(ts, vals))
+    return cov / var
+
+
+def rank_process_candidates(ts: Dict[str, Any], clk_tck: int, limit: int = 80) -> List[Dict[str, Any]]:
+    """Turn the series into candidate dicts (closed_loop_infer_run schema) ranked by combined score."""
+    series: Dict[SeriesKey, ProcSeries] = ts.get("series") or {}
+    hz = float(clk_tck or 100)
+    rows: List[Dict[str, Any]] = []
+    for s in series.values():
+        cpu_delta = None
+        cpu_pct = None
+        cpu_pct_max = None
+        if len(s.cpu_t_ms) >= 2:
+            d = s.cpu_jiffies[-1] - s.cpu_jiffies[0]
+            span = s.cpu_t_ms[-1] - s.cpu_t_ms[0]
+            if d >= 0:
+                cpu_delta = d
+                if span > 0:
+                    cpu_pct = round(d / (hz * span / 1000.0) * 100.0, 2)
+            steps = []
+            for i in range(1, len(s.cpu_t_ms)):
+                dt = s.cpu_t_ms[i] - s.cpu_t_ms[i - 1]
+                dj = s.cpu_jiffies[i] - s.cpu_jiffies[i - 1]
+                if dt > 0 and dj >= 0:
+                    steps.append(dj / (hz * dt / 1000.0) * 100.0)
+            if steps:
+                cpu_pct_max = round(max(steps), 2)
+        rss_delta = None
+        slope = None
+        if len(s.rss_kb) >= 2:
+            rss_delta = s.rss_kb[-1] - s.rss_kb[0]
+            slope = _slope_per_min(s.rss_t_ms, s.rss_kb)
+        rows.append({
+            "series": s,
+            "cpu_delta": cpu_delta,
+            "cpu_pct": cpu_pct,
+            "cpu_pct_max": cpu_pct_max,
+            "cpu_total": s.cpu_jiffies[-1] if s.cpu_jiffies else None,
+            "rss_delta": rss_delta,
+            "slope": slope,
+        })
+
+    window_total = sum(r["cpu_delta"] for r in rows if r["cpu_delta"])
+    lifetime_total = sum(r["cpu_total"] for r in rows if r["cpu_total"])
+    max_slope = max([r["slope"] for r in rows if r["slope"] and r["slope"] > MIN_LEAK_SLOPE_KB_PER_MIN] or [0.0])
+
+    out: List[Dict[str, Any]] = []
+    for r in rows:
+        s: ProcSeries = r["series"]
+        share_win = (r["cpu_delta"] / window_total) if (r["cpu_delta"] and window_total) else 0.0
+        share_life = (r["cpu_total"] / lifetime_total) if (r["cpu_total"] and lifetime_total) else 0.0
+        leak = 0.0
+        if max_slope > 0 and r["slope"] and r["slope"] > MIN_LEAK_SLOPE_KB_PER_MIN and (r["rss_delta"] or 0) > 0:
+            leak = r["slope"] / max_slope
+        score = None
+        if r["cpu_delta"] is not None or r["slope"] is not None:
+            score = round(100.0 * (SCORE_WEIGHTS["cpu"] * share_win
+                                   + SCORE_WEIGHTS["leak"] * leak
+                                   + SCORE_WEIGHTS["lifetime"] * share_life), 2)
+        signals: List[str] = []
+        if r["cpu_delta"] is not None:
+            signals.append("cpu_delta_jiffies")
+        if leak > 0:
+            signals.append("rss_growth")
+        if s.rss_kb:
+            signals.append("rss_kb")
+        if s.stat:
+            signals.append("stat")
+        source = "pidstat" if r["cpu_delta"] is not None else "procs"
+        if len(s.rss_kb) >= 2 and r["cpu_delta"] is None:
+            source = "procs_series"
+        out.append({
+            "pid": s.pid,
+            "start_time": s.start_time if isinstance(s.start_time, int) else None,
+            "name": s.comm,
+            "comm": s.comm,
+            "cmd": s.comm,
+            "ppid": s.ppid,
+            "stat": s.stat,
+            "rss_kb": s.rss_kb[-1] if s.rss_kb else None,
+            "rss_delta_kb": r["rss_delta"],
+            "rss_slope_kb_per_min": round(r["slope"], 2) if r["slope"] is not None else None,
+            "rss_samples": len(s.rss_kb),
+            "cpu_delta_jiffies": r["cpu_delta"],
+            "cpu_pct": r["cpu_pct"],
+            "cpu_pct_max": r["cpu_pct_max"],
+            "cpu_samples": len(s.cpu_jiffies),
+            "cpu_share_window": round(share_win, 4) if r["cpu_delta"] is not None else None,
+            "cpu_share_lifetime": round(share_life, 4) if r["cpu_total"] is not None else None,
+            "last_seen_ms": s.last_seen_ms,
+            "score": score,
+            "signals": signals,
+            "source": source,
+        })
+
+    def _key(item: Dict[str, Any]) -> Tuple[int, float, float]:
+        sc = item.get("score")
+        rss = float(item.get("rss_kb") or 0)
+        if sc is None:
+            return (0, 0.0, rss)
+        return (1, float(sc), rss)
+
+    out.sort(key=_key, reverse=True)
+    return out[:limit] if limit > 0 else out
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+redaction.py
+- Input : prompt material (run meta, event dicts/messages, dmesg/hilog buffers)
+- Output: the same material with label-leaking tokens replaced + a per-rule report
+Each rule set is compiled into one alternation pattern, so a buffer is redacted
+in a single left-to-right scan instead of one regex/replace pass per rule.
+Output is byte-identical to the per-pass helpers it replaces (see redaction_check.py).
+"""
+
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# (rule name, regex, replacement); earlier rules win when two match at the same offset
+LABEL_LEAK_RULES: List[Tuple[str, str, str]] = [
+    ("obs_token", r"\bobs_[A-Za-z0-9_]+\b", "<redacted_obs>"),
+    ("meta_key", r"scenario_tag|fault_type", "<redacted_meta>"),
+]
+EVENT_MSG_RULES: List[Tuple[str, str, str]] = [
+    ("scenario_token", r"\b(?:cpu|mem|bg|net|background)_[A-Za-z0-9_]+\b", "<redacted_scenario>"),
+    ("obs_token", r"\bobs_[A-Za-z0-9_]+\b", "<redacted_obs>"),
+]
+# event messages that embed scenario_tag/fault_type (cli poke, run_begin/run_end markers)
+EVENT_MSG_TRIGGER_RE = re.compile(r"poke|run_end|run_begin")
+# events carrying any of these substrings (in a key or string value) are dropped from the prompt
+LEAK_PROBE_RE = re.compile(r"obs_|scenario_tag|fault_type")
+LEAK_KEYS = frozenset(("scenario_tag", "fault_type"))
+EVENT_MSG_KEEP_PARTS = 4
+EVENT_MSG_MIN_PARTS = 6
+
+META_DROP_KEYS = frozenset((
+    "scenario_tag",
+    "fault_type",
+    "family",
+    "severity",
+    "gt_family",
+    "gt_severity",
+    "gt_fault",
+    "gt_label",
+    "labels",
+    "scenario",
+    "obs_primary",
+    "obs_fault",
+))
+META_DROP_PREFIX = "obs_"
+
+
+class RedactionReport:
+    """Counts of redactions per source and rule (matched text is never stored)."""
+
+    __slots__ = ("counts",)
+
+    def __init__(self) -> None:
+        self.counts: Dict[str, Dict[str, int]] = {}
+
+    def add(self, source: str, rule: str, n: int = 1) -> None:
+        per = self.counts.setdefault(source, {})
+        per[rule] = per.get(rule, 0) + n
+
+    def merge(self, other: "RedactionReport") -> None:
+        for source, per in other.counts.items():
+            for rule, n in per.items():
+                self.add(source, rule, n)
+
+    def total(self) -> int:
+        return sum(n for per in self.counts.values() for n in per.values())
+
+    def as_dict(self) -> Dict[str, Dict[str, int]]:
+        return {s: dict(per) for s, per in self.counts.items()}
+
+
+class RedactionEngine:
+    """One precompiled alternation over all rules; sub() with a per-match dispatch."""
+
+    def __init__(self, rules: List[Tuple[str, str, str]]) -> None:
+        self.rules = list(rules)
+        self._group_rule: Dict[str, Tuple[str, str]] = {}
+        parts = []
+        for i, (name, pattern, repl) in enumerate(self.rules):
+            group = f"r{i}"
+            self._group_rule[group] = (name, repl)
+            parts.append(f"(?P<{group}>{pattern})")
+        self.pattern = re.compile("|".join(parts))
+
+    def redact(self, text: str, report: Optional[RedactionReport] = None, source: str = "text") -> str:
+        if not text:
+            return text
+        if report is None:
+            return self.pattern.sub(self._repl_silent, text)
+
+        def _repl(m: "re.Match[str]") -> str:
+            name, repl = self._group_rule[m.lastgroup]
+            report.add(source, name)
+            return repl
+
+        return self.pattern.sub(_repl, text)
+
+    def redact_lines(self,
+                     lines: Iterable[str],
+                     report: Optional[RedactionReport] = None,
+                     source: str = "text") -> Iterator[str]:
+        """Streaming variant: rules never span a newline, so lines are independent."""
+        for ln in lines:
+            yield self.redact(ln, report, source)
+
+    def _repl_silent(self, m: "re.Match[str]") -> str:
+        return self._group_rule[m.lastgroup][1]
+
+
+LABEL_LEAK_ENGINE = RedactionEngine(LABEL_LEAK_RULES)
+EVENT_MSG_ENGINE = RedactionEngine(EVENT_MSG_RULES)
+
+
+def redact_label_leaks(text: Any, report: Optional[RedactionReport] = None, source: str = "text") -> Any:
+    if not text:
+        return text
+    return LABEL_LEAK_ENGINE.redact(str(text), report, source)
+
+
+def redact_event_msg(msg: Any, report: Optional[RedactionReport] = None) -> str:
+    """Scenario/obs tokens of run markers, then keep only the first ':' groups of long markers."""
+    if msg is None:
+        return ""
+    s = str(msg)
+    if not EVENT_MSG_TRIGGER_RE.search(s):
+        return s
+    s = EVENT_MSG_ENGINE.redact(s, report, "event_msg")
+    parts = s.split(":")
+    if len(parts) >= EVENT_MSG_MIN_PARTS:
+        dropped = len(parts) - EVENT_MSG_KEEP_PARTS
+        s = ":".join(parts[:EVENT_MSG_KEEP_PARTS] + ["<redacted>"] * dropped)
+        if report is not None:
+            report.add("event_msg", "marker_tail", dropped)
+    return s
+
+
+def event_has_label_leak(ev: Any) -> bool:
+    if not isinstance(ev, dict):
+        return False
+    for k, v in ev.items():
+        if isinstance(k, str) and ("obs_" in k or k in LEAK_KEYS):
+            return True
+        if isinstance(v, str) and LEAK_PROBE_RE.search(v):
+            return True
+    return False
+
+
+def split_leaky_events(events: List[Dict[str, Any]],
+                       report: Optional[RedactionReport] = None) -> List[Dict[str, Any]]:
+    """Events safe for the prompt; dropped ones are counted as rule "leaky_event"."""
+    safe = [ev for ev in events if not event_has_label_leak(ev)]
+    if report is not None and len(safe) != len(events):
+        report.add("events", "leaky_event", len(events) - len(safe))
+    return safe
+
+
+def sanitize_meta(meta: Any, report: Optional[RedactionReport] = None) -> Dict[str, Any]:
+    if not isinstance(meta, dict):
+        return {}
+    out: Dict[str, Any] = {}
+    for k, v in meta.items():
+        if not isinstance(k, str):
+            continue
+        ks = k.strip()
+        if ks.startswith(META_DROP_PREFIX) or ks in META_DROP_KEYS:
+            if report is not None:
+                report.add("meta", "meta_drop_key")
+            continue
+        out[ks] = v
+    return out
+
+
+def redact_log_tail(lines: List[str],
+                    report: Optional[RedactionReport] = None,
+                    source: str = "log") -> Tuple[List[str], str]:
+    """
+    Redact a log tail once as a single buffer; returns (lines without newline, text).
+    Lines must still carry their line endings (as from readlines()).
+    """
+    text = LABEL_LEAK_ENGINE.redact("".join(lines), report, source)
+    if not text:
+        return [], text
+    out = text.split("\n")
+    if text.endswith("\n"):
+        out.pop()
+    return out, text
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+redaction_check.py
+- Property check: redaction.py must produce exactly what the per-pass helpers produced
+  (frozen copies below, taken from closed_loop_infer_run.py before the engine) on random
+  token soup and, optionally, on real run dirs (--run_dir, repeatable).
+- Micro-benchmark: legacy per-line passes vs one engine scan over the same log/event buffers.
+Usage:
+  python redaction_check.py [--cases 20000] [--seed 1] [--run_dir RUN ...] [--bench_lines 20000]
+Exit code 0 = identical output, 1 = mismatch (first few are printed).
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import redaction
+
+
+# ---------------- frozen reference implementation ----------------
+
+def legacy_sanitize_meta_for_llm(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Remove fields that can leak labels / scripted scenario info into LLM input.
+    Keep only operational metadata needed for context.
+    """
+    if not isinstance(meta, dict):
+        return {}
+
+    drop_keys = {
+        "scenario_tag",
+        "fault_type",
+        "family",
+        "severity",
+        "gt_family",
+        "gt_severity",
+        "gt_fault",
+        "gt_label",
+        "labels",
+        "scenario",
+        "obs_primary",
+        "obs_fault",
+    }
+
+    out: Dict[str, Any] = {}
+    for k, v in meta.items():
+        if not isinstance(k, str):
+            continue
+        ks = k.strip()
+        # drop anything starting with obs_ (obs_fault_state/obs_cpu_hotspot/obs_mem_pressure ...)
+        if ks.startswith("obs_"):
+            continue
+        if ks in drop_keys:
+            continue
+        out[ks] = v
+
+    return out
+
+def legacy_sanitize_event_msg_for_llm(msg: Any) -> str:
+    """
+    Remove label-leaking tokens from events (e.g. cli poke / run_end containing scenario tag).
+    Keep as much useful context as possible.
+    """
+    if msg is None:
+        return ""
+    s = str(msg)
+
+    # If it's a cli poke style line, it often embeds scenario_tag/fault_type twice
+    # Example: "run_end:...:cpu_busy_loop:cpu_busy_loop"
+    if "poke" in s or "run_end" in s or "run_begin" in s:
+        # redact common scenario-like tokens (cpu_*/mem_*/bg_*/net_*/background_*)
+        s = re.sub(r"\b(cpu|mem|bg|net|background)_[A-Za-z0-9_]+\b", "<redacted_scenario>", s)
+        # redact obs_* tokens if any
+        s = re.sub(r"\bobs_[A-Za-z0-9_]+\b", "<redacted_obs>", s)
+
+        # also redact " :xxx:xxx " tail patterns conservatively
+        # keep first two ':' groups, redact later groups
+        parts = s.split(":")
+        if len(parts) >= 6:
+            s = ":".join(parts[:4] + ["<redacted>"] * (len(parts) - 4))
+
+    return s
+
+def legacy_event_has_label_leak(ev: Any) -> bool:
+    if not isinstance(ev, dict):
+        return False
+    for k, v in ev.items():
+        if isinstance(k, str):
+            if "obs_" in k or k in ("scenario_tag", "fault_type"):
+                return True
+        if isinstance(v, str):
+            if "obs_" in v or "scenario_tag" in v or "fault_type" in v:
+                return True
+    return False
+
+def legacy_redact_label_leaks(text: str) -> str:
+    if not text:
+        return text
+    s = str(text)
+    s = re.sub(r"\bobs_[A-Za-z0-9_]+\b", "<redacted_obs>", s)
+    s = s.replace("scenario_tag", "<redacted_meta>")
+    s = s.replace("fault_type", "<redacted_meta>")
+    return s
+
+
+# ---------------- property check ----------------
+
+TOKENS = [
+    "obs_", "obs_fault_state", "obs_cpu_hotspot", "scenario_tag", "fault_type", "scenario_", "fault_",
+    "cpu_busy_loop", "mem_leak", "bg_io", "net_", "background_noise", "cpu", "mem", "xobs_a",
+    "poke", "run_end", "run_begin", "run_", ":", "::", "_", "-", " ", "\t", "\n", "=", "<", ">",
+    "a", "Z", "9", "é", "进程", "\u2028", "\x0c", "\r",
+]
+
+
+def random_text(rng: random.Random, max_tokens: int = 24) -> str:
+    return "".join(rng.choice(TOKENS) for _ in range(rng.randint(0, max_tokens)))
+
+
+def random_event(rng: random.Random) -> Dict[str, Any]:
+    ev: Dict[str, Any] = {"ts": rng.randint(0, 10), "msg": random_text(rng)}
+    for _ in range(rng.randint(0, 3)):
+        key = rng.choice(["tag", "component", "level", "obs_x", "scenario_tag", "fault_type", "note", "n"])
+        ev[key] = rng.choice([random_text(rng, 6), rng.randint(0, 9), None])
+    return ev
+
+
+def random_meta(rng: random.Random) -> Dict[Any, Any]:
+    keys = sorted(redaction.META_DROP_KEYS) + ["obs_a", " obs_b", "device_sn ", "run_start", "script_version", 3]
+    return {rng.choice(keys): random_text(rng, 4) for _ in range(rng.randint(0, 8))}
+
+
+def check_log_tail(lines_with_nl: List[str]) -> bool:
+    want_lines = [legacy_redact_label_leaks(ln.rstrip("\n")) for ln in lines_with_nl]
+    want_text = legacy_redact_label_leaks("".join(lines_with_nl))
+    got_lines, got_text = redaction.redact_log_tail(lines_with_nl, redaction.RedactionReport())
+    return got_lines == want_lines and got_text == want_text
+
+
+def run_property_check(cases: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    failures: List[str] = []
+    for i in range(cases):
+        text = random_text(rng)
+        ev = random_event(rng)
+        meta = random_meta(rng)
+        checks = [
+            ("redact_label_leaks", redaction.redact_label_leaks(text, redaction.RedactionReport()), legacy_redact_label_leaks(text)),
+            ("redact_event_msg", redaction.redact_event_msg(text, redaction.RedactionReport()), legacy_sanitize_event_msg_for_llm(text)),
+            ("event_has_label_leak", redaction.event_has_label_leak(ev), legacy_event_has_label_leak(ev)),
+            ("sanitize_meta", redaction.sanitize_meta(meta, redaction.RedactionReport()), legacy_sanitize_meta_for_llm(meta)),
+        ]
+        for name, got, want in checks:
+            if got != want:
+                failures.append(f"case={i} {name}: input={text!r} got={got!r} want={want!r}")
+        # readlines() shape: "\n" only as the terminator, last line may lack it
+        lines = [random_text(rng, 8).replace("\n", "") + "\n" for _ in range(rng.randint(0, 4))]
+        last = random_text(rng, 8).replace("\n", "")
+        if last and rng.random() < 0.5:
+            lines.append(last)
+        if not check_log_tail(lines):
+            failures.append(f"case={i} redact_log_tail: lines={lines!r}")
+        if len(failures) >= 10:
+            break
+    for edge in (None, "", 0, 12, "obs_", "obs_a", "fault_typeobs_x", "obs_fault_type", "a:b:c:d:e:run_end"):
+        if redaction.redact_label_leaks(edge) != legacy_redact_label_leaks(edge):
+            failures.append(f"edge redact_label_leaks {edge!r}")
+        if redaction.redact_event_msg(edge) != legacy_sanitize_event_msg_for_llm(edge):
+            failures.append(f"edge redact_event_msg {edge!r}")
+    return failures
+
+
+def run_dir_check(run_dir: Path) -> List[str]:
+    failures: List[str] = []
+    for name in ("dmesg_after.utf8.log", "hilog_text_full.log"):
+        p = run_dir / name
+        if p.exists():
+            with p.open("r", encoding="utf-8", errors="ignore") as f:
+                if not check_log_tail(f.readlines()):
+                    failures.append(f"{p}: log tail mismatch")
+    for p in sorted((run_dir / "events").glob("events_*.jsonl")):
+        for n, line in enumerate(p.read_text(encoding="utf-8", errors="ignore").splitlines()):
+            try:
+                ev = json.loads(line)
+            except Exception:
+                continue
+            if redaction.redact_event_msg(ev.get("msg")) != legacy_sanitize_event_msg_for_llm(ev.get("msg")):
+                failures.append(f"{p}:{n + 1}: event msg mismatch")
+            if redaction.event_has_label_leak(ev) != legacy_event_has_label_leak(ev):
+                failures.append(f"{p}:{n + 1}: leak flag mismatch")
+    meta_path = run_dir / "_run_meta.json"
+    if meta_path.exists():
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        if redaction.sanitize_meta(meta) != legacy_sanitize_meta_for_llm(meta):
+            failures.append(f"{meta_path}: meta mismatch")
+    return failures
+
+
+# ---------------- micro-benchmark ----------------
+
+def bench(n_lines: int, seed: int, repeat: int = 5) -> None:
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(n_lines):
+        base = "[%8.3f] kernel: worker %d rss=%dkB" % (rng.random() * 1e4, rng.randint(1, 9999), rng.randint(1, 10 ** 6))
+        if rng.random() < 0.05:
+            base += " " + rng.choice(["obs_mem_pressure=1", "scenario_tag=cpu_busy_loop", "fault_type=mem"])
+        lines.append(base + "\n")
+    events = [random_event(rng) for _ in range(n_lines // 10)]
+
+    def legacy_pass() -> None:
+        # old flow: per-line redaction for the prompt, then the whole tail again for prompt_material
+        [legacy_redact_label_leaks(ln.rstrip("\n")) for ln in lines]
+        legacy_redact_label_leaks("".join(lines))
+        [legacy_sanitize_event_msg_for_llm(ev.get("msg")) for ev in events]
+        [ev for ev in events if not legacy_event_has_label_leak(ev)]
+
+    def engine_pass() -> None:
+        report = redaction.RedactionReport()
+        redaction.redact_log_tail(lines, report, "dmesg")
+        [redaction.redact_event_msg(ev.get("msg"), report) for ev in events]
+        redaction.split_leaky_events(events, report)
+
+    for name, fn in (("legacy", legacy_pass), ("engine", engine_pass)):
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - t0)
+        print(f"[bench] {name}: lines={n_lines} events={len(events)} best_of_{repeat}={best * 1000.0:.2f} ms")
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--cases", type=int, default=20000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--run_dir", action="append", default=[])
+    ap.add_argument("--bench_lines", type=int, default=20000)
+    args = ap.parse_args()
+
+    failures = run_property_check(args.cases, args.seed)
+    for rd in args.run_dir:
+        failures.extend(run_dir_check(Path(rd)))
+    if failures:
+        for f in failures[:10]:
+            print("[mismatch] " + f)
+        print(f"[check] FAIL mismatches={len(failures)}")
+        return 1
+    print(f"[check] OK cases={args.cases} run_dirs={len(args.run_dir)}")
+    if args.bench_lines > 0:
+        bench(args.bench_lines, args.seed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+Content-addressed store for run files: <store>/<sha256[:2]>/<sha256>.
+ingest_bundle.py hard-links every stable run file to its blob, so identical daily
+metrics/events files, binaries and log prefixes of several runs share one inode.
+The link count is the reference count: a blob whose only link is the store itself
+(st_nlink == 1) belongs to no run anymore and is removed by `gc`.
+Blobs are read-only (0444); writers must replace run files (tmp + os.replace), never
+rewrite them in place.
+Usage:
+  python blob_store.py report --out_root /home/xrh/qwen3_os_fault/storage/runs
+  python blob_store.py gc --store <blob_dir> [--min_age_sec 600] [--dry_run]
+"""
+
+import argparse
+import errno
+import hashlib
+import json
+import os
+import stat
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+BLOB_DIR_ENV = "WK_BLOB_DIR"
+# rewritten after extraction (patch_run_meta) or consumed by the ingest; never shared
+BLOB_EXCLUDE_NAMES = frozenset((
+    "_run_meta.json",
+    "bundle_manifest.json",
+    "manifest.json",
+    "delta_manifest.json",
+))
+# smaller files cost more in inode/dirent churn than they save
+BLOB_MIN_BYTES = 4096
+BLOB_MODE = 0o444
+BLOB_GC_MIN_AGE_SEC = 600
+
+
+def blob_root(out_root: Path) -> Path:
+    env = os.environ.get(BLOB_DIR_ENV, "").strip()
+    if env:
+        return Path(env).expanduser()
+    return out_root.parent / "blobs"
+
+
+def blob_path(store: Path, digest: str) -> Path:
+    return store / digest[:2] / digest
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def iter_store(store: Path) -> Iterator[Tuple[Path, os.stat_result]]:
+    if not store.is_dir():
+        return
+    for sub in sorted(store.iterdir()):
+        if not sub.is_dir() or len(sub.name) != 2:
+            continue
+        for p in sub.iterdir():
+            try:
+                yield p, p.lstat()
+            except OSError:
+                continue
+
+
+def _link_replace(blob: Path, path: Path) -> None:
+    tmp = path.with_name(path.name + ".blob.tmp")
+    try:
+        tmp.unlink()
+    except FileNotFoundError:
+        pass
+    os.link(blob, tmp)
+    os.replace(tmp, path)
+
+
+def link_file(path: Path, store: Path) -> Tuple[str, int]:
+    """
+    Replace `path` by a hard link to its blob. Returns (outcome, bytes saved):
+    ("linked", size) when the blob already existed, ("stored", 0) when this file became it.
+    """
+    st = path.lstat()
+    digest = file_sha256(path)
+    blob = blob_path(store, digest)
+    for _ in range(2):
+        try:
+            bst = blob.lstat()
+        except FileNotFoundError:
+            bst = None
+        if bst is not None:
+            if bst.st_ino == st.st_ino and bst.st_dev == st.st_dev:
+                return "linked", 0
+            if bst.st_size != st.st_size:
+                raise ValueError(f"blob size mismatch: {blob}")
+            try:
+                _link_replace(blob, path)
+            except FileNotFoundError:
+                continue  # collected by gc in between: store this copy instead
+            return "linked", st.st_size
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(path, BLOB_MODE)
+        try:
+            os.link(path, blob)
+        except FileExistsError:
+            continue  # a concurrent ingest stored the same content first
+        return "stored", 0
+    raise RuntimeError(f"blob store race on {blob}")
+
+
+def dedupe_tree(tree: Path, store: Path, min_bytes: int = BLOB_MIN_BYTES) -> Dict[str, int]:
+    """Hard-link every regular file of `tree` (except BLOB_EXCLUDE_NAMES) into `store`."""
+    stats = {"files": 0, "linked": 0, "stored": 0, "bytes_saved": 0}
+    for dirpath, _, filenames in os.walk(tree):
+        for fn in sorted(filenames):
+            if fn in BLOB_EXCLUDE_NAMES:
+                continue
+            p = Path(dirpath) / fn
+            try:
+                st = p.lstat()
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or st.st_size < min_bytes:
+                continue
+            stats["files"] += 1
+            try:
+                outcome, saved = link_file(p, store)
+            except OSError as exc:
+                if exc.errno == errno.EXDEV:
+                    # store on another filesystem: hard links impossible, keep plain copies
+                    return stats
+                continue
+            except Exception:
+                continue
+            stats[outcome] += 1
+            stats["bytes_saved"] += saved
+    return stats
+
+
+def store_report(store: Path) -> Dict[str, Any]:
+    """
+    physical_bytes: blob sizes; logical_bytes: what the runs would take without sharing
+    (size * run links); bytes_saved = logical - physical of referenced blobs.
+    """
+    blobs = orphans = 0
+    physical = logical = orphan_bytes = 0
+    for _, st in iter_store(store):
+        blobs += 1
+        refs = st.st_nlink - 1
+        if refs <= 0:
+            orphans += 1
+            orphan_bytes += st.st_size
+            continue
+        physical += st.st_size
+        logical += st.st_size * refs
+    return {
+        "store": str(store),
+        "blobs": blobs,
+        "referenced_blobs": blobs - orphans,
+        "physical_bytes": physical,
+        "logical_bytes": logical,
+        "bytes_saved": logical - physical,
+        "orphan_blobs": orphans,
+        "orphan_bytes": orphan_bytes,
+    }
+
+
+def gc_store(store: Path, min_age_sec: float = BLOB_GC_MIN_AGE_SEC, dry_run: bool = False) -> Dict[str, int]:
+    """Remove blobs no run links to anymore (st_nlink == 1)."""
+    cutoff = time.time() - min_age_sec
+    removed = freed = 0
+    for p, st in iter_store(store):
+        # ctime moves on every link/unlink: recently touched blobs may be mid-ingest
+        if st.st_nlink > 1 or st.st_ctime > cutoff:
+            continue
+        if not dry_run:
+            try:
+                p.unlink()
+            except OSError:
+                continue
+        removed += 1
+        freed += st.st_size
+    return {"removed": removed, "freed_bytes": freed}
+
+
+def parse_args() -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("cmd", choices=["report", "gc"])
+    ap.add_argument("--store", default="", help=f"blob dir (default: ${BLOB_DIR_ENV} or <out_root>/../blobs)")
+    ap.add_argument("--out_root", default="server_B/storage/runs", help="runs root (to locate the store)")
+    ap.add_argument("--min_age_sec", type=float, default=BLOB_GC_MIN_AGE_SEC)
+    ap.add_argument("--dry_run", action="store_true")
+    return ap.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    store: Optional[Path] = Path(args.store).expanduser() if args.store else None
+    if store is None:
+        store = blob_root(Path(args.out_root).expanduser().resolve())
+    if args.cmd == "gc":
+        res: Dict[str, Any] = gc_store(store, args.min_age_sec, args.dry_run)
+        res["dry_run"] = bool(args.dry_run)
+    else:
+        res = store_report(store)
+    print(json.dumps(res, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
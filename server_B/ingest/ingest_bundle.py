@@ -1,12 +1,81 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import json
+import os
+import re
 import tarfile
 import tempfile
 import shutil
+import sys
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional
+
+from blob_store import blob_root, dedupe_tree
+
+# the streaming zstd reader + dictionary loading are shared with the ingest server
+_TCP_DIR = Path(__file__).resolve().parents[1] / "tcp"
+if str(_TCP_DIR) not in sys.path:
+    sys.path.insert(0, str(_TCP_DIR))
+from tar_stream_index import zstd_stream_reader
+
+# written by tcp_ingest_server next to the upload (see server_B/tcp/tar_stream_index.py)
+INDEX_SUFFIX = ".index.json"
+INDEX_SCHEMA = 1
+REQUIRED_MEMBERS = [
+    ("metrics", "sys_", ".csv"),
+    ("events", "events_", ".jsonl"),
+    ("procs", "procs_", ".txt"),
+]
+# ENC=zstd uploads; dictionaries come from $WK_ZSTD_DICT_DIR (tar_stream_index.load_zstd_dicts)
+ZSTD_SUFFIXES = (".tar.zst", ".tzst")
+# delta bundles: append-only daily files sent as <path>.delta (bytes after base_len) and rebuilt
+# from the last ingested copy in <delta_base>/<device_id>/<name> (see tcp_ingest_server.py)
+DELTA_MANIFEST = "delta_manifest.json"
+DELTA_SUFFIX = ".delta"
+# <bundle>.delta_base/: the bases the upload was verified against, pinned by tcp_ingest_server.py
+DELTA_PIN_SUFFIX = ".delta_base"
+DELTA_TAIL_BYTES = 4096
+DELTA_BASE_DIR_ENV = "WK_DELTA_BASE_DIR"
+DELTA_BASE_KEEP_DAYS = 3
+SAFE_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+# bundles are unpacked into <out_root>/.staging_* (same filesystem, hidden from run scans) and
+# renamed into place once complete; leftovers of killed ingests are removed after this long
+STAGING_PREFIX = ".staging_"
+STAGING_STALE_SEC = 3600
+
+
+class IngestError(Exception):
+    """Base of the bundle ingest failures; each also subclasses the builtin it used to be."""
+
+
+class BundleNotFound(IngestError, FileNotFoundError):
+    pass
+
+
+class MissingRequiredFiles(IngestError, FileNotFoundError):
+    pass
+
+
+class UnsafeBundle(IngestError, ValueError):
+    """Path traversal / absolute member names, or no usable run_id."""
+
+
+class RunDirExists(IngestError, FileExistsError):
+    pass
+
+
+@dataclass
+class IngestResult:
+    run_id: str
+    run_dir: Path
+    bundle: Path
+    indexed: bool = False
+    deltas_rebuilt: int = 0
+    blobs: Dict[str, int] = field(default_factory=dict)
 
 
 def safe_int(val: Any) -> Optional[int]:
@@ -24,17 +93,266 @@ def safe_int(val: Any) -> Optional[int]:
     return None
 
 
+def check_member_name(name: str) -> None:
+    if name.startswith("/"):
+        raise UnsafeBundle(f"unsafe path in tar: {name}")
+    parts = Path(name).parts
+    if any(part == ".." for part in parts):
+        raise UnsafeBundle(f"unsafe path in tar: {name}")
+
+
 def safe_extract(tar: tarfile.TarFile, dest: Path) -> None:
     for member in tar.getmembers():
-        name = member.name
-        if name.startswith("/"):
-            raise ValueError(f"unsafe path in tar: {name}")
-        parts = Path(name).parts
-        if any(part == ".." for part in parts):
-            raise ValueError(f"unsafe path in tar: {name}")
+        check_member_name(member.name)
     tar.extractall(dest)
 
 
+def load_member_index(bundle_path: Path) -> Optional[Dict[str, Any]]:
+    """Member index from the ingest server, if present and still describing this exact file."""
+    path = Path(str(bundle_path) + INDEX_SUFFIX)
+    if not path.exists():
+        return None
+    try:
+        index = json.loads(path.read_text(encoding="utf-8"))
+        st = bundle_path.stat()
+    except Exception:
+        return None
+    if not isinstance(index, dict) or index.get("schema") != INDEX_SCHEMA:
+        return None
+    if index.get("compressed_size") != st.st_size:
+        return None
+    if index.get("file_mtime_ns") not in (None, st.st_mtime_ns):
+        return None
+    if not isinstance(index.get("members"), list):
+        return None
+    return index
+
+
+def missing_required_members(names: List[str]) -> List[str]:
+    """ensure_required() evaluated on member names, relative to the root find_root_dir() would pick."""
+    norm = [n[2:] if n.startswith("./") else n for n in names]
+    # a .delta member becomes the full file before ensure_required() runs
+    norm = [n[:-len(DELTA_SUFFIX)] if n.endswith(DELTA_SUFFIX) else n for n in norm]
+    norm = [n.strip("/") for n in norm if n.strip("/") and n.strip("/") != "."]
+    tops = {n.split("/", 1)[0] for n in norm} - {"__MACOSX"}
+    prefix = ""
+    if len(tops) == 1:
+        top = next(iter(tops))
+        if any(n.startswith(top + "/") for n in norm):
+            prefix = top + "/"
+    rel = [n[len(prefix):] for n in norm if n.startswith(prefix)]
+    missing = []
+    for sub, head, tail in REQUIRED_MEMBERS:
+        ok = False
+        for n in rel:
+            parts = n.split("/")
+            if len(parts) == 2 and parts[0] == sub and parts[1].startswith(head) and parts[1].endswith(tail):
+                ok = True
+                break
+        if not ok:
+            missing.append(f"{sub}/{head}*{tail}")
+    return missing
+
+
+def is_zstd_bundle(bundle_path: Path) -> bool:
+    return bundle_path.name.endswith(ZSTD_SUFFIXES)
+
+
+def extract_stream(bundle_path: Path, dest: Path) -> None:
+    """One sequential pass (tarfile "r|"); names are checked member by member before extraction."""
+    with bundle_path.open("rb") as f:
+        fileobj = zstd_stream_reader(f) if is_zstd_bundle(bundle_path) else f
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                check_member_name(member.name)
+                tar.extract(member, dest)
+
+
+def extract_indexed(bundle_path: Path, dest: Path, index: Dict[str, Any]) -> None:
+    """
+    One sequential stream pass (r|*), like extract_stream, but every member must match the
+    index entry at the same position (name and size), and there must be no extra or missing
+    members. The up-front name/required checks in ingest_bundle() ran on the index, so this
+    makes sure they describe what is actually extracted.
+    """
+    expected = index["members"]
+    seen = 0
+    with bundle_path.open("rb") as f:
+        fileobj = zstd_stream_reader(f) if is_zstd_bundle(bundle_path) else f
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                check_member_name(member.name)
+                want = expected[seen] if seen < len(expected) else {}
+                if (member.name.rstrip("/") != str(want.get("name") or "").rstrip("/")
+                        or member.size != want.get("size")):
+                    raise UnsafeBundle(f"bundle does not match its member index at #{seen}: {member.name}")
+                tar.extract(member, dest)
+                seen += 1
+    if seen != len(expected):
+        raise UnsafeBundle(f"bundle has {seen} members, its index lists {len(expected)}")
+
+
+class DeltaBaseMismatch(IngestError, ValueError):
+    pass
+
+
+def delta_base_root(out_root: Path) -> Path:
+    """$WK_DELTA_BASE_DIR, else storage/delta_base next to the runs root (and the tcp inbox)."""
+    env = os.environ.get(DELTA_BASE_DIR_ENV, "").strip()
+    return Path(env) if env else out_root.parent / "delta_base"
+
+
+def tail_sha256(path: Path, length: int) -> Optional[str]:
+    try:
+        with path.open("rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < length:
+                return None
+            start = max(0, length - DELTA_TAIL_BYTES)
+            f.seek(start)
+            return hashlib.sha256(f.read(length - start)).hexdigest()
+    except OSError:
+        return None
+
+
+def load_delta_manifest(root_dir: Path) -> Optional[Dict[str, Any]]:
+    path = root_dir / DELTA_MANIFEST
+    if not path.exists():
+        return None
+    try:
+        manifest = json.loads(path.read_text(encoding="utf-8"))
+    except Exception as exc:
+        raise DeltaBaseMismatch(f"bad {DELTA_MANIFEST}: {exc}")
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("files"), list):
+        raise DeltaBaseMismatch(f"bad {DELTA_MANIFEST}")
+    device_id = str(manifest.get("device_id") or "")
+    if not SAFE_NAME_RE.match(device_id):
+        raise DeltaBaseMismatch(f"bad device_id in {DELTA_MANIFEST}")
+    for entry in manifest["files"]:
+        rel = str(entry.get("path") or "") if isinstance(entry, dict) else ""
+        check_member_name(rel)
+        if not rel or not SAFE_NAME_RE.match(Path(rel).name):
+            raise DeltaBaseMismatch(f"bad path in {DELTA_MANIFEST}: {rel}")
+    return manifest
+
+
+def apply_deltas(root_dir: Path, base_dir: Path, manifest: Dict[str, Any]) -> int:
+    """Rebuild every mode=delta file as base[:base_len] + <path>.delta; verified by length + sha256."""
+    rebuilt = 0
+    for entry in manifest["files"]:
+        if entry.get("mode") != "delta":
+            continue
+        rel = str(entry["path"])
+        target = root_dir / rel
+        delta = Path(str(target) + DELTA_SUFFIX)
+        base = base_dir / Path(rel).name
+        base_len = entry.get("base_len")
+        if not isinstance(base_len, int) or base_len <= 0 or not delta.is_file():
+            raise DeltaBaseMismatch(f"bad delta entry: {rel}")
+        if tail_sha256(base, base_len) != entry.get("base_tail_sha256"):
+            raise DeltaBaseMismatch(f"delta base mismatch: {rel}")
+        h = hashlib.sha256()
+        tmp = Path(str(target) + ".rebuild")
+        with base.open("rb") as src, tmp.open("wb") as dst:
+            left = base_len
+            while left > 0:
+                chunk = src.read(min(1 << 20, left))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                h.update(chunk)
+                left -= len(chunk)
+            with delta.open("rb") as d:
+                for chunk in iter(lambda: d.read(1 << 20), b""):
+                    dst.write(chunk)
+                    h.update(chunk)
+        size = tmp.stat().st_size
+        if size != entry.get("len") or h.hexdigest() != entry.get("sha256"):
+            tmp.unlink()
+            raise DeltaBaseMismatch(f"delta rebuild mismatch: {rel}")
+        os.replace(tmp, target)
+        delta.unlink()
+        rebuilt += 1
+    return rebuilt
+
+
+def is_older_copy(src: Path, base: Path) -> bool:
+    """True when src is a shorter prefix of the current base (an older bundle ingested late)."""
+    try:
+        src_len, base_len = src.stat().st_size, base.stat().st_size
+    except OSError:
+        return False
+    return src_len < base_len and tail_sha256(base, src_len) == tail_sha256(src, src_len)
+
+
+def delta_pin_dir(bundle_path: Path) -> Path:
+    return Path(str(bundle_path) + DELTA_PIN_SUFFIX)
+
+
+def remove_delta_pin(bundle_path: Path) -> None:
+    shutil.rmtree(delta_pin_dir(bundle_path), ignore_errors=True)
+
+
+def update_delta_bases(run_dir: Path, base_dir: Path, manifest: Dict[str, Any]) -> None:
+    """
+    Keep the full files of this run as the bases the next delta bundle is checked against.
+    A base is never rolled back to an older, shorter copy of the same file: coalescing can
+    ingest an older bundle after a newer one.
+    """
+    base_dir.mkdir(parents=True, exist_ok=True)
+    for entry in manifest["files"]:
+        src = run_dir / str(entry["path"])
+        if not src.is_file():
+            continue
+        dst = base_dir / src.name
+        if is_older_copy(src, dst):
+            continue
+        tmp = Path(str(dst) + ".tmp")
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    # yesterday's files stop growing; drop old bases
+    cutoff = time.time() - DELTA_BASE_KEEP_DAYS * 86400
+    for p in base_dir.iterdir():
+        try:
+            if p.is_file() and p.stat().st_mtime < cutoff:
+                p.unlink()
+        except OSError:
+            continue
+
+
+def make_staging_dir(out_root: Path) -> Path:
+    staging = Path(tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=str(out_root)))
+    # mkdtemp is 0700; the staging dir itself becomes the run dir for flat bundles
+    os.chmod(staging, 0o755)
+    return staging
+
+
+def sweep_staging(out_root: Path, max_age_sec: float = STAGING_STALE_SEC) -> int:
+    cutoff = time.time() - max_age_sec
+    removed = 0
+    for p in out_root.glob(STAGING_PREFIX + "*"):
+        try:
+            if p.is_dir() and p.stat().st_mtime < cutoff:
+                shutil.rmtree(p, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+def publish_run_dir(src: Path, run_dir: Path) -> None:
+    """Atomic rename of a complete, validated tree into out_root/run_id."""
+    if run_dir.exists():
+        raise RunDirExists(f"run_dir exists: {run_dir}")
+    try:
+        os.rename(src, run_dir)
+    except OSError as exc:
+        # lost a race with another ingest of the same run: rename onto a non-empty dir fails
+        if run_dir.exists():
+            raise RunDirExists(f"run_dir exists: {run_dir}") from exc
+        raise
+
+
 def find_root_dir(extract_dir: Path) -> Path:
     entries = [p for p in extract_dir.iterdir() if p.name not in ("__MACOSX",)]
     if len(entries) == 1 and entries[0].is_dir():
@@ -68,7 +386,7 @@ def ensure_required(run_dir: Path) -> None:
         missing.append("procs/procs_*.txt")
 
     if missing:
-        raise FileNotFoundError("missing required files: " + ", ".join(missing))
+        raise MissingRequiredFiles("missing required files: " + ", ".join(missing))
 
 
 def patch_run_meta(meta_path: Path, run_dir: Path, run_id: str, manifest: dict) -> None:
@@ -115,27 +433,80 @@ def patch_run_meta(meta_path: Path, run_dir: Path, run_id: str, manifest: dict)
 
 def parse_args() -> argparse.Namespace:
     ap = argparse.ArgumentParser()
-    ap.add_argument("--bundle", required=True, help="path to bundle_*.tar.gz")
+    ap.add_argument("--bundle", required=True, help="path to bundle_*.tar.gz (or .tar.zst)")
     ap.add_argument("--out_root", default="server_B/storage/runs", help="output root for runs")
+    ap.add_argument("--no_dedupe", action="store_true", help="keep plain copies instead of blob store hard links")
+    ap.add_argument("--device_id", default=None,
+                    help="device of the delta bases (default: the bundle's inbox dir name)")
     return ap.parse_args()
 
 
-def main() -> None:
-    args = parse_args()
-    bundle_path = Path(args.bundle).expanduser().resolve()
-    out_root = Path(args.out_root).expanduser().resolve()
+def ingest_bundle(bundle: Path, out_root: Path, dedupe: bool = True,
+                  device_id: Optional[str] = None) -> IngestResult:
+    """
+    bundle_*.tar.gz / .tar.zst -> out_root/<run_id>, validated and published atomically.
+    device_id selects the delta bases; by default it is the inbox dir the bundle sits in
+    (tcp_inbox/<device_id>/), never the board-supplied delta_manifest.json.
+    Raises IngestError subclasses (RunDirExists, MissingRequiredFiles, UnsafeBundle,
+    DeltaBaseMismatch, BundleNotFound); other errors are I/O or decompression failures.
+    """
+    bundle_path = Path(bundle).expanduser().resolve()
+    out_root = Path(out_root).expanduser().resolve()
     out_root.mkdir(parents=True, exist_ok=True)
 
     if not bundle_path.exists():
-        raise FileNotFoundError(f"bundle not found: {bundle_path}")
-
-    with tempfile.TemporaryDirectory() as td:
-        extract_dir = Path(td)
-        with tarfile.open(bundle_path, "r:*") as tar:
-            safe_extract(tar, extract_dir)
+        raise BundleNotFound(f"bundle not found: {bundle_path}")
+
+    index = load_member_index(bundle_path)
+    if index is not None:
+        names = [str(m.get("name") or "") for m in index["members"]]
+        for name in names:
+            check_member_name(name)
+        # fail before decompressing anything when the bundle cannot pass ensure_required()
+        missing = missing_required_members(names)
+        if missing:
+            raise MissingRequiredFiles("missing required files: " + ", ".join(missing))
+
+    deltas_rebuilt = 0
+    blobs: Dict[str, int] = {}
+    sweep_staging(out_root)
+    staging = make_staging_dir(out_root)
+    try:
+        extract_dir = staging
+        if index is not None:
+            extract_indexed(bundle_path, extract_dir, index)
+        elif is_zstd_bundle(bundle_path):
+            # tarfile cannot seek in zstd; a bad name aborts the (staged) extraction
+            extract_stream(bundle_path, extract_dir)
+        else:
+            with tarfile.open(bundle_path, "r:*") as tar:
+                safe_extract(tar, extract_dir)
 
         root_dir = find_root_dir(extract_dir)
         manifest = load_manifest(root_dir)
+        delta_manifest = load_delta_manifest(root_dir)
+        base_dir: Optional[Path] = None
+        if delta_manifest is not None:
+            device = device_id or bundle_path.parent.name
+            if not SAFE_NAME_RE.match(device) or delta_manifest["device_id"] != device:
+                raise DeltaBaseMismatch(
+                    f"delta_manifest device_id {delta_manifest['device_id']} does not match device {device}")
+            base_dir = delta_base_root(out_root) / device
+            # rebuild against the copies pinned when the upload was acknowledged: the live
+            # bases may have moved on since (a reset daily file, another bundle ingested first)
+            pinned = delta_pin_dir(bundle_path)
+            try:
+                deltas_rebuilt = apply_deltas(root_dir, pinned if pinned.is_dir() else base_dir, delta_manifest)
+            except DeltaBaseMismatch:
+                if pinned.is_dir():
+                    raise  # the bundle itself is inconsistent; the live bases are fine
+                # stop offering these bases: the board's next query finds none and sends full files
+                for entry in delta_manifest["files"]:
+                    try:
+                        (base_dir / Path(str(entry["path"])).name).unlink()
+                    except OSError:
+                        pass
+                raise
 
         run_id = manifest.get("run_id")
         if not run_id:
@@ -144,20 +515,52 @@ def main() -> None:
             else:
                 name = bundle_path.name
                 run_id = name.replace("bundle_", "").replace(".tar.gz", "").replace(".tgz", "")
+                run_id = run_id.replace(".tar.zst", "").replace(".tzst", "")
 
         if not run_id:
-            raise ValueError("unable to determine run_id")
+            raise UnsafeBundle("unable to determine run_id")
 
         run_dir = out_root / run_id
         if run_dir.exists():
-            raise FileExistsError(f"run_dir exists: {run_dir}")
+            raise RunDirExists(f"run_dir exists: {run_dir}")
+
+        # validate and patch in staging: out_root/run_id only ever appears complete
+        ensure_required(root_dir)
+        patch_run_meta(root_dir / "_run_meta.json", run_dir, run_id, manifest)
+        if dedupe:
+            try:
+                blobs = dedupe_tree(root_dir, blob_root(out_root))
+                print(f"[ingest] blobs files={blobs['files']} linked={blobs['linked']} "
+                      f"stored={blobs['stored']} bytes_saved={blobs['bytes_saved']}", file=sys.stderr)
+            except Exception as exc:
+                print(f"[ingest] blob dedupe skipped: {exc}", file=sys.stderr)
+        publish_run_dir(root_dir, run_dir)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    if delta_manifest is not None and base_dir is not None:
+        try:
+            update_delta_bases(run_dir, base_dir, delta_manifest)
+        except Exception:
+            pass  # the next bundle is then sent in full
+    remove_delta_pin(bundle_path)
 
-        shutil.copytree(root_dir, run_dir)
-        ensure_required(run_dir)
-        patch_run_meta(run_dir / "_run_meta.json", run_dir, run_id, manifest)
+    return IngestResult(
+        run_id=str(run_id),
+        run_dir=run_dir,
+        bundle=bundle_path,
+        indexed=index is not None,
+        deltas_rebuilt=deltas_rebuilt,
+        blobs=blobs,
+    )
 
-    print(str(run_dir))
+
+def main() -> None:
+    args = parse_args()
+    result = ingest_bundle(Path(args.bundle), Path(args.out_root), dedupe=not args.no_dedupe,
+                           device_id=args.device_id)
+    print(str(result.run_dir))
 
 
 if __name__ == "__main__":
-    main()
+    main()
@@ -1,12 +1,45 @@
 #!/usr/bin/env python3
 
+"""
+Bundle -> run dir -> inference -> actions_device.txt, in one process.
+The stages are plain functions (ingest / extract_features / infer / export_actions,
+chained by run_pipeline) returning dataclasses and raising typed errors, so the
+watcher calls them directly: no interpreter start, re-import or model load per bundle,
+and no scraping of run_dir= from stdout. main() is the thin CLI kept for manual runs.
+"""
+
 import argparse
 import json
-import os
-import subprocess
 import sys
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Sequence
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+for _p in (REPO_ROOT, REPO_ROOT / "server_B" / "ingest"):
+    if str(_p) not in sys.path:
+        sys.path.insert(0, str(_p))
+
+from closed_loop_infer_run import (InferOptions, InferResult, RunContext, load_coalesced_context, load_run_context,
+                                   run_inference)
+from ingest_bundle import IngestResult, ingest_bundle
+from stage_deadline import parse_budgets, run_with_deadline
+
+
+class InferFailed(RuntimeError):
+    """run_inference() itself crashed (model errors are already turned into fallback outputs)."""
+
+
+@dataclass
+class PipelineResult:
+    run_dir: Path
+    out_dir: Path
+    actions_device: Path
+    actions_count: int
+    infer: InferResult
+    ingest: Optional[IngestResult] = None
+    timings_ms: Dict[str, float] = field(default_factory=dict)
 
 
 def parse_args() -> argparse.Namespace:
@@ -14,32 +47,33 @@ def parse_args() -> argparse.Namespace:
     ap.add_argument("--bundle", help="path to bundle_*.tar.gz")
     ap.add_argument("--run_dir", help="path to run directory")
     ap.add_argument("--out_root", default="server_B/storage/runs")
+    ap.add_argument("--degrade_level", type=int, default=None, help="overload ladder rung (load_ladder.LEVELS)")
+    ap.add_argument("--queue_wait_sec", type=float, default=None)
+    ap.add_argument("--deadlines", type=parse_budgets, default=None, help="per-stage budgets, e.g. stage1=300,stage2=180")
     return ap.parse_args()
 
 
-def run_ingest(bundle: Path, out_root: Path) -> Path:
-    script = Path(__file__).resolve().parents[1] / "ingest" / "ingest_bundle.py"
-    cmd = [sys.executable, str(script), "--bundle", str(bundle), "--out_root", str(out_root)]
-    result = subprocess.check_output(cmd, text=True).strip().splitlines()
-    if not result:
-        raise RuntimeError("ingest_bundle.py returned empty output")
-    return Path(result[-1]).resolve()
+def ingest(bundle: Path, out_root: Path) -> IngestResult:
+    return ingest_bundle(bundle, out_root)
 
 
-def run_infer(run_dir: Path) -> Path:
-    out_dir = run_dir / "_server_out"
-    out_dir.mkdir(parents=True, exist_ok=True)
+def extract_features(run_dir: Path, member_dirs: Sequence[Path] = ()) -> RunContext:
+    """
+    Parse the run inputs (feature cache aware); pass the result on to infer().
+    member_dirs: older runs of the same device coalesced into this one (union window, no cache).
+    """
+    if member_dirs:
+        return load_coalesced_context(run_dir, member_dirs)
+    return load_run_context(run_dir)
 
-    env = os.environ.copy()
-    if not env.get("WK_QWEN3_ENABLE_STAGE2"):
-        env["WK_QWEN3_ENABLE_STAGE2"] = "0"
 
-    script = Path("/home/xrh/qwen3_os_fault/closed_loop_infer_run.py")
-    cmd = [sys.executable, str(script), "--run_dir", str(run_dir), "--out_dir", str(out_dir)]
-    rc = subprocess.call(cmd, env=env)
-    if rc != 0:
-        raise RuntimeError(f"closed_loop_infer_run.py failed rc={rc}")
-    return out_dir
+def infer(run_dir: Path, ctx: Optional[RunContext] = None, opts: Optional[InferOptions] = None) -> InferResult:
+    out_dir = run_dir / "_server_out"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        return run_inference(run_dir, out_dir, opts, run_ctx=ctx)
+    except Exception as exc:
+        raise InferFailed(f"closed_loop_infer_run failed: {exc}") from exc
 
 
 def write_actions_device(actions_json: Path, out_path: Path) -> int:
@@ -59,26 +93,68 @@ def write_actions_device(actions_json: Path, out_path: Path) -> int:
     return len(lines)
 
 
+def export_actions(out_dir: Path) -> int:
+    return write_actions_device(out_dir / "actions.json", out_dir / "actions_device.txt")
+
+
+def run_pipeline(bundle: Optional[Path] = None,
+                 run_dir: Optional[Path] = None,
+                 out_root: Path = Path("server_B/storage/runs"),
+                 opts: Optional[InferOptions] = None) -> PipelineResult:
+    if bundle is None and run_dir is None:
+        raise ValueError("bundle or run_dir required")
+    timings: Dict[str, float] = {}
+
+    def _lap(name: str, t0: float) -> None:
+        timings[name] = round((time.perf_counter() - t0) * 1000.0, 3)
+
+    ingested: Optional[IngestResult] = None
+    t0 = time.perf_counter()
+    if bundle is not None:
+        ingested = ingest(Path(bundle), Path(out_root))
+        run_dir = ingested.run_dir
+        _lap("ingest", t0)
+    run_dir = Path(str(run_dir)).expanduser().resolve()
+
+    t0 = time.perf_counter()
+    ctx = run_with_deadline(lambda: extract_features(run_dir), ((opts.deadlines if opts else None) or {}).get("features"),
+                            "features")
+    _lap("features", t0)
+
+    t0 = time.perf_counter()
+    result = infer(run_dir, ctx, opts)
+    _lap("infer", t0)
+
+    t0 = time.perf_counter()
+    count = export_actions(result.out_dir)
+    _lap("actions", t0)
+    return PipelineResult(
+        run_dir=run_dir,
+        out_dir=result.out_dir,
+        actions_device=result.out_dir / "actions_device.txt",
+        actions_count=count,
+        infer=result,
+        ingest=ingested,
+        timings_ms=timings,
+    )
+
+
 def main() -> None:
     args = parse_args()
     if not args.bundle and not args.run_dir:
         raise SystemExit("--bundle or --run_dir required")
 
-    out_root = Path(args.out_root).expanduser().resolve()
-    if args.bundle:
-        run_dir = run_ingest(Path(args.bundle).expanduser().resolve(), out_root)
-    else:
-        run_dir = Path(args.run_dir).expanduser().resolve()
-
-    out_dir = run_infer(run_dir)
-    actions_path = out_dir / "actions.json"
-    actions_device_path = out_dir / "actions_device.txt"
-    count = write_actions_device(actions_path, actions_device_path)
-
-    print(f"run_dir={run_dir}")
-    print(f"out_dir={out_dir}")
-    print(f"actions_device={actions_device_path} count={count}")
+    res = run_pipeline(
+        bundle=Path(args.bundle).expanduser().resolve() if args.bundle else None,
+        run_dir=Path(args.run_dir).expanduser().resolve() if args.run_dir else None,
+        out_root=Path(args.out_root).expanduser().resolve(),
+        opts=InferOptions(degrade_level=args.degrade_level, queue_wait_sec=args.queue_wait_sec,
+                          deadlines=args.deadlines),
+    )
+    print(f"run_dir={res.run_dir}")
+    print(f"out_dir={res.out_dir}")
+    print(f"actions_device={res.actions_device} count={res.actions_count}")
 
 
 if __name__ == "__main__":
-    main()
+    main()
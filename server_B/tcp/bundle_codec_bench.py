@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Size/CPU benchmark of bundle encodings on real run directories, and zstd dictionary trainer.
+For every run dir (a dir with metrics/ events/ procs/) the bundle tar is built in memory,
+then compressed with gzip (what `tar -czf` on the board does) and zstd at --zstd_levels,
+optionally with a trained dictionary. Reported per codec: total bytes, ratio vs gzip,
+compress CPU (board side), decompress CPU and the server's streaming validate+index CPU
+(TarStreamIndexer, what tcp_ingest_server runs while receiving).
+Usage:
+  python bundle_codec_bench.py --runs /home/xrh/qwen3_os_fault/storage/runs
+  python bundle_codec_bench.py --runs <runs_root> --train_dict_dir <dict_dir>   # + writes <dict_id>.zdict
+"""
+
+import argparse
+import gzip
+import io
+import json
+import sys
+import tarfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from tar_stream_index import ZSTD_DICT_SUFFIX, TarStreamIndexer, zstandard
+
+# server-side artifacts that never come from the board
+SKIP_NAMES = {"_server_out", "_action_result", ".feature_cache.json.gz"}
+# repetitive, line-oriented files the dictionary is trained on
+DICT_GLOBS = ("metrics/*.csv", "events/*.jsonl", "procs/*.txt")
+DICT_SAMPLE_BYTES = 16 * 1024
+
+
+def find_run_dirs(paths: List[str]) -> List[Path]:
+    out: List[Path] = []
+    for raw in paths:
+        p = Path(raw).expanduser()
+        if (p / "metrics").is_dir():
+            out.append(p)
+        elif p.is_dir():
+            out.extend(sorted(d for d in p.iterdir() if (d / "metrics").is_dir()))
+    return out
+
+
+def build_tar(run_dir: Path) -> bytes:
+    bio = io.BytesIO()
+    with tarfile.open(fileobj=bio, mode="w") as tar:
+        tar.add(str(run_dir), arcname=run_dir.name, filter=lambda ti: None if Path(ti.name).name in SKIP_NAMES else ti)
+    return bio.getvalue()
+
+
+def dict_samples(run_dirs: List[Path]) -> List[bytes]:
+    samples: List[bytes] = []
+    for rd in run_dirs:
+        for pattern in DICT_GLOBS:
+            for p in sorted(rd.glob(pattern)):
+                data = p.read_bytes()
+                samples.extend(data[i:i + DICT_SAMPLE_BYTES] for i in range(0, len(data), DICT_SAMPLE_BYTES))
+    return samples
+
+
+def train_dict(run_dirs: List[Path], dict_size: int) -> Any:
+    samples = dict_samples(run_dirs)
+    if len(samples) < 8:
+        raise SystemExit(f"too few dictionary samples ({len(samples)}); pass more run dirs")
+    return zstandard.train_dictionary(dict_size, samples)
+
+
+def cpu_best(fn: Callable[[], Any], repeat: int) -> Tuple[float, Any]:
+    best = float("inf")
+    out = None
+    for _ in range(max(1, repeat)):
+        t0 = time.process_time()
+        out = fn()
+        best = min(best, time.process_time() - t0)
+    return best, out
+
+
+def index_stream(blob: bytes, enc: str, dicts: Optional[Dict[int, Any]]) -> bool:
+    idx = TarStreamIndexer(enc, dicts)
+    view = memoryview(blob)
+    for off in range(0, len(blob), 65536):
+        idx.feed(bytes(view[off:off + 65536]))
+    return idx.finish()
+
+
+def codecs(zstd_levels: List[int], gzip_level: int, zdict: Any) -> List[Tuple[str, str, Callable, Callable]]:
+    """(name, enc, compress(bytes), decompress(bytes))"""
+    out: List[Tuple[str, str, Callable, Callable]] = [
+        (f"gzip-{gzip_level}", "gzip",
+         lambda b: gzip.compress(b, compresslevel=gzip_level, mtime=0), gzip.decompress),
+    ]
+    if zstandard is None:
+        return out
+    for lvl in zstd_levels:
+        out.append((f"zstd-{lvl}", "zstd",
+                    zstandard.ZstdCompressor(level=lvl).compress,
+                    zstandard.ZstdDecompressor().decompress))
+        if zdict is not None:
+            out.append((f"zstd-{lvl}+dict", "zstd",
+                        zstandard.ZstdCompressor(level=lvl, dict_data=zdict).compress,
+                        zstandard.ZstdDecompressor(dict_data=zdict).decompress))
+    return out
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", nargs="+", required=True, help="run dirs or roots containing run dirs")
+    ap.add_argument("--gzip_level", type=int, default=6, help="6 = busybox/GNU tar -z default")
+    ap.add_argument("--zstd_levels", default="1,3,9,19")
+    ap.add_argument("--dict", default="", help="existing .zdict to evaluate")
+    ap.add_argument("--train_dict_dir", default="", help="train a dictionary on --runs and save <dict_id>.zdict here")
+    ap.add_argument("--dict_size", type=int, default=112640)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    run_dirs = find_run_dirs(args.runs)
+    if not run_dirs:
+        print("[bench] no run dirs found")
+        return 2
+    if zstandard is None:
+        print("[bench] python zstandard missing: gzip only")
+
+    zdict = None
+    dict_note = ""
+    if zstandard is not None and args.dict:
+        zdict = zstandard.ZstdCompressionDict(Path(args.dict).read_bytes())
+        dict_note = f"dict={args.dict}"
+    elif zstandard is not None and args.train_dict_dir:
+        zdict = train_dict(run_dirs, args.dict_size)
+        out_dir = Path(args.train_dict_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        path = out_dir / f"{zdict.dict_id()}{ZSTD_DICT_SUFFIX}"
+        path.write_bytes(zdict.as_bytes())
+        # trained and measured on the same runs: an upper bound for the dictionary gain
+        dict_note = f"dict={path} (trained on these runs)"
+    dicts = {zdict.dict_id(): zdict} if zdict is not None else None
+
+    tars = [build_tar(rd) for rd in run_dirs]
+    raw_total = sum(len(t) for t in tars)
+    levels = [int(x) for x in args.zstd_levels.split(",") if x.strip()]
+    rows: List[Dict[str, Any]] = []
+    for name, enc, comp, decomp in codecs(levels, args.gzip_level, zdict):
+        size = 0
+        c_cpu = d_cpu = i_cpu = 0.0
+        ok = True
+        for t in tars:
+            dt, blob = cpu_best(lambda: comp(t), args.repeat)
+            c_cpu += dt
+            size += len(blob)
+            dt, back = cpu_best(lambda: decomp(blob), args.repeat)
+            d_cpu += dt
+            ok = ok and back == t
+            dt, valid = cpu_best(lambda: index_stream(blob, enc, dicts), args.repeat)
+            i_cpu += dt
+            ok = ok and valid
+        rows.append({
+            "codec": name,
+            "bytes": size,
+            "ratio": round(raw_total / size, 2) if size else 0.0,
+            "compress_cpu_ms": round(c_cpu * 1000, 1),
+            "decompress_cpu_ms": round(d_cpu * 1000, 1),
+            "server_index_cpu_ms": round(i_cpu * 1000, 1),
+            "roundtrip_ok": ok,
+        })
+    base = rows[0]["bytes"] or 1
+    for r in rows:
+        r["vs_gzip"] = round(r["bytes"] / base, 3)
+
+    if args.json:
+        print(json.dumps({"runs": len(run_dirs), "tar_bytes": raw_total, "dict": dict_note or None, "rows": rows}, indent=2))
+    else:
+        print(f"[bench] runs={len(run_dirs)} tar_bytes={raw_total} {dict_note}".rstrip())
+        print(f"{'codec':<16}{'bytes':>12}{'ratio':>8}{'vs_gzip':>9}{'comp_ms':>10}{'decomp_ms':>11}{'index_ms':>10}  ok")
+        for r in rows:
+            print(f"{r['codec']:<16}{r['bytes']:>12}{r['ratio']:>8}{r['vs_gzip']:>9}{r['compress_cpu_ms']:>10}"
+                  f"{r['decompress_cpu_ms']:>11}{r['server_index_cpu_ms']:>10}  {r['roundtrip_ok']}")
+    return 0 if all(r["roundtrip_ok"] for r in rows) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
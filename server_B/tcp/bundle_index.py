@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""
+Bounded, persistent SHA-256 index of received bundles (<inbox>/.bundle_index.json).
+The ingest server hashes every payload while it streams in (UploadSink); a bundle whose
+content was already received is not handed to the watcher again: it gets an
+`<name>.infer_done` = skip_duplicate pointing at the original upload/run right away,
+so re-uploads under a new name and retries after a lost OK cost no extraction or
+inference. watch_and_infer.py fills in the outcome (status, run_dir) of the original.
+All access is serialized with flock on <inbox>/.bundle_index.lock (thread server, async
+server executor and watcher are separate threads/processes).
+"""
+
+import fcntl
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+BUNDLE_INDEX_NAME = ".bundle_index.json"
+BUNDLE_INDEX_LOCK = ".bundle_index.lock"
+BUNDLE_INDEX_MAX_ENV = "WK_BUNDLE_INDEX_MAX"
+BUNDLE_INDEX_MAX = 4096
+BUNDLE_DEDUPE_ENV = "WK_BUNDLE_DEDUPE"
+# outcomes after which a re-upload must be processed again instead of skipped
+RETRY_STATUSES = frozenset(("error", "skip_bad_bundle"))
+
+
+def dedupe_enabled() -> bool:
+    return os.environ.get(BUNDLE_DEDUPE_ENV, "1").strip() != "0"
+
+
+def index_max() -> int:
+    try:
+        return max(1, int(os.environ.get(BUNDLE_INDEX_MAX_ENV, str(BUNDLE_INDEX_MAX))))
+    except ValueError:
+        return BUNDLE_INDEX_MAX
+
+
+def _load(path: Path) -> Dict[str, Dict[str, Any]]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+    entries = data.get("entries") if isinstance(data, dict) else None
+    return entries if isinstance(entries, dict) else {}
+
+
+def _save(path: Path, entries: Dict[str, Dict[str, Any]]) -> None:
+    tmp = Path(str(path) + ".tmp")
+    tmp.write_text(json.dumps({"schema": 1, "entries": entries}, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _update(inbox_root: Path, fn: Callable[[Dict[str, Dict[str, Any]]], Any]) -> Any:
+    """Run fn(entries) under the index lock; entries are saved when fn returns."""
+    inbox_root.mkdir(parents=True, exist_ok=True)
+    with open(inbox_root / BUNDLE_INDEX_LOCK, "a") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        path = inbox_root / BUNDLE_INDEX_NAME
+        entries = _load(path)
+        out = fn(entries)
+        # insertion order == recency: evict the oldest beyond the bound
+        excess = len(entries) - index_max()
+        for key in list(entries)[:max(0, excess)]:
+            del entries[key]
+        _save(path, entries)
+        return out
+
+
+def claim_bundle(inbox_root: Path, sha256: str, device_id: str, run_id: str, name: str) -> Optional[Dict[str, Any]]:
+    """Record a received bundle. Returns the earlier entry if the same content was seen before."""
+
+    def fn(entries: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        prev = entries.pop(sha256, None)
+        if prev is not None and prev.get("status") not in RETRY_STATUSES:
+            prev["hits"] = int(prev.get("hits") or 0) + 1
+            entries[sha256] = prev
+            return dict(prev)
+        entries[sha256] = {
+            "device_id": device_id,
+            "run_id": run_id,
+            "name": name,
+            "ts": int(time.time()),
+            "status": "pending",
+        }
+        return None
+
+    return _update(inbox_root, fn)
+
+
+def resolve_bundle(inbox_root: Path, sha256: str, status: str, run_dir: str = "") -> None:
+    """Record what the watcher did with the original upload."""
+
+    def fn(entries: Dict[str, Dict[str, Any]]) -> None:
+        entry = entries.get(sha256)
+        if entry is None:
+            return
+        entry["status"] = status
+        if run_dir:
+            entry["run_dir"] = run_dir
+
+    _update(inbox_root, fn)
+
+
+def bundle_sha256(item: Path) -> str:
+    """SHA-256 recorded by the ingest server in <item>.index.json ("" when unknown)."""
+    try:
+        index = json.loads(Path(str(item) + ".index.json").read_text(encoding="utf-8"))
+        return str(index.get("sha256") or "")
+    except Exception:
+        return ""
+
+
+def mark_duplicate(dest: Path, device_id: str, run_id: str, original: Dict[str, Any], marker: bool = True) -> None:
+    """
+    Same marker shape as watch_and_infer.mark_infer(); the payload is dropped right away
+    (no .done), like the watcher's cleanup of handled items. marker=False skips the
+    .infer_done file (job ledger only, see job_ledger.py).
+    """
+    payload: Dict[str, Any] = {
+        "ts_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "status": "skip_duplicate",
+        "device_id": device_id,
+        "run_id": run_id,
+        "duplicate_of": original.get("name"),
+        "original_device_id": original.get("device_id"),
+        "original_run_id": original.get("run_id"),
+        "original_status": original.get("status"),
+    }
+    if original.get("run_dir"):
+        payload["run_dir"] = original["run_dir"]
+    if marker:
+        Path(str(dest) + ".infer_done").write_text(json.dumps(payload, ensure_ascii=True) + "\n", encoding="utf-8")
+    for p in (dest, Path(str(dest) + ".index.json")):
+        try:
+            p.unlink()
+        except OSError:
+            pass
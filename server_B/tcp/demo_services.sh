@@ -16,6 +16,15 @@ TRIGGER_POLL_SEC="${TRIGGER_POLL_SEC:-2}"
 # Default: disabled. Enable by exporting ENABLE_TRIGGERD=1 before running this script.
 ENABLE_TRIGGERD="${ENABLE_TRIGGERD:-0}"
 
+# asyncio ingest (bounded concurrent uploads, stats on 127.0.0.1:18090). Default: thread server.
+INGEST_ASYNC="${INGEST_ASYNC:-0}"
+INGEST_MAX_UPLOADS="${INGEST_MAX_UPLOADS:-32}"
+
+# delta uploads: last ingested copy of each device's daily sys/events files. The ingest server
+# answers OP=delta_query from it and ingest_bundle.py rebuilds .delta members against it.
+# It is pinned here because WIN_RUNS may move the runs root away from the inbox.
+export WK_DELTA_BASE_DIR="${WK_DELTA_BASE_DIR:-$ROOT/storage/delta_base}"
+
 ensure_dirs() {
   mkdir -p "$LOG_DIR" "$PID_DIR" "$INBOX" "$OUT" "$RUNS"
 }
@@ -291,7 +300,11 @@ start_all() {
   ensure_dirs
   activate_venv
   pre_kill_ports
-  start_one "ingest" "$PID_DIR/ingest.pid" "$LOG_DIR/ingest.log" "$PY" "$ROOT/server_B/tcp/tcp_ingest_server.py" --host 0.0.0.0 --port 18080 --inbox "$INBOX"
+  if [ "${INGEST_ASYNC}" = "1" ]; then
+    start_one "ingest" "$PID_DIR/ingest.pid" "$LOG_DIR/ingest.log" "$PY" "$ROOT/server_B/tcp/tcp_ingest_server_async.py" --host 0.0.0.0 --port 18080 --inbox "$INBOX" --max_uploads "$INGEST_MAX_UPLOADS"
+  else
+    start_one "ingest" "$PID_DIR/ingest.pid" "$LOG_DIR/ingest.log" "$PY" "$ROOT/server_B/tcp/tcp_ingest_server.py" --host 0.0.0.0 --port 18080 --inbox "$INBOX"
+  fi
   start_one "actions" "$PID_DIR/actions.pid" "$LOG_DIR/actions.log" "$PY" "$ROOT/server_B/tcp/tcp_actions_server.py" --host 0.0.0.0 --port 28081 --out "$OUT"
   start_one "watcher" "$PID_DIR/watcher.pid" "$LOG_DIR/watcher.log" "$PY" "$ROOT/server_B/tcp/watch_and_infer.py" --inbox "$INBOX" --out "$OUT" --runs_root "$RUNS" --poll_sec 2
   if [ "${ENABLE_TRIGGERD}" = "1" ]; then
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Linux inotify (via ctypes, no extra package) on the ingest inbox for watch_and_infer.py.
+Watches <inbox> for new device dirs and every <inbox>/<device_id> for `.done` markers
+(written by tcp_ingest_server.py once an upload is complete). wait() returns the
+device ids that saw a marker, so the watcher scans only those instead of every device
+and marker file each poll. A kernel queue overflow asks for a full rescan.
+InboxNotifier() raises OSError where inotify is unavailable; callers fall back to polling.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from pathlib import Path
+from typing import Dict, Set, Tuple
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+ROOT_MASK = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+DEVICE_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HDR = struct.Struct("iIII")  # wd, mask, cookie, len
+READ_BYTES = 64 * 1024
+MARKER_SUFFIX = ".done"
+
+
+class InboxNotifier:
+    def __init__(self, inbox_root: Path) -> None:
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        try:
+            self._libc = ctypes.CDLL(libc_name, use_errno=True)
+            self._libc.inotify_init1
+        except (OSError, AttributeError) as exc:
+            raise OSError(errno.ENOSYS, f"inotify unavailable: {exc}")
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"inotify_init1: {os.strerror(e)}")
+        self.fd = fd
+        self.inbox_root = inbox_root
+        self._wd_device: Dict[int, str] = {}
+        self._device_wd: Dict[str, int] = {}
+        try:
+            self._root_wd = self._add_watch(inbox_root, ROOT_MASK)
+            for p in inbox_root.iterdir():
+                if p.is_dir():
+                    self.watch_device(p.name)
+        except Exception:
+            self.close()
+            raise
+
+    def _add_watch(self, path: Path, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(path)), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            # ENOSPC: fs.inotify.max_user_watches reached
+            raise OSError(e, f"inotify_add_watch {path}: {os.strerror(e)}")
+        return wd
+
+    def watch_device(self, device: str) -> None:
+        if device in self._device_wd or device.startswith("."):
+            return
+        wd = self._add_watch(self.inbox_root / device, DEVICE_MASK)
+        self._wd_device[wd] = device
+        self._device_wd[device] = wd
+
+    def wait(self, timeout: float) -> Tuple[Set[str], bool]:
+        """(device ids with new .done markers, full_rescan_needed); empty after timeout."""
+        dirty: Set[str] = set()
+        rescan = False
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return dirty, rescan
+        while True:
+            try:
+                buf = os.read(self.fd, READ_BYTES)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            off = 0
+            while off + EVENT_HDR.size <= len(buf):
+                wd, mask, _, nlen = EVENT_HDR.unpack_from(buf, off)
+                raw = buf[off + EVENT_HDR.size:off + EVENT_HDR.size + nlen]
+                off += EVENT_HDR.size + nlen
+                name = os.fsdecode(raw.split(b"\0", 1)[0])
+                if mask & IN_Q_OVERFLOW:
+                    rescan = True
+                elif wd == self._root_wd:
+                    if mask & IN_ISDIR and name:
+                        # markers may land before the watch exists: scan the new dir once
+                        try:
+                            self.watch_device(name)
+                        except OSError:
+                            rescan = True
+                        dirty.add(name)
+                elif mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    device = self._wd_device.pop(wd, None)
+                    if device is not None:
+                        self._device_wd.pop(device, None)
+                elif name.endswith(MARKER_SUFFIX):
+                    device = self._wd_device.get(wd)
+                    if device is not None:
+                        dirty.add(device)
+        return dirty, rescan
+
+    def close(self) -> None:
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+Admission control for the ingest servers (tcp_ingest_server.py / tcp_ingest_server_async.py).
+While the watcher is backed up, a new bundle mostly ends up as skip_stale; the server then
+answers `BUSY RETRY_AFTER=<sec>` instead of taking the payload, and uploader_nc.sh waits
+(or gives up with exit 4) instead of transferring it.
+- queue depth: bundle jobs received/prep/infer in the job ledger (with WK_JOB_LEDGER=0:
+  .done markers without .infer_done), re-read at most every DEPTH_CACHE_SEC
+- per-device token bucket: --admit_device_rate_per_min refill, --admit_device_burst size
+Only TYPE=bundle is throttled. OP=query is checked without taking a token, so the board
+hears BUSY before sending anything; resumed uploads (OFFSET>0) are always admitted.
+RETRY_AFTER is the bucket refill time, or the backlog above --admit_max_queue times the
+recent average job time, jittered by +-20% and clamped to [RETRY_MIN_SEC, --admit_retry_max_sec].
+"""
+
+import argparse
+import math
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from job_ledger import open_ledger
+
+ADMIT_KINDS = ("bundle",)
+DEPTH_CACHE_SEC = 1.0
+MARKER_SCAN_SEC = 5.0
+DEFAULT_JOB_SEC = 30.0
+RETRY_MIN_SEC = 5.0
+RETRY_JITTER = 0.2
+# closing with unread payload bytes makes the kernel send RST, which can destroy the BUSY
+# line before the board reads it: half-close and drain briefly first (see linger_input)
+BUSY_LINGER_SEC = 2.0
+BUSY_LINGER_BYTES = 1024 * 1024
+BUNDLE_SUFFIXES = (".tar.gz", ".tar.zst", ".tgz", ".tzst")
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+
+def reply_busy(retry_after: float) -> bytes:
+    return f"BUSY RETRY_AFTER={int(math.ceil(retry_after))}\n".encode("utf-8")
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, burst: float, now: float) -> None:
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, rate: float, burst: float, now: float) -> None:
+        self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+
+
+class AdmissionControl:
+    def __init__(self,
+                 inbox_root: Path,
+                 max_queue: int = 32,
+                 device_rate_per_min: float = 6.0,
+                 device_burst: float = 3.0,
+                 retry_max: float = 600.0) -> None:
+        self.inbox_root = inbox_root
+        self.max_queue = max(0, max_queue)
+        self.rate = max(0.0, device_rate_per_min) / 60.0
+        self.burst = max(1.0, device_burst)
+        self.retry_max = max(RETRY_MIN_SEC, retry_max)
+        self.busy = 0
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._depth: Tuple[float, int, float] = (0.0, 0, DEFAULT_JOB_SEC)  # (read at, depth, avg job sec)
+        self._admitted = 0  # uploads let in since that reading
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_queue > 0 or self.rate > 0
+
+    def _marker_depth(self) -> int:
+        n = 0
+        for device_dir in self.inbox_root.iterdir():
+            if not device_dir.is_dir() or device_dir.name.startswith("."):
+                continue
+            for done in device_dir.glob("*.done"):
+                item = str(done)[:-len(".done")]
+                if item.endswith(BUNDLE_SUFFIXES) and not os.path.exists(item + ".infer_done"):
+                    n += 1
+        return n
+
+    def backlog(self) -> Tuple[int, float]:
+        """(bundles waiting or in flight, recent average seconds per job)."""
+        now = time.time()
+        read_at, depth, job_sec = self._depth
+        ledger = open_ledger(self.inbox_root)
+        if now - read_at < (DEPTH_CACHE_SEC if ledger is not None else MARKER_SCAN_SEC):
+            return depth + self._admitted, job_sec
+        try:
+            if ledger is not None:
+                info = ledger.backlog(ADMIT_KINDS[0])
+                depth, job_sec = int(info["depth"]), float(info["avg_job_sec"] or DEFAULT_JOB_SEC)
+            else:
+                depth = self._marker_depth()
+        except Exception:
+            depth += self._admitted  # keep the last reading; never refuse uploads because the ledger is locked
+        self._depth = (now, depth, job_sec)
+        self._admitted = 0
+        return depth, job_sec
+
+    def check(self, device_id: str, kind: str, op: str = "", offset: Optional[int] = None) -> Optional[float]:
+        """None to admit, else seconds the board should wait. OP=query takes no token."""
+        if not self.enabled or kind not in ADMIT_KINDS or (offset or 0) > 0:
+            return None
+        with self._lock:
+            now = time.time()
+            wait = 0.0
+            bucket: Optional[TokenBucket] = None
+            if self.rate > 0:
+                bucket = self._buckets.get(device_id)
+                if bucket is None:
+                    bucket = self._buckets[device_id] = TokenBucket(self.burst, now)
+                bucket.refill(self.rate, self.burst, now)
+                if bucket.tokens < 1.0:
+                    wait = (1.0 - bucket.tokens) / self.rate
+            if self.max_queue > 0 and wait <= 0:
+                depth, job_sec = self.backlog()
+                if depth >= self.max_queue:
+                    wait = (depth - self.max_queue + 1) * job_sec
+            if wait > 0:
+                self.busy += 1
+                wait *= 1.0 + random.uniform(-RETRY_JITTER, RETRY_JITTER)
+                return min(self.retry_max, max(RETRY_MIN_SEC, wait))
+            if op != "query":
+                self._admitted += 1
+                if bucket is not None:
+                    bucket.tokens -= 1.0
+            return None
+
+
+def add_admission_args(ap: argparse.ArgumentParser) -> None:
+    ap.add_argument("--admit_max_queue", type=int, default=int(env_float("WK_ADMIT_MAX_QUEUE", 32)),
+                    help="BUSY while this many bundles wait or run (0: no limit)")
+    ap.add_argument("--admit_device_rate_per_min", type=float,
+                    default=env_float("WK_ADMIT_DEVICE_RATE_PER_MIN", 6.0),
+                    help="bundles per minute per device after the burst (0: no limit)")
+    ap.add_argument("--admit_device_burst", type=float, default=env_float("WK_ADMIT_DEVICE_BURST", 3.0))
+    ap.add_argument("--admit_retry_max_sec", type=float, default=env_float("WK_ADMIT_RETRY_MAX_SEC", 600.0))
+
+
+def admission_from_args(inbox_root: Path, args: argparse.Namespace) -> Optional[AdmissionControl]:
+    adm = AdmissionControl(inbox_root, args.admit_max_queue, args.admit_device_rate_per_min,
+                           args.admit_device_burst, args.admit_retry_max_sec)
+    return adm if adm.enabled else None
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+Load test for the ingest servers: a burst of boards reconnecting at once.
+Starts tcp_ingest_server.py (thread) and/or tcp_ingest_server_async.py on a scratch
+inbox, fires --clients concurrent uploads of a --size_kb bundle, and reports
+ok/err counts, latency percentiles, throughput, plus the server's peak RSS and
+thread count sampled from /proc.
+Usage:
+  python ingest_load_test.py --impl both --clients 300 --size_kb 512
+  python ingest_load_test.py --impl none --port 18080      # against a running server
+"""
+
+import argparse
+import io
+import os
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+HERE = Path(__file__).resolve().parent
+
+
+def make_bundle(size_kb: int) -> bytes:
+    raw = os.urandom(size_kb * 1024)
+    bio = io.BytesIO()
+    with tarfile.open(fileobj=bio, mode="w:gz", compresslevel=1) as tar:
+        info = tarfile.TarInfo("load/blob.bin")
+        info.size = len(raw)
+        tar.addfile(info, io.BytesIO(raw))
+    return bio.getvalue()
+
+
+def upload(host: str, port: int, device: str, run: str, payload: bytes, timeout: float) -> str:
+    header = f"TYPE=bundle\nDEVICE={device}\nRUN={run}\nLEN={len(payload)}\n\n".encode("utf-8")
+    with socket.create_connection((host, port), timeout=timeout) as s:
+        s.sendall(header)
+        view = memoryview(payload)
+        for off in range(0, len(payload), 65536):
+            s.sendall(view[off:off + 65536])
+        s.shutdown(socket.SHUT_WR)
+        resp = b""
+        while True:
+            chunk = s.recv(64)
+            if not chunk:
+                break
+            resp += chunk
+    return resp.decode("utf-8", errors="ignore").strip()
+
+
+def proc_sample(pid: int) -> Dict[str, int]:
+    out = {"rss_kb": 0, "threads": 0}
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                out["rss_kb"] = int(line.split()[1])
+            elif line.startswith("Threads:"):
+                out["threads"] = int(line.split()[1])
+    except Exception:
+        pass
+    return out
+
+
+def wait_port(host: str, port: int, timeout: float = 10.0) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def percentile(vals: List[float], p: float) -> float:
+    if not vals:
+        return 0.0
+    vals = sorted(vals)
+    k = min(len(vals) - 1, max(0, int(round(p / 100.0 * (len(vals) - 1)))))
+    return vals[k]
+
+
+def run_load(host: str, port: int, clients: int, payload: bytes, timeout: float,
+             server_pid: Optional[int]) -> Dict[str, Any]:
+    results: List[Optional[str]] = [None] * clients
+    latencies: List[float] = [0.0] * clients
+    start_gate = threading.Event()
+
+    def worker(i: int) -> None:
+        start_gate.wait()
+        t0 = time.perf_counter()
+        try:
+            results[i] = upload(host, port, f"load{i % 64:02d}", f"run_{i:05d}", payload, timeout)
+        except Exception as exc:
+            results[i] = f"EXC:{type(exc).__name__}"
+        latencies[i] = time.perf_counter() - t0
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(clients)]
+    for t in threads:
+        t.start()
+    peak = {"rss_kb": 0, "threads": 0}
+    stop_sampler = threading.Event()
+
+    def sampler() -> None:
+        while not stop_sampler.is_set() and server_pid:
+            s = proc_sample(server_pid)
+            peak["rss_kb"] = max(peak["rss_kb"], s["rss_kb"])
+            peak["threads"] = max(peak["threads"], s["threads"])
+            time.sleep(0.05)
+
+    st = threading.Thread(target=sampler, daemon=True)
+    st.start()
+    t_start = time.perf_counter()
+    start_gate.set()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t_start
+    stop_sampler.set()
+    st.join()
+
+    ok = sum(1 for r in results if r == "OK")
+    errs: Dict[str, int] = {}
+    for r in results:
+        if r != "OK":
+            errs[str(r)] = errs.get(str(r), 0) + 1
+    return {
+        "clients": clients,
+        "ok": ok,
+        "errors": errs,
+        "wall_sec": round(wall, 3),
+        "mb_per_sec": round(ok * len(payload) / (1024 * 1024) / wall, 2) if wall > 0 else 0.0,
+        "lat_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "lat_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "lat_max_ms": round(max(latencies) * 1000, 1) if latencies else 0.0,
+        "server_peak_rss_kb": peak["rss_kb"],
+        "server_peak_threads": peak["threads"],
+    }
+
+
+def start_server(impl: str, port: int, inbox: Path, max_uploads: int) -> subprocess.Popen:
+    # nothing drains the scratch inbox: admission control would turn the burst into BUSY replies
+    no_admission = ["--admit_max_queue", "0", "--admit_device_rate_per_min", "0"]
+    if impl == "thread":
+        cmd = [sys.executable, str(HERE / "tcp_ingest_server.py"), "--host", "127.0.0.1", "--port", str(port),
+               "--inbox", str(inbox)] + no_admission
+    else:
+        cmd = [sys.executable, str(HERE / "tcp_ingest_server_async.py"), "--host", "127.0.0.1", "--port", str(port),
+               "--inbox", str(inbox), "--max_uploads", str(max_uploads), "--stats_port", "0"] + no_admission
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--impl", default="both", choices=["thread", "async", "both", "none"])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=28180)
+    ap.add_argument("--clients", type=int, default=200)
+    ap.add_argument("--size_kb", type=int, default=256)
+    ap.add_argument("--max_uploads", type=int, default=32)
+    ap.add_argument("--timeout_sec", type=float, default=120.0)
+    args = ap.parse_args()
+
+    payload = make_bundle(args.size_kb)
+    print(f"[load] clients={args.clients} payload_bytes={len(payload)}")
+    impls = ["thread", "async"] if args.impl == "both" else [args.impl]
+    rc = 0
+    for impl in impls:
+        if impl == "none":
+            res = run_load(args.host, args.port, args.clients, payload, args.timeout_sec, None)
+            print(f"[load] external {res}")
+            rc |= 0 if res["ok"] == args.clients else 1
+            continue
+        with tempfile.TemporaryDirectory(prefix=f"ingest_load_{impl}_") as td:
+            proc = start_server(impl, args.port, Path(td), args.max_uploads)
+            try:
+                if not wait_port(args.host, args.port):
+                    print(f"[load] {impl}: server did not start")
+                    rc = 1
+                    continue
+                res = run_load(args.host, args.port, args.clients, payload, args.timeout_sec, proc.pid)
+                done = len(list(Path(td).glob("load*/*.done")))
+                print(f"[load] {impl} {res} done_markers={done}")
+                rc |= 0 if res["ok"] == args.clients else 1
+            finally:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
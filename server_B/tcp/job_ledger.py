@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+"""
+SQLite job ledger for the ingest inbox (<inbox>/.jobs.sqlite, WAL mode).
+One row per upload <inbox>/<device_id>/<name>: the ingest server inserts it as `received`
+once the payload is complete, watch_and_infer.py moves it through prep / infer to its
+outcome (the same status strings as the .infer_done markers) with timings, run_dir and
+error, and every transition is appended to job_events. The watcher schedules from the
+indexed `received` rows instead of globbing and stat-ing marker files.
+The .done / .infer_done markers stay on by default for older tooling; WK_INBOX_MARKERS=0
+drops them once everything reads the ledger. WK_JOB_LEDGER=0 disables the ledger
+(marker-only, as before); any other value is the database path.
+Usage:
+  python job_ledger.py list --inbox <inbox> [--device D] [--state error] [--limit 50]
+  python job_ledger.py stats --inbox <inbox>
+  python job_ledger.py retry --inbox <inbox> (--id N ... | --device D | --state error)
+  python job_ledger.py purge --inbox <inbox> [--keep_max 200] [--keep_days 7] [--dry_run]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set
+
+LEDGER_ENV = "WK_JOB_LEDGER"
+LEDGER_NAME = ".jobs.sqlite"
+MARKERS_ENV = "WK_INBOX_MARKERS"
+BUSY_TIMEOUT_MS = 10000
+
+STATE_RECEIVED = "received"
+# uploads the watcher does not process (non-tar TYPEs): recorded, never purged
+STATE_STORED = "stored"
+ACTIVE_STATES = ("prep", "infer")
+# terminal states the CLI may put back to `received`
+RETRY_STATES = ("error", "skip_bad_bundle", "skip_stale", "cancelled_superseded", "skip_missing")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    run_id TEXT NOT NULL DEFAULT '',
+    kind TEXT NOT NULL DEFAULT '',
+    path TEXT NOT NULL,
+    sha256 TEXT,
+    size INTEGER,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    run_dir TEXT,
+    error TEXT,
+    detail TEXT,
+    received_ts REAL,
+    started_ts REAL,
+    finished_ts REAL,
+    updated_ts REAL NOT NULL,
+    UNIQUE (device_id, name)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, device_id, received_ts);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (device_id, finished_ts);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    state TEXT NOT NULL,
+    info TEXT
+);
+CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id);
+"""
+
+MAX_ERROR_CHARS = 2048
+
+
+def markers_enabled() -> bool:
+    return os.environ.get(MARKERS_ENV, "1").strip() != "0"
+
+
+def ledger_path(inbox_root: Path) -> Optional[Path]:
+    env = os.environ.get(LEDGER_ENV, "").strip()
+    if env == "0":
+        return None
+    if env:
+        return Path(env).expanduser()
+    return inbox_root / LEDGER_NAME
+
+
+def is_terminal(state: str) -> bool:
+    return state != STATE_RECEIVED and state not in ACTIVE_STATES
+
+
+class JobLedger:
+    """One sqlite3 connection per thread (watcher pipeline threads, ingest server handlers)."""
+
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self._local = threading.local()
+        self._conn()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.db_path), timeout=BUSY_TIMEOUT_MS / 1000.0)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            conn.executescript(SCHEMA)
+            cols = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}
+            if "worker" not in cols:
+                try:
+                    conn.execute("ALTER TABLE jobs ADD COLUMN worker TEXT")
+                except sqlite3.OperationalError:
+                    pass  # added by another process meanwhile
+            self._local.conn = conn
+        return conn
+
+    def _event(self, conn: sqlite3.Connection, job_id: int, state: str, info: Optional[Dict[str, Any]], now: float) -> None:
+        conn.execute(
+            "INSERT INTO job_events (job_id, ts, state, info) VALUES (?, ?, ?, ?)",
+            (job_id, now, state, json.dumps(info, ensure_ascii=True) if info else None),
+        )
+
+    def record_upload(self,
+                      item: Path,
+                      kind: str,
+                      run_id: str = "",
+                      sha256: Optional[str] = None,
+                      size: Optional[int] = None,
+                      state: str = STATE_RECEIVED,
+                      error: str = "",
+                      detail: Optional[Dict[str, Any]] = None) -> int:
+        """
+        Insert (or reset, for a re-upload under the same name) the job of a complete upload.
+        A skip_duplicate never overwrites an existing job of that name: it only adds an event.
+        """
+        now = time.time()
+        device_id = item.parent.name
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT INTO jobs (device_id, name, run_id, kind, path, sha256, size, state, error, detail,"
+                " received_ts, updated_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (device_id, name) DO UPDATE SET"
+                " run_id=excluded.run_id, kind=excluded.kind, path=excluded.path, sha256=excluded.sha256,"
+                " size=excluded.size, state=excluded.state, error=excluded.error, detail=excluded.detail,"
+                " run_dir=NULL, received_ts=excluded.received_ts, started_ts=NULL, finished_ts=NULL,"
+                " updated_ts=excluded.updated_ts"
+                " WHERE excluded.state != 'skip_duplicate'",
+                (device_id, item.name, run_id, kind, str(item), sha256, size, state, (error or None),
+                 json.dumps(detail, ensure_ascii=True) if detail else None, now, now),
+            )
+            if is_terminal(state):
+                conn.execute("UPDATE jobs SET finished_ts=? WHERE device_id=? AND name=? AND state=?",
+                             (now, device_id, item.name, state))
+            row = conn.execute("SELECT id FROM jobs WHERE device_id=? AND name=?", (device_id, item.name)).fetchone()
+            self._event(conn, row["id"], state, detail or ({"error": error} if error else None), now)
+        return int(row["id"])
+
+    def set_state(self,
+                  item: Path,
+                  state: str,
+                  run_id: str = "",
+                  run_dir: str = "",
+                  error: str = "",
+                  detail: Optional[Dict[str, Any]] = None,
+                  worker: str = "") -> None:
+        """
+        Move the job of `item` to `state`; jobs the ledger never saw are added on the fly.
+        `worker` (prep/infer) names the watcher holding the job, see requeue_active().
+        """
+        now = time.time()
+        device_id = item.parent.name
+        conn = self._conn()
+        with conn:
+            row = conn.execute("SELECT id, state FROM jobs WHERE device_id=? AND name=?",
+                               (device_id, item.name)).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO jobs (device_id, name, run_id, path, state, received_ts, updated_ts)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (device_id, item.name, run_id, str(item), STATE_RECEIVED, now, now),
+                )
+                row = conn.execute("SELECT id, state FROM jobs WHERE device_id=? AND name=?",
+                                   (device_id, item.name)).fetchone()
+            sets = ["state=?", "updated_ts=?"]
+            args: List[Any] = [state, now]
+            if state in ACTIVE_STATES:
+                if row["state"] == STATE_RECEIVED:
+                    sets += ["attempts=attempts+1", "started_ts=?", "finished_ts=NULL"]
+                    args.append(now)
+            elif is_terminal(state):
+                sets.append("finished_ts=?")
+                args.append(now)
+            if run_id:
+                sets.append("run_id=?")
+                args.append(run_id)
+            if worker:
+                sets.append("worker=?")
+                args.append(worker)
+            if run_dir:
+                sets.append("run_dir=?")
+                args.append(run_dir)
+            if error or state != "error":
+                sets.append("error=?")
+                args.append(error[:MAX_ERROR_CHARS] or None)
+            if detail:
+                sets.append("detail=?")
+                args.append(json.dumps(detail, ensure_ascii=True))
+            conn.execute("UPDATE jobs SET %s WHERE id=?" % ", ".join(sets), args + [row["id"]])
+            info = dict(detail or {})
+            if error:
+                info["error"] = error[:MAX_ERROR_CHARS]
+            self._event(conn, row["id"], state, info, now)
+
+    def known_names(self, device_id: str) -> Set[str]:
+        rows = self._conn().execute("SELECT name FROM jobs WHERE device_id=?", (device_id,)).fetchall()
+        return {r["name"] for r in rows}
+
+    def pending_devices(self) -> Set[str]:
+        rows = self._conn().execute("SELECT DISTINCT device_id FROM jobs WHERE state=?", (STATE_RECEIVED,)).fetchall()
+        return {r["device_id"] for r in rows}
+
+    def pending(self, device_id: str) -> List[sqlite3.Row]:
+        return self._conn().execute(
+            "SELECT * FROM jobs WHERE state=? AND device_id=? ORDER BY received_ts",
+            (STATE_RECEIVED, device_id),
+        ).fetchall()
+
+    def requeue_active(self, device_id: str = "", keep: Optional[Callable[[sqlite3.Row], bool]] = None,
+                       reason: str = "watcher_restart") -> int:
+        """
+        Jobs left in prep/infer by a dead watcher go back to `received`.
+        keep(row) spares jobs still owned by a live watcher (several watchers, one inbox).
+        """
+        now = time.time()
+        conn = self._conn()
+        sql = "SELECT * FROM jobs WHERE state IN (?, ?)"
+        args: List[Any] = list(ACTIVE_STATES)
+        if device_id:
+            sql += " AND device_id=?"
+            args.append(device_id)
+        n = 0
+        with conn:
+            for r in conn.execute(sql, args).fetchall():
+                if keep is not None and keep(r):
+                    continue
+                conn.execute("UPDATE jobs SET state=?, updated_ts=? WHERE id=? AND state=?",
+                             (STATE_RECEIVED, now, r["id"], r["state"]))
+                self._event(conn, r["id"], STATE_RECEIVED, {"requeued": reason, "worker": r["worker"]}, now)
+                n += 1
+        return n
+
+    def jobs(self, device_id: str = "", state: str = "", limit: int = 50) -> List[sqlite3.Row]:
+        where: List[str] = []
+        args: List[Any] = []
+        if device_id:
+            where.append("device_id=?")
+            args.append(device_id)
+        if state:
+            where.append("state=?")
+            args.append(state)
+        sql = "SELECT * FROM jobs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY updated_ts DESC LIMIT ?"
+        return self._conn().execute(sql, args + [max(1, limit)]).fetchall()
+
+    def events(self, job_id: int) -> List[sqlite3.Row]:
+        return self._conn().execute("SELECT * FROM job_events WHERE job_id=? ORDER BY ts", (job_id,)).fetchall()
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._conn()
+        states = {r["state"]: r["n"] for r in conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")}
+        pending = {r["device_id"]: r["n"] for r in conn.execute(
+            "SELECT device_id, COUNT(*) AS n FROM jobs WHERE state=? GROUP BY device_id", (STATE_RECEIVED,))}
+        return {"db": str(self.db_path), "states": states, "pending_by_device": pending}
+
+    def backlog(self, kind: str = "bundle", window: int = 20) -> Dict[str, Any]:
+        """Jobs of `kind` waiting or in flight, and the mean prep+infer time of the last `window` ok ones."""
+        conn = self._conn()
+        # rows added on the fly by set_state() have no kind
+        depth = conn.execute(
+            "SELECT COUNT(*) AS n FROM jobs WHERE state IN (?, ?, ?) AND kind IN (?, '')",
+            (STATE_RECEIVED,) + ACTIVE_STATES + (kind,),
+        ).fetchone()["n"]
+        recent = conn.execute(
+            "SELECT finished_ts - started_ts AS sec FROM jobs WHERE state='ok' AND kind IN (?, '')"
+            " AND started_ts IS NOT NULL AND finished_ts IS NOT NULL ORDER BY finished_ts DESC LIMIT ?",
+            (kind, max(1, window)),
+        ).fetchall()
+        secs = [r["sec"] for r in recent if r["sec"] is not None and r["sec"] >= 0]
+        return {"depth": int(depth), "avg_job_sec": (sum(secs) / len(secs)) if secs else None}
+
+    def retry(self, job_ids: Optional[List[int]] = None, device_id: str = "", state: str = "") -> Dict[str, List[int]]:
+        """
+        Put terminal jobs whose payload is still in the inbox back to `received`.
+        Selecting by device alone only picks RETRY_STATES.
+        """
+        rows = []
+        if job_ids:
+            conn = self._conn()
+            for jid in job_ids:
+                r = conn.execute("SELECT * FROM jobs WHERE id=?", (jid,)).fetchone()
+                if r is not None:
+                    rows.append(r)
+        else:
+            rows = self.jobs(device_id, state, limit=1 << 30)
+            if not state:
+                rows = [r for r in rows if r["state"] in RETRY_STATES]
+        out: Dict[str, List[int]] = {"requeued": [], "missing": [], "not_terminal": []}
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            for r in rows:
+                if not is_terminal(r["state"]):
+                    out["not_terminal"].append(r["id"])
+                    continue
+                item = Path(r["path"])
+                if not item.exists():
+                    out["missing"].append(r["id"])
+                    continue
+                remove_file(Path(str(item) + ".infer_done"))
+                conn.execute(
+                    "UPDATE jobs SET state=?, error=NULL, started_ts=NULL, finished_ts=NULL, updated_ts=? WHERE id=?",
+                    (STATE_RECEIVED, now, r["id"]),
+                )
+                self._event(conn, r["id"], STATE_RECEIVED, {"requeued": "retry", "from": r["state"]}, now)
+                out["requeued"].append(r["id"])
+        return out
+
+    def purge(self, keep_max: int = 200, keep_days: int = 7, dry_run: bool = False) -> Dict[str, int]:
+        """
+        Drop finished jobs beyond the newest keep_max per device or older than keep_days,
+        together with whatever is left of them in the inbox (payload and markers).
+        """
+        conn = self._conn()
+        cutoff = time.time() - keep_days * 86400 if keep_days > 0 else None
+        victims: List[sqlite3.Row] = []
+        for d in conn.execute("SELECT DISTINCT device_id FROM jobs").fetchall():
+            rows = conn.execute(
+                "SELECT id, path, state, finished_ts FROM jobs WHERE device_id=? AND finished_ts IS NOT NULL"
+                " ORDER BY finished_ts DESC", (d["device_id"],),
+            ).fetchall()
+            for idx, r in enumerate(rows):
+                if not is_terminal(r["state"]) or r["state"] == STATE_STORED:
+                    continue
+                over = keep_max > 0 and idx >= keep_max
+                old = cutoff is not None and r["finished_ts"] < cutoff
+                if over or old:
+                    victims.append(r)
+        if not dry_run and victims:
+            with conn:
+                for r in victims:
+                    item = Path(r["path"])
+                    for p in (item, Path(str(item) + ".done"), Path(str(item) + ".index.json"),
+                              Path(str(item) + ".infer_done")):
+                        remove_file(p)
+                    # delta bases pinned for the upload (tcp_ingest_server.pin_delta_bases)
+                    shutil.rmtree(Path(str(item) + ".delta_base"), ignore_errors=True)
+                    conn.execute("DELETE FROM job_events WHERE job_id=?", (r["id"],))
+                    conn.execute("DELETE FROM jobs WHERE id=?", (r["id"],))
+        return {"purged": len(victims)}
+
+
+def remove_file(p: Path) -> None:
+    try:
+        p.unlink()
+    except OSError:
+        pass
+
+
+_LEDGERS: Dict[str, JobLedger] = {}
+_LEDGERS_LOCK = threading.Lock()
+
+
+def open_ledger(inbox_root: Path) -> Optional[JobLedger]:
+    """Shared JobLedger of an inbox; None when disabled or the database cannot be opened."""
+    path = ledger_path(inbox_root)
+    if path is None:
+        return None
+    key = str(path.resolve())
+    with _LEDGERS_LOCK:
+        ledger = _LEDGERS.get(key)
+        if ledger is None:
+            try:
+                ledger = JobLedger(path)
+            except Exception as exc:
+                print(f"[job_ledger] unavailable {path}: {exc}", file=sys.stderr, flush=True)
+                return None
+            _LEDGERS[key] = ledger
+        return ledger
+
+
+def fmt_ts(ts: Optional[float]) -> str:
+    if not ts:
+        return "-"
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
+
+def parse_args() -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("cmd", choices=["list", "stats", "retry", "purge", "events"])
+    ap.add_argument("--inbox", default="/home/xrh/qwen3_os_fault/storage/tcp_inbox")
+    ap.add_argument("--db", default="", help=f"ledger path (default: ${LEDGER_ENV} or <inbox>/{LEDGER_NAME})")
+    ap.add_argument("--device", default="")
+    ap.add_argument("--state", default="")
+    ap.add_argument("--id", type=int, action="append", default=[], help="job id (repeatable)")
+    ap.add_argument("--limit", type=int, default=50)
+    ap.add_argument("--keep_max", type=int, default=int(os.environ.get("WK_TCP_INBOX_KEEP_MAX", "200")))
+    ap.add_argument("--keep_days", type=int, default=int(os.environ.get("WK_TCP_INBOX_KEEP_DAYS", "7")))
+    ap.add_argument("--dry_run", action="store_true")
+    return ap.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    db = Path(args.db).expanduser() if args.db else ledger_path(Path(args.inbox).expanduser())
+    if db is None:
+        print(f"ledger disabled ({LEDGER_ENV}=0)", file=sys.stderr)
+        return 2
+    ledger = JobLedger(db)
+    if args.cmd == "list":
+        for r in ledger.jobs(args.device, args.state, args.limit):
+            err = (r["error"] or "").replace("\n", " ")[:120]
+            print("\t".join([
+                str(r["id"]), r["device_id"], r["name"], r["state"], str(r["attempts"]), r["worker"] or "-",
+                fmt_ts(r["received_ts"]), fmt_ts(r["finished_ts"]), r["run_dir"] or "-", err,
+            ]))
+        return 0
+    if args.cmd == "events":
+        for jid in args.id:
+            for e in ledger.events(jid):
+                print("\t".join([str(jid), fmt_ts(e["ts"]), e["state"], e["info"] or ""]))
+        return 0
+    if args.cmd == "retry":
+        if not (args.id or args.device or args.state):
+            print("retry needs --id, --device or --state", file=sys.stderr)
+            return 2
+        res: Dict[str, Any] = ledger.retry(args.id or None, args.device, args.state)
+    elif args.cmd == "purge":
+        res = ledger.purge(args.keep_max, args.keep_days, args.dry_run)
+        res["dry_run"] = bool(args.dry_run)
+    else:
+        res = ledger.stats()
+    print(json.dumps(res, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
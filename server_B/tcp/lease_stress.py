@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+Stress test for the work leases (work_lease.py) shared by several watchers.
+Starts --workers local worker processes on a scratch inbox of --devices x --jobs fake
+jobs. Workers claim devices the way watch_and_infer.py does (DeviceClaims: one lease
+per device, heartbeat, reclaim when expired) and "process" jobs for --work_ms each.
+Faults are injected while a job is held:
+  crash: os._exit() with the lease left behind (the parent restarts the worker)
+  stall: SIGSTOP for longer than the ttl (GC pause / hung NFS); the parent SIGCONTs it
+         later and the worker must notice the lost lease and not commit
+Every commit is an O_EXCL <job>.done. At the end each job must be committed exactly once,
+and no worker may commit a job another worker started after it (overlapping holders).
+Usage:
+  python lease_stress.py --workers 6 --devices 8 --jobs 10 --crash_p 0.05 --stall_p 0.03
+  python lease_stress.py --workers 4 --ttl_sec 1.5 --keep           # keep the scratch dir
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from work_lease import try_acquire, worker_id
+
+LEASE_NAME = ".watch_lease"
+CRASH_RC = 17
+
+
+def log_event(job: Path, what: str, wid: str) -> None:
+    # one O_APPEND write per line: atomic for small lines on a local fs
+    line = json.dumps({"ts": time.time(), "ev": what, "worker": wid}) + "\n"
+    with open(str(job) + ".log", "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+def commit(job: Path, wid: str) -> bool:
+    try:
+        fd = os.open(str(job) + ".done", os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        log_event(job, "double_commit", wid)
+        return False
+    os.write(fd, (wid + "\n").encode("utf-8"))
+    os.close(fd)
+    log_event(job, "commit", wid)
+    return True
+
+
+def all_done(root: Path) -> bool:
+    return all(Path(str(job) + ".done").exists() for job in root.glob("*/job_*[0-9]"))
+
+
+def run_worker(args: argparse.Namespace) -> int:
+    root = Path(args.root)
+    rnd = random.Random(os.getpid() ^ int(time.time() * 1000))
+    wid = worker_id()
+    held: Dict[str, Any] = {}
+    while not all_done(root):
+        for dev in sorted(root.iterdir(), key=lambda _: rnd.random()):
+            if not dev.is_dir():
+                continue
+            lease = held.get(dev.name)
+            if lease is None or lease.lost.is_set():
+                lease = try_acquire(dev / LEASE_NAME, args.ttl_sec, owner=wid)
+                if lease is None:
+                    continue
+                if lease.reclaimed:
+                    log_event(dev / LEASE_NAME, "reclaimed", wid)
+                held[dev.name] = lease
+            for job in sorted(dev.glob("job_*[0-9]")):
+                if Path(str(job) + ".done").exists():
+                    continue
+                log_event(job, "start", wid)
+                ticks = max(1, args.work_ms // 10)
+                for _ in range(ticks):
+                    time.sleep(args.work_ms / 1000.0 / ticks)
+                    if rnd.random() < args.crash_p / ticks:
+                        log_event(job, "crash", wid)
+                        os._exit(CRASH_RC)
+                    if rnd.random() < args.stall_p / ticks:
+                        log_event(job, "stall", wid)
+                        os.kill(os.getpid(), signal.SIGSTOP)
+                # fence: only commit while the lease is provably ours
+                if not lease.check():
+                    log_event(job, "lost", wid)
+                    break
+                commit(job, wid)
+            lease.release()
+            held.pop(dev.name, None)
+        time.sleep(0.05)
+    return 0
+
+
+def proc_state(pid: int) -> str:
+    try:
+        return Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()[0]
+    except Exception:
+        return ""
+
+
+def verify(root: Path) -> Dict[str, Any]:
+    res: Dict[str, Any] = {
+        "jobs": 0, "committed": 0, "missing": 0, "double_commits": 0,
+        "overlaps": 0, "crashes": 0, "stalls": 0, "lost": 0, "reclaims": 0,
+    }
+    for dev in root.iterdir():
+        if not dev.is_dir():
+            continue
+        lease_log = Path(str(dev / LEASE_NAME) + ".log")
+        if lease_log.exists():
+            res["reclaims"] += len(lease_log.read_text().splitlines())
+        for job in dev.glob("job_*[0-9]"):
+            res["jobs"] += 1
+            if Path(str(job) + ".done").exists():
+                res["committed"] += 1
+            else:
+                res["missing"] += 1
+            events: List[Dict[str, Any]] = []
+            p = Path(str(job) + ".log")
+            if p.exists():
+                events = [json.loads(line) for line in p.read_text().splitlines() if line.strip()]
+            events.sort(key=lambda e: e["ts"])
+            for key, ev in (("double_commits", "double_commit"), ("crashes", "crash"), ("stalls", "stall"), ("lost", "lost")):
+                res[key] += sum(1 for e in events if e["ev"] == ev)
+            # the committer's own last start must not be followed by another worker's start
+            for i, e in enumerate(events):
+                if e["ev"] != "commit":
+                    continue
+                starts = [j for j in range(i) if events[j]["ev"] == "start" and events[j]["worker"] == e["worker"]]
+                if not starts:
+                    res["overlaps"] += 1
+                    continue
+                between = events[starts[-1] + 1:i]
+                if any(b["ev"] == "start" and b["worker"] != e["worker"] for b in between):
+                    res["overlaps"] += 1
+    res["ok"] = res["missing"] == 0 and res["double_commits"] == 0 and res["overlaps"] == 0
+    return res
+
+
+def parse_args() -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--role", default="parent", choices=["parent", "worker"])
+    ap.add_argument("--root", default="")
+    ap.add_argument("--workers", type=int, default=6)
+    ap.add_argument("--devices", type=int, default=8)
+    ap.add_argument("--jobs", type=int, default=10, help="jobs per device")
+    ap.add_argument("--work_ms", type=int, default=40)
+    ap.add_argument("--ttl_sec", type=float, default=1.5)
+    ap.add_argument("--crash_p", type=float, default=0.05, help="per job")
+    ap.add_argument("--stall_p", type=float, default=0.03, help="per job")
+    ap.add_argument("--timeout_sec", type=float, default=300.0)
+    ap.add_argument("--keep", action="store_true", help="keep the scratch dir")
+    return ap.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    if args.role == "worker":
+        return run_worker(args)
+
+    root = Path(args.root) if args.root else Path(tempfile.mkdtemp(prefix="lease_stress_"))
+    for d in range(args.devices):
+        dev = root / f"dev{d:02d}"
+        dev.mkdir(parents=True, exist_ok=True)
+        for j in range(args.jobs):
+            (dev / f"job_{j:03d}").write_text("x\n")
+
+    def spawn() -> subprocess.Popen:
+        cmd = [sys.executable, __file__, "--role", "worker", "--root", str(root),
+               "--work_ms", str(args.work_ms), "--ttl_sec", str(args.ttl_sec),
+               "--crash_p", str(args.crash_p), "--stall_p", str(args.stall_p)]
+        return subprocess.Popen(cmd)
+
+    t0 = time.time()
+    procs = [spawn() for _ in range(args.workers)]
+    stopped_at: Dict[int, float] = {}
+    restarts = 0
+    while procs and time.time() - t0 < args.timeout_sec:
+        time.sleep(0.1)
+        alive = []
+        for p in procs:
+            rc = p.poll()
+            if rc is None:
+                if proc_state(p.pid) == "T":
+                    first = stopped_at.setdefault(p.pid, time.time())
+                    if time.time() - first > args.ttl_sec * 2:
+                        os.kill(p.pid, signal.SIGCONT)
+                        stopped_at.pop(p.pid, None)
+                alive.append(p)
+            elif rc == CRASH_RC:
+                restarts += 1
+                alive.append(spawn())
+        procs = alive
+    for p in procs:
+        try:
+            os.kill(p.pid, signal.SIGCONT)
+        except OSError:
+            pass
+        p.kill()
+
+    res = verify(root)
+    res["elapsed_sec"] = round(time.time() - t0, 2)
+    res["restarts"] = restarts
+    res["workers"] = args.workers
+    res["root"] = str(root)
+    print(json.dumps(res, indent=2))
+    if not args.keep and res["ok"]:
+        shutil.rmtree(root, ignore_errors=True)
+    return 0 if res["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
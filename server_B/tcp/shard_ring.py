@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""
+Consistent-hash ring mapping device ids onto server_B backend nodes (shard_router.py).
+Each node is placed on the ring at --vnodes points (md5 of "<name>#<i>", first 8 bytes);
+a device belongs to the first point clockwise of md5(device_id). Adding or removing a
+node therefore moves only the devices between its points and their predecessors (~1/N).
+Node spec: name=host:ingest_port:actions_port, comma or newline separated ('#' comments),
+from --nodes, a --nodes_file (re-read when it changes) or WK_SHARD_NODES.
+Usage:
+  python shard_ring.py --nodes a=10.0.0.1:18080:18081,b=10.0.0.2:18080:18081 owner dev01 dev02
+  python shard_ring.py --nodes_file nodes.txt moves --add c=10.0.0.3:18080:18081 --devices 1000
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+SHARD_NODES_ENV = "WK_SHARD_NODES"
+VNODES = 128
+
+
+class Node(NamedTuple):
+    name: str
+    host: str
+    ingest_port: int
+    actions_port: int
+
+    def spec(self) -> str:
+        return f"{self.name}={self.host}:{self.ingest_port}:{self.actions_port}"
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+def parse_node(spec: str) -> Node:
+    name, sep, addr = spec.strip().partition("=")
+    parts = addr.rsplit(":", 2)
+    if not sep or not name.strip() or len(parts) != 3:
+        raise ValueError(f"bad node spec (want name=host:ingest_port:actions_port): {spec!r}")
+    return Node(name.strip(), parts[0].strip() or "127.0.0.1", int(parts[1]), int(parts[2]))
+
+
+def parse_nodes(text: str) -> List[Node]:
+    nodes: Dict[str, Node] = {}
+    for line in text.splitlines():
+        line = line.split("#", 1)[0]
+        for spec in line.split(","):
+            if spec.strip():
+                node = parse_node(spec)
+                nodes[node.name] = node
+    return list(nodes.values())
+
+
+def load_nodes(nodes: str = "", nodes_file: str = "") -> List[Node]:
+    if nodes_file:
+        return parse_nodes(Path(nodes_file).read_text(encoding="utf-8"))
+    return parse_nodes(nodes or os.environ.get(SHARD_NODES_ENV, ""))
+
+
+class HashRing:
+    def __init__(self, nodes: Iterable[Node] = (), vnodes: int = VNODES) -> None:
+        self.vnodes = max(1, vnodes)
+        self.nodes: Dict[str, Node] = {}
+        self._points: List[int] = []
+        self._owners: List[str] = []
+        for node in nodes:
+            self.nodes[node.name] = node
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        points: List[Tuple[int, str]] = []
+        for name in self.nodes:
+            points.extend((ring_hash(f"{name}#{i}"), name) for i in range(self.vnodes))
+        points.sort()
+        self._points = [p for p, _ in points]
+        self._owners = [n for _, n in points]
+
+    def add(self, node: Node) -> None:
+        self.nodes[node.name] = node
+        self._rebuild()
+
+    def remove(self, name: str) -> None:
+        if self.nodes.pop(name, None) is not None:
+            self._rebuild()
+
+    def owner(self, device_id: str) -> Optional[Node]:
+        if not self._points:
+            return None
+        i = bisect.bisect_right(self._points, ring_hash(device_id)) % len(self._points)
+        return self.nodes[self._owners[i]]
+
+    def same_nodes(self, nodes: Iterable[Node]) -> bool:
+        return sorted(self.nodes.values()) == sorted(nodes)
+
+
+def moved_devices(before: HashRing, after: HashRing, devices: Iterable[str]) -> Dict[str, Tuple[str, str]]:
+    """device -> (old owner, new owner) for devices whose owner differs."""
+    moved: Dict[str, Tuple[str, str]] = {}
+    for dev in devices:
+        a, b = before.owner(dev), after.owner(dev)
+        old, new = (a.name if a else ""), (b.name if b else "")
+        if old != new:
+            moved[dev] = (old, new)
+    return moved
+
+
+def parse_args() -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--nodes", default="", help=f"name=host:ingest_port:actions_port,... (default ${SHARD_NODES_ENV})")
+    ap.add_argument("--nodes_file", default="")
+    ap.add_argument("--vnodes", type=int, default=VNODES)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("owner", help="owner node of each device id")
+    p.add_argument("device", nargs="+")
+    p = sub.add_parser("moves", help="share of devices that change owner on a node add/remove")
+    p.add_argument("--add", default="", help="node spec to add")
+    p.add_argument("--remove", default="", help="node name to remove")
+    p.add_argument("--devices", type=int, default=1000, help="synthetic device ids dev00000..")
+    return ap.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    ring = HashRing(load_nodes(args.nodes, args.nodes_file), args.vnodes)
+    if not ring.nodes:
+        print("no nodes configured", file=sys.stderr)
+        return 2
+    if args.cmd == "owner":
+        for dev in args.device:
+            node = ring.owner(dev)
+            print(f"{dev} {node.spec() if node else '-'}")
+        return 0
+
+    after = HashRing(ring.nodes.values(), args.vnodes)
+    if args.add:
+        after.add(parse_node(args.add))
+    if args.remove:
+        after.remove(args.remove)
+    devices = [f"dev{i:05d}" for i in range(args.devices)]
+    moved = moved_devices(ring, after, devices)
+    per_node: Dict[str, int] = {}
+    for dev in devices:
+        node = after.owner(dev)
+        if node is not None:
+            per_node[node.name] = per_node.get(node.name, 0) + 1
+    flows: Dict[str, int] = {}
+    for old, new in moved.values():
+        flows[f"{old}->{new}"] = flows.get(f"{old}->{new}", 0) + 1
+    print(json.dumps({
+        "devices": len(devices),
+        "moved": len(moved),
+        "moved_share": round(len(moved) / max(1, len(devices)), 4),
+        "flows": flows,
+        "per_node_after": per_node,
+    }, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
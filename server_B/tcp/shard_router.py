@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+"""
+Front router for a device-sharded server_B: several backend nodes, each running its own
+tcp_ingest_server(.py|_async.py) + tcp_actions_server.py + watch_and_infer.py on its own
+inbox/out dirs. Device ids map onto nodes through a consistent-hash ring (shard_ring.py),
+so a board's uploads, resume state and actions all live on one node.
+- listens on the board-facing ingest (--port) and actions (--actions_port) ports, reads
+  the header block, picks the owner of DEVICE= and relays the connection to that node's
+  matching port unchanged; boards need no changes
+- --redirect: header-only requests (OP=query, OP=delta_query) get "REDIRECT=host:port"
+  instead, and uploader_nc.sh then sends the payload straight to the owner. Older
+  uploaders read it as "no resume/delta support" and fall back to a full relayed upload
+- node add/remove: edit --nodes_file (re-read when its mtime changes, or on SIGHUP).
+  Only the ~1/N devices whose owner changed move. Their partial uploads stay on the old
+  node (they restart from offset 0) and an actions poll that finds nothing on the new
+  owner is answered from the previous owner until the new one has published
+Usage:
+  python shard_router.py --nodes_file /etc/wk/shard_nodes.txt --port 18080 --actions_port 18081
+  python shard_router.py --nodes a=10.0.0.1:18080:18081,b=10.0.0.2:18080:18081 --redirect
+"""
+
+import argparse
+import asyncio
+import signal
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+from shard_ring import VNODES, HashRing, Node, load_nodes
+from tcp_ingest_server import HEADER_LIMIT, READ_CHUNK, reply_err, sanitize_token, split_headers
+
+HEADER_ONLY_OPS = ("query", "delta_query")
+EMPTY_ACTIONS = b"RUN=\nLEN=0\n\n"
+ACTIONS_REPLY_LIMIT = 16 * 1024 * 1024
+
+
+def actions_len(reply: bytes) -> int:
+    headers, _ = split_headers(reply)
+    try:
+        return int(headers.get("LEN", "0"))
+    except ValueError:
+        return 0
+
+
+class ShardRouter:
+    def __init__(self,
+                 nodes: str = "",
+                 nodes_file: str = "",
+                 vnodes: int = VNODES,
+                 redirect: bool = False,
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 30.0) -> None:
+        self.nodes = nodes
+        self.nodes_file = nodes_file
+        self.vnodes = vnodes
+        self.redirect = redirect
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.ring = HashRing(load_nodes(nodes, nodes_file), vnodes)
+        # membership before the last change: actions fallback while a moved device has
+        # not been published by its new owner yet
+        self.prev_ring: Optional[HashRing] = None
+        self._nodes_mtime = self._file_mtime()
+        self.seen: Set[str] = set()
+        self.routed: Dict[str, int] = {}
+        self.redirects = 0
+        self.errors = 0
+
+    def _file_mtime(self) -> float:
+        if not self.nodes_file:
+            return 0.0
+        try:
+            return Path(self.nodes_file).stat().st_mtime
+        except OSError:
+            return 0.0
+
+    def reload(self, force: bool = False) -> bool:
+        """Re-read --nodes_file; True when the membership changed."""
+        mtime = self._file_mtime()
+        if not self.nodes_file or (mtime == self._nodes_mtime and not force):
+            return False
+        self._nodes_mtime = mtime
+        try:
+            nodes = load_nodes(self.nodes, self.nodes_file)
+        except Exception as exc:
+            print(f"[shard_router] keep old nodes, bad {self.nodes_file}: {exc}", flush=True)
+            return False
+        if not nodes or self.ring.same_nodes(nodes):
+            return False
+        ring = HashRing(nodes, self.vnodes)
+        old_names, new_names = set(self.ring.nodes), set(ring.nodes)
+        moved = sum(1 for dev in self.seen if self.ring.owner(dev) != ring.owner(dev))
+        self.prev_ring, self.ring = self.ring, ring
+        print(
+            f"[shard_router] nodes={','.join(sorted(new_names))} "
+            f"added={','.join(sorted(new_names - old_names)) or '-'} "
+            f"removed={','.join(sorted(old_names - new_names)) or '-'} "
+            f"moved={moved}/{len(self.seen)} seen devices",
+            flush=True,
+        )
+        return True
+
+    async def reload_loop(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.reload()
+            except Exception:
+                pass
+
+    async def _read_header_block(self, reader: asyncio.StreamReader) -> bytes:
+        data = b""
+        while b"\n\n" not in data and b"\r\n\r\n" not in data:
+            chunk = await asyncio.wait_for(reader.read(512), self.read_timeout)
+            if not chunk:
+                break
+            data += chunk
+            if len(data) > HEADER_LIMIT:
+                raise ValueError("header too large")
+        return data
+
+    def _owner(self, headers: Dict[str, str]) -> Tuple[str, Optional[Node]]:
+        raw = headers.get("DEVICE", "")
+        if not raw.strip():
+            return "", None
+        device_id = sanitize_token(raw)
+        self.seen.add(device_id)
+        return device_id, self.ring.owner(device_id)
+
+    async def _connect(self, host: str, port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.wait_for(asyncio.open_connection(host, port), self.connect_timeout)
+
+    async def _pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(READ_CHUNK), self.read_timeout)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except Exception:
+            pass
+
+    async def handle_ingest(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        backend: Optional[asyncio.StreamWriter] = None
+        try:
+            data = await self._read_header_block(reader)
+            headers, _ = split_headers(data)
+            device_id, node = self._owner(headers)
+            if node is None:
+                self.errors += 1
+                writer.write(reply_err("no_backend" if device_id else ""))
+                return
+            if self.redirect and headers.get("OP", "").strip().lower() in HEADER_ONLY_OPS:
+                self.redirects += 1
+                writer.write(f"REDIRECT={node.host}:{node.ingest_port}\n".encode("utf-8"))
+                return
+            try:
+                b_reader, backend = await self._connect(node.host, node.ingest_port)
+            except Exception:
+                self.errors += 1
+                writer.write(reply_err("backend_unavailable"))
+                return
+            self.routed[node.name] = self.routed.get(node.name, 0) + 1
+            backend.write(data)
+            # board -> node until the payload is sent; node -> board until its reply is done
+            upstream = asyncio.ensure_future(self._pipe(reader, backend))
+            try:
+                await self._pipe(b_reader, writer)
+            finally:
+                upstream.cancel()
+        except Exception:
+            self.errors += 1
+        finally:
+            for w in (backend, writer):
+                if w is None:
+                    continue
+                try:
+                    await asyncio.wait_for(w.drain(), self.read_timeout)
+                except Exception:
+                    pass
+                w.close()
+
+    async def _fetch_actions(self, node: Node, request: bytes) -> bytes:
+        b_reader, b_writer = await self._connect(node.host, node.actions_port)
+        try:
+            b_writer.write(request)
+            await b_writer.drain()
+            reply = b""
+            while len(reply) <= ACTIONS_REPLY_LIMIT:
+                chunk = await asyncio.wait_for(b_reader.read(READ_CHUNK), self.read_timeout)
+                if not chunk:
+                    break
+                reply += chunk
+            return reply
+        finally:
+            b_writer.close()
+
+    async def handle_actions(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        reply = EMPTY_ACTIONS
+        try:
+            data = await self._read_header_block(reader)
+            headers, _ = split_headers(data)
+            device_id, node = self._owner(headers)
+            if node is None:
+                self.errors += 1
+                return
+            self.routed[node.name] = self.routed.get(node.name, 0) + 1
+            try:
+                reply = await self._fetch_actions(node, data)
+            except Exception:
+                self.errors += 1
+                reply = EMPTY_ACTIONS
+            prev = self.prev_ring.owner(device_id) if self.prev_ring is not None else None
+            if actions_len(reply) == 0 and prev is not None and prev != node:
+                try:
+                    older = await self._fetch_actions(prev, data)
+                    if actions_len(older) > 0:
+                        reply = older
+                except Exception:
+                    pass
+        except Exception:
+            self.errors += 1
+        finally:
+            try:
+                writer.write(reply)
+                await asyncio.wait_for(writer.drain(), self.read_timeout)
+            except Exception:
+                pass
+            writer.close()
+
+
+def parse_args() -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=18080, help="board-facing ingest port")
+    ap.add_argument("--actions_port", type=int, default=18081, help="board-facing actions port; 0 disables")
+    ap.add_argument("--nodes", default="", help="name=host:ingest_port:actions_port,... (default $WK_SHARD_NODES)")
+    ap.add_argument("--nodes_file", default="", help="same specs, one per line; re-read when it changes")
+    ap.add_argument("--vnodes", type=int, default=VNODES)
+    ap.add_argument("--redirect", action="store_true",
+                    help="answer OP=query / OP=delta_query with REDIRECT=host:port instead of relaying")
+    ap.add_argument("--reload_sec", type=float, default=2.0)
+    ap.add_argument("--connect_timeout_sec", type=float, default=5.0)
+    ap.add_argument("--read_timeout_sec", type=float, default=30.0)
+    ap.add_argument("--backlog", type=int, default=512)
+    return ap.parse_args()
+
+
+async def serve(args: argparse.Namespace) -> None:
+    router = ShardRouter(args.nodes, args.nodes_file, args.vnodes, args.redirect,
+                         args.connect_timeout_sec, args.read_timeout_sec)
+    if not router.ring.nodes:
+        raise SystemExit("[shard_router] no backend nodes (--nodes, --nodes_file or $WK_SHARD_NODES)")
+
+    servers = [await asyncio.start_server(router.handle_ingest, args.host, args.port,
+                                          backlog=args.backlog, reuse_address=True)]
+    if args.actions_port > 0:
+        servers.append(await asyncio.start_server(router.handle_actions, args.host, args.actions_port,
+                                                  backlog=args.backlog, reuse_address=True))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        loop.add_signal_handler(signal.SIGHUP, router.reload, True)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+    print(
+        f"[shard_router] listen {args.host}:{args.port} actions={args.actions_port or '-'} "
+        f"nodes={','.join(n.spec() for n in router.ring.nodes.values())} redirect={int(args.redirect)}",
+        flush=True,
+    )
+    reloader = asyncio.create_task(router.reload_loop(args.reload_sec))
+    await stop.wait()
+    reloader.cancel()
+    for srv in servers:
+        srv.close()
+        await srv.wait_closed()
+    print(f"[shard_router] stopped routed={router.routed} redirects={router.redirects} errors={router.errors}", flush=True)
+
+
+def main() -> None:
+    asyncio.run(serve(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
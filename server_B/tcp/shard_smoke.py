@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""
+Smoke test for device sharding (shard_ring.py + shard_router.py) with local processes.
+Starts --nodes backend pairs (tcp_ingest_server.py + tcp_actions_server.py, own inbox/out
+each, consecutive ports from --base_port) and shard_router.py in front of them, then:
+  1. uploads one bundle per device through the router and checks it landed only in the
+     owner node's inbox; polls actions through the router and checks the owner answered
+  2. checks OP=query gets REDIRECT=<owner> from a second router started with --redirect
+  3. adds a node (rewrites the nodes file), re-uploads, checks that only devices whose
+     owner changed land elsewhere, all of them on the new node, ~1/(N+1) of them
+  4. removes a node: only its devices move, and their actions polls are still answered
+     from the old owner until the new owner publishes
+Usage:
+  python shard_smoke.py --nodes 3 --devices 60
+  python shard_smoke.py --nodes 4 --devices 200 --keep
+"""
+
+import argparse
+import json
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from ingest_load_test import make_bundle, upload, wait_port
+from shard_ring import HashRing, Node, moved_devices
+
+HERE = Path(__file__).resolve().parent
+
+
+def request(host: str, port: int, header: str, timeout: float = 10.0) -> str:
+    with socket.create_connection((host, port), timeout=timeout) as s:
+        s.sendall(header.encode("utf-8"))
+        resp = b""
+        while True:
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            resp += chunk
+    return resp.decode("utf-8", errors="ignore")
+
+
+def poll_actions(port: int, device: str) -> str:
+    """Body of the actions reply (the answering node writes its name there)."""
+    resp = request("127.0.0.1", port, f"DEVICE={device}\n\n")
+    return resp.split("\n\n", 1)[1].strip() if "\n\n" in resp else ""
+
+
+class Cluster:
+    def __init__(self, root: Path, base_port: int) -> None:
+        self.root = root
+        self.base_port = base_port
+        self.nodes: Dict[str, Node] = {}
+        self.procs: Dict[str, List[subprocess.Popen]] = {}
+        self.routers: List[subprocess.Popen] = []
+        self.nodes_file = root / "nodes.txt"
+
+    def inbox(self, name: str) -> Path:
+        return self.root / name / "inbox"
+
+    def out(self, name: str) -> Path:
+        return self.root / name / "out"
+
+    def start_node(self, idx: int) -> Node:
+        name = f"node{idx}"
+        node = Node(name, "127.0.0.1", self.base_port + 10 + 2 * idx, self.base_port + 11 + 2 * idx)
+        self.inbox(name).mkdir(parents=True, exist_ok=True)
+        self.out(name).mkdir(parents=True, exist_ok=True)
+        self.procs[name] = [
+            subprocess.Popen([sys.executable, str(HERE / "tcp_ingest_server.py"), "--host", "127.0.0.1",
+                              "--port", str(node.ingest_port), "--inbox", str(self.inbox(name)),
+                              "--admit_max_queue", "0", "--admit_device_rate_per_min", "0"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+            subprocess.Popen([sys.executable, str(HERE / "tcp_actions_server.py"), "--host", "127.0.0.1",
+                              "--port", str(node.actions_port), "--out", str(self.out(name))],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+        ]
+        for port in (node.ingest_port, node.actions_port):
+            if not wait_port("127.0.0.1", port):
+                raise RuntimeError(f"{name} did not start on {port}")
+        self.nodes[name] = node
+        return node
+
+    def write_nodes(self) -> None:
+        tmp = self.nodes_file.with_suffix(".tmp")
+        tmp.write_text("".join(n.spec() + "\n" for n in self.nodes.values()), encoding="utf-8")
+        tmp.replace(self.nodes_file)
+
+    def start_router(self, port: int, actions_port: int, redirect: bool = False) -> None:
+        cmd = [sys.executable, str(HERE / "shard_router.py"), "--host", "127.0.0.1", "--port", str(port),
+               "--actions_port", str(actions_port), "--nodes_file", str(self.nodes_file), "--reload_sec", "0.2"]
+        if redirect:
+            cmd.append("--redirect")
+        self.routers.append(subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        for p in (port, actions_port):
+            if not wait_port("127.0.0.1", p):
+                raise RuntimeError(f"router did not start on {p}")
+
+    def publish_actions(self, name: str, device: str) -> None:
+        # what watch_and_infer.py would write after processing the device's bundle
+        d = self.out(name) / device
+        d.mkdir(parents=True, exist_ok=True)
+        (d / "latest_actions_device.txt").write_text(f"{name}\n", encoding="utf-8")
+        (d / "latest_run_id.txt").write_text("run_smoke\n", encoding="utf-8")
+
+    def holders(self, device: str, run: str) -> List[str]:
+        return sorted(name for name in self.nodes if any((self.inbox(name) / device).glob(f"{run}__*")))
+
+    def stop(self) -> None:
+        for p in self.routers + [p for ps in self.procs.values() for p in ps]:
+            p.terminate()
+        for p in self.routers + [p for ps in self.procs.values() for p in ps]:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+
+def upload_round(cl: Cluster, port: int, devices: List[str], run: str, payload: bytes) -> Dict[str, Any]:
+    ring = HashRing(cl.nodes.values())
+    res: Dict[str, Any] = {"ok": 0, "misrouted": [], "errors": []}
+    for dev in devices:
+        reply = upload("127.0.0.1", port, dev, run, payload, 30.0)
+        if reply != "OK":
+            res["errors"].append(f"{dev}:{reply}")
+            continue
+        res["ok"] += 1
+        owner = ring.owner(dev)
+        if cl.holders(dev, run) != [owner.name if owner else ""]:
+            res["misrouted"].append(dev)
+    return res
+
+
+def wait_reload(port: int, device: str, expect: str, timeout: float = 5.0) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if poll_actions(port, device) == expect:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--nodes", type=int, default=3)
+    ap.add_argument("--devices", type=int, default=60)
+    ap.add_argument("--base_port", type=int, default=28300)
+    ap.add_argument("--keep", action="store_true", help="keep the scratch dir")
+    args = ap.parse_args()
+
+    root = Path(tempfile.mkdtemp(prefix="shard_smoke_"))
+    cl = Cluster(root, args.base_port)
+    port, actions_port = args.base_port, args.base_port + 1
+    devices = [f"board{i:03d}" for i in range(args.devices)]
+    payload = make_bundle(4)
+    out: Dict[str, Any] = {"root": str(root)}
+    ok = True
+    try:
+        for i in range(args.nodes):
+            cl.start_node(i)
+        cl.write_nodes()
+        cl.start_router(port, actions_port)
+        cl.start_router(args.base_port + 2, args.base_port + 3, redirect=True)
+
+        # 1. routing
+        before = HashRing(cl.nodes.values())
+        for dev in devices:
+            cl.publish_actions(before.owner(dev).name, dev)
+        r1 = upload_round(cl, port, devices, "run_a", payload)
+        wrong_actions = [d for d in devices if poll_actions(actions_port, d) != before.owner(d).name]
+        per_node = {n: sum(1 for d in devices if before.owner(d).name == n) for n in cl.nodes}
+        out["route"] = {"upload": r1, "actions_misrouted": wrong_actions, "per_node": per_node}
+        ok &= r1["ok"] == len(devices) and not r1["misrouted"] and not wrong_actions
+
+        # 2. redirect
+        dev = devices[0]
+        owner = before.owner(dev)
+        reply = request("127.0.0.1", args.base_port + 2,
+                        f"TYPE=bundle\nDEVICE={dev}\nRUN=run_q\nLEN=10\nOP=query\n\n").strip()
+        out["redirect"] = reply
+        ok &= reply == f"REDIRECT={owner.host}:{owner.ingest_port}"
+
+        # 3. add a node
+        cl.start_node(args.nodes)
+        cl.write_nodes()
+        after_add = HashRing(cl.nodes.values())
+        moved = moved_devices(before, after_add, devices)
+        new_name = f"node{args.nodes}"
+        if moved:
+            probe = next(iter(moved))
+            cl.publish_actions(new_name, probe)
+            ok &= wait_reload(actions_port, probe, new_name)
+        r3 = upload_round(cl, port, devices, "run_b", payload)
+        out["add"] = {
+            "upload": r3,
+            "moved": len(moved),
+            "moved_share": round(len(moved) / len(devices), 3),
+            "moved_not_to_new_node": [d for d, (_, new) in moved.items() if new != new_name],
+        }
+        ok &= r3["ok"] == len(devices) and not r3["misrouted"] and not out["add"]["moved_not_to_new_node"]
+
+        # 4. remove a node
+        gone = "node0"
+        del cl.nodes[gone]
+        cl.write_nodes()
+        after_rm = HashRing(cl.nodes.values())
+        moved = moved_devices(after_add, after_rm, devices)
+        time.sleep(1.0)  # router reload (--reload_sec 0.2)
+        # nothing published on the new owners yet: the old owner still answers the polls
+        fallback_wrong = [d for d in moved if poll_actions(actions_port, d) != moved[d][0]]
+        r4 = upload_round(cl, port, devices, "run_c", payload)
+        out["remove"] = {
+            "upload": r4,
+            "moved": len(moved),
+            "moved_not_from_removed": [d for d, (old, _) in moved.items() if old != gone],
+            "actions_fallback_wrong": fallback_wrong,
+        }
+        ok &= (r4["ok"] == len(devices) and not r4["misrouted"]
+               and not out["remove"]["moved_not_from_removed"] and not fallback_wrong)
+    finally:
+        cl.stop()
+    out["ok"] = bool(ok)
+    print(json.dumps(out, indent=2))
+    if not args.keep and ok:
+        shutil.rmtree(root, ignore_errors=True)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
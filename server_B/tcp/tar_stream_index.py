@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+
+"""
+Incremental tar.gz / tar.zst validation + member index, fed chunk by chunk while an upload is received.
+- gzip: zlib.decompressobj (CRC32/ISIZE of every gzip member checked at its end)
+- zstd: zstandard decompressobj per frame (optional dependency); frames made with a trained
+        dictionary are decoded with the matching <dict_id>.zdict from $WK_ZSTD_DICT_DIR
+- tar : 512-byte headers parsed with tarfile.TarInfo.frombuf (checksum checked), GNU
+        longname/longlink and pax path/size/mtime records applied, member data skipped
+Nothing is buffered beyond one header block (or one GNU/pax extension record).
+Decompression output is bounded per step (INFLATE_CHUNK / ZSTD_IN_SLICE) and the stream is
+rejected once it inflates past $WK_BUNDLE_MAX_UNCOMPRESSED_MB (decompression bombs).
+The index is written next to the upload as <name>.index.json before the .done marker.
+"""
+
+import json
+import os
+import tarfile
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+try:
+    import zstandard
+except ImportError:  # zstd bundles are optional; gzip needs nothing beyond the stdlib
+    zstandard = None
+
+INDEX_SCHEMA = 1
+INDEX_SUFFIX = ".index.json"
+BLOCK = tarfile.BLOCKSIZE
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+ZSTD_FRAME_HEADER_MAX = 18
+ZSTD_DICT_DIR_ENV = "WK_ZSTD_DICT_DIR"
+ZSTD_DICT_SUFFIX = ".zdict"
+# ENC= header value -> inbox file extension
+ENC_EXT = {"gzip": ".tar.gz", "zstd": ".tar.zst"}
+# largest GNU longname / pax header payload we agree to buffer
+MAX_EXT_HEADER = 1024 * 1024
+# gzip: output bytes per zlib decompress() step
+INFLATE_CHUNK = 1024 * 1024
+# zstd: zstandard's decompressobj has no output bound, so input goes in small slices
+# (an RLE block expands ~32000:1: one slice yields at most ~8 MiB)
+ZSTD_IN_SLICE = 256
+MAX_UNCOMPRESSED = int(float(os.environ.get("WK_BUNDLE_MAX_UNCOMPRESSED_MB", "1024")) * 1024 * 1024)
+EXT_TYPES = (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK, tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.SOLARIS_XHDTYPE)
+
+
+class TarStreamError(Exception):
+    pass
+
+
+class TarStreamTooLarge(TarStreamError):
+    pass
+
+
+_zstd_dicts: Optional[Dict[int, Any]] = None
+
+
+def zstd_available() -> bool:
+    return zstandard is not None
+
+
+def load_zstd_dicts(dict_dir: Optional[str] = None) -> Dict[int, Any]:
+    """dict_id -> ZstdCompressionDict for every *.zdict in dict_dir ($WK_ZSTD_DICT_DIR); loaded once."""
+    global _zstd_dicts
+    if dict_dir is None and _zstd_dicts is not None:
+        return _zstd_dicts
+    out: Dict[int, Any] = {}
+    root = dict_dir if dict_dir is not None else os.environ.get(ZSTD_DICT_DIR_ENV, "")
+    if zstandard is not None and root and Path(root).is_dir():
+        for p in sorted(Path(root).glob("*" + ZSTD_DICT_SUFFIX)):
+            try:
+                d = zstandard.ZstdCompressionDict(p.read_bytes())
+                out[d.dict_id()] = d
+            except Exception:
+                continue
+    if dict_dir is None:
+        _zstd_dicts = out
+    return out
+
+
+def zstd_frame_dict_id(head: bytes) -> int:
+    """Dictionary id of the frame starting at head (>= ZSTD_FRAME_HEADER_MAX bytes or the whole input)."""
+    if zstandard is None:
+        raise TarStreamError("zstd not supported (python zstandard missing)")
+    try:
+        return zstandard.get_frame_parameters(head).dict_id
+    except zstandard.ZstdError:
+        raise TarStreamError("bad zstd frame header")
+
+
+def zstd_decompressor_for(dict_id: int, dicts: Optional[Dict[int, Any]] = None) -> Any:
+    if zstandard is None:
+        raise TarStreamError("zstd not supported (python zstandard missing)")
+    if not dict_id:
+        return zstandard.ZstdDecompressor()
+    d = (load_zstd_dicts() if dicts is None else dicts).get(dict_id)
+    if d is None:
+        raise TarStreamError(f"unknown zstd dictionary {dict_id}")
+    return zstandard.ZstdDecompressor(dict_data=d)
+
+
+def _blocks(size: int) -> int:
+    return ((size + BLOCK - 1) // BLOCK) * BLOCK
+
+
+def _parse_pax(buf: bytes) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    pos = 0
+    while pos < len(buf):
+        sp = buf.find(b" ", pos)
+        if sp < 0:
+            break
+        try:
+            length = int(buf[pos:sp])
+        except ValueError:
+            raise TarStreamError("bad pax header")
+        if length <= 0:
+            raise TarStreamError("bad pax header")
+        rec = buf[sp + 1:pos + length - 1]
+        pos += length
+        if b"=" not in rec:
+            continue
+        k, v = rec.split(b"=", 1)
+        out[k.decode("utf-8", "surrogateescape")] = v.decode("utf-8", "surrogateescape")
+    return out
+
+
+def zstd_stream_reader(f: Any, dicts: Optional[Dict[int, Any]] = None) -> Any:
+    """Decompressing reader over a seekable .tar.zst file object (all frames), for tarfile mode "r|"."""
+    head = f.read(ZSTD_FRAME_HEADER_MAX)
+    f.seek(0)
+    if head[:len(ZSTD_MAGIC)] != ZSTD_MAGIC:
+        raise TarStreamError("not a zstd stream")
+    dctx = zstd_decompressor_for(zstd_frame_dict_id(head), dicts)
+    return dctx.stream_reader(f, read_across_frames=True)
+
+
+class TarStreamIndexer:
+    """
+    feed() compressed chunks, then finish(); errors are recorded, never raised from feed().
+    enc is what the uploader declared (ENC= header); the stream magic must agree with it.
+    """
+
+    def __init__(self,
+                 enc: str = "gzip",
+                 zstd_dicts: Optional[Dict[int, Any]] = None,
+                 max_uncompressed: Optional[int] = None) -> None:
+        self.enc = enc
+        self.error: Optional[str] = None
+        self.too_large = False
+        # 0 = unlimited
+        self.max_uncompressed = MAX_UNCOMPRESSED if max_uncompressed is None else max_uncompressed
+        self.members: List[Dict[str, Any]] = []
+        self.compressed_size = 0
+        self.uncompressed_size = 0
+        self._z: Optional[Any] = None
+        self._head = b""
+        self._frames = 0
+        self._zstd_dicts = zstd_dicts
+        self._zstd_dict_id = 0
+        self._buf = bytearray()
+        self._skip = 0  # member data bytes still to skip
+        self._ext_type: Optional[bytes] = None
+        self._ext_need = 0
+        self._ext_pad = 0
+        self._pending: Dict[str, str] = {}
+        self._global: Dict[str, str] = {}
+        self._ext_start: Optional[int] = None  # member offset = its first GNU/pax header (tarfile semantics)
+        self._end = False
+        self._header_seen = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def feed(self, chunk: bytes) -> None:
+        if self.error is not None or not chunk:
+            return
+        self.compressed_size += len(chunk)
+        try:
+            if self._z is None:
+                self._head += chunk
+                chunk = self._start(final=False)
+                if not chunk:
+                    return
+            self._inflate(chunk)
+        except Exception as exc:
+            # zlib.error / ZstdError / TarError / TarStreamError: the upload is not a valid bundle
+            self.error = str(exc) or type(exc).__name__
+            self.too_large = isinstance(exc, TarStreamTooLarge)
+
+    def _start(self, final: bool) -> bytes:
+        """Pick the decompressor once enough of the stream head is buffered; returns the buffered bytes."""
+        head = self._head
+        if self.enc == "zstd":
+            if len(head) < ZSTD_FRAME_HEADER_MAX and not final:
+                return b""
+            if head[:len(ZSTD_MAGIC)] != ZSTD_MAGIC:
+                if not self._frames:
+                    raise TarStreamError("not a zstd stream")
+                if head.strip(b"\x00"):
+                    raise TarStreamError("trailing garbage after zstd stream")
+                self._head = b""  # zero padding after the last frame
+                return b""
+            self._zstd_dict_id = zstd_frame_dict_id(head)
+            self._z = zstd_decompressor_for(self._zstd_dict_id, self._zstd_dicts).decompressobj()
+        else:
+            if len(head) < len(GZIP_MAGIC):
+                return b""
+            if head[:len(GZIP_MAGIC)] != GZIP_MAGIC:
+                raise TarStreamError("not a gzip stream")
+            self._z = zlib.decompressobj(31)
+        self._frames += 1
+        self._head = b""
+        return head
+
+    def _inflate(self, data: bytes) -> None:
+        full = False
+        while data or full:
+            if self.enc == "zstd":
+                piece, data = data[:ZSTD_IN_SLICE], data[ZSTD_IN_SLICE:]
+                out = self._z.decompress(piece)
+            else:
+                # a full output chunk may leave more pending output even with no input left
+                out = self._z.decompress(data, INFLATE_CHUNK)
+                data = self._z.unconsumed_tail
+                full = len(out) == INFLATE_CHUNK
+            if out:
+                self._tar(out)
+            if not self._z.eof:
+                continue
+            full = False
+            data = self._z.unused_data + data
+            if self.enc == "zstd":
+                # a finished zstd decompressobj cannot be reused: every frame gets its own (and may
+                # name its own dictionary); the next frame header may still be split across chunks
+                self._z = None
+                self._head = data
+                data = self._start(final=False)
+                continue
+            if data:
+                # concatenated gzip members (`cat a.gz b.gz`, multi-member writers)
+                if data[:1] != GZIP_MAGIC[:1]:
+                    if data.strip(b"\x00"):
+                        raise TarStreamError("trailing garbage after gzip stream")
+                    return
+                self._z = zlib.decompressobj(31)
+                self._frames += 1
+
+    def _tar(self, data: bytes) -> None:
+        self.uncompressed_size += len(data)
+        if self.max_uncompressed and self.uncompressed_size > self.max_uncompressed:
+            raise TarStreamTooLarge(f"uncompressed size over {self.max_uncompressed} bytes")
+        view = memoryview(data)
+        pos = 0
+        n = len(view)
+        while pos < n:
+            if self._skip:
+                take = min(self._skip, n - pos)
+                self._skip -= take
+                pos += take
+                continue
+            if self._end:
+                # after the end-of-archive marker only zero padding is allowed (ignored like tarfile does)
+                return
+            if self._ext_type is not None:
+                take = min(self._ext_need - len(self._buf), n - pos)
+                self._buf += view[pos:pos + take]
+                pos += take
+                if len(self._buf) == self._ext_need:
+                    self._apply_ext(bytes(self._buf))
+                    self._buf.clear()
+                    self._ext_type = None
+                    self._skip = self._ext_pad
+                continue
+            take = min(BLOCK - len(self._buf), n - pos)
+            self._buf += view[pos:pos + take]
+            pos += take
+            if len(self._buf) == BLOCK:
+                block = bytes(self._buf)
+                self._buf.clear()
+                self._header(block, self.uncompressed_size - (n - pos) - BLOCK)
+
+    def _header(self, block: bytes, offset: int) -> None:
+        if block.count(0) == BLOCK:
+            self._end = True
+            return
+        ti = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+        self._header_seen = True
+        if ti.type in EXT_TYPES:
+            if self._ext_start is None:
+                self._ext_start = offset
+            if ti.size > MAX_EXT_HEADER:
+                raise TarStreamError("extended header too large")
+            self._ext_type = ti.type
+            self._ext_need = ti.size
+            self._ext_pad = _blocks(ti.size) - ti.size
+            if ti.size == 0:
+                self._apply_ext(b"")
+                self._ext_type = None
+            return
+
+        name = ti.name
+        linkname = ti.linkname
+        size = ti.size
+        mtime = ti.mtime
+        ext = dict(self._global)
+        ext.update(self._pending)
+        self._pending = {}
+        if "path" in ext:
+            name = ext["path"]
+        if "linkpath" in ext:
+            linkname = ext["linkpath"]
+        if "size" in ext:
+            try:
+                size = int(ext["size"])
+            except ValueError:
+                raise TarStreamError("bad pax size")
+        if "mtime" in ext:
+            try:
+                mtime = int(float(ext["mtime"]))
+            except ValueError:
+                pass
+        if ti.type == tarfile.DIRTYPE:
+            name = name.rstrip("/")
+
+        self.members.append({
+            "name": name,
+            "type": ti.type.decode("ascii", "replace"),
+            "size": size,
+            "mode": ti.mode,
+            "mtime": mtime,
+            "offset": offset if self._ext_start is None else self._ext_start,
+            "offset_data": offset + BLOCK,
+            "linkname": linkname or None,
+        })
+        self._ext_start = None
+        # same rule as tarfile: data follows regular files and unknown types only
+        if ti.isreg() or ti.type not in tarfile.SUPPORTED_TYPES:
+            self._skip = _blocks(size)
+
+    def _apply_ext(self, buf: bytes) -> None:
+        if self._ext_type == tarfile.GNUTYPE_LONGNAME:
+            self._pending["path"] = buf.split(b"\x00", 1)[0].decode("utf-8", "surrogateescape")
+        elif self._ext_type == tarfile.GNUTYPE_LONGLINK:
+            self._pending["linkpath"] = buf.split(b"\x00", 1)[0].decode("utf-8", "surrogateescape")
+        elif self._ext_type == tarfile.XGLTYPE:
+            self._global.update(_parse_pax(buf))
+        else:
+            self._pending.update(_parse_pax(buf))
+
+    def finish(self) -> bool:
+        if self.error is None and self._z is None and self._head:
+            try:
+                self._inflate(self._start(final=True))
+            except Exception as exc:
+                self.error = str(exc) or type(exc).__name__
+        if self.error is None:
+            if self._z is None and not self._frames:
+                self.error = "empty file" if not self.compressed_size else f"not a {self.enc} stream"
+            elif self._z is not None and not self._z.eof:
+                self.error = f"unexpected end of {self.enc} stream"
+            elif self._skip or self._buf or self._ext_type is not None:
+                if not self._end:
+                    self.error = "unexpected end of data"
+            elif not self._header_seen:
+                self.error = "empty archive"
+        return self.error is None
+
+    def to_index(self, dest: Path, sha256: Optional[str] = None) -> Dict[str, Any]:
+        try:
+            st = dest.stat()
+            mtime_ns: Optional[int] = st.st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        return {
+            "schema": INDEX_SCHEMA,
+            "format": "tar.zst" if self.enc == "zstd" else "tar.gz",
+            "file": dest.name,
+            "compressed_size": self.compressed_size,
+            "uncompressed_size": self.uncompressed_size,
+            "gzip_members": self._frames if self.enc != "zstd" else 0,
+            "zstd_frames": self._frames if self.enc == "zstd" else 0,
+            "zstd_dict_id": self._zstd_dict_id or None,
+            "file_mtime_ns": mtime_ns,
+            "sha256": sha256,
+            "members": self.members,
+        }
+
+
+def index_from_tarfile(dest: Path, sha256: Optional[str] = None) -> Dict[str, Any]:
+    """Slow path for non-gzip tars (tar/bz2/xz): same index shape from tarfile.getmembers()."""
+    with tarfile.open(dest, "r:*") as tar:
+        infos = tar.getmembers()
+    st = dest.stat()
+    return {
+        "schema": INDEX_SCHEMA,
+        "format": "tar",
+        "file": dest.name,
+        "compressed_size": st.st_size,
+        "uncompressed_size": None,
+        "gzip_members": 0,
+        "zstd_frames": 0,
+        "zstd_dict_id": None,
+        "file_mtime_ns": st.st_mtime_ns,
+        "sha256": sha256,
+        "members": [
+            {
+                "name": ti.name,
+                "type": ti.type.decode("ascii", "replace"),
+                "size": ti.size,
+                "mode": ti.mode,
+                "mtime": int(ti.mtime),
+                "offset": ti.offset,
+                "offset_data": ti.offset_data,
+                "linkname": ti.linkname or None,
+            }
+            for ti in infos
+        ],
+    }
+
+
+def write_index(dest: Path, index: Dict[str, Any]) -> Path:
+    path = Path(str(dest) + INDEX_SUFFIX)
+    tmp = Path(str(path) + ".tmp")
+    tmp.write_text(json.dumps(index, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    os.replace(tmp, path)
+    return path
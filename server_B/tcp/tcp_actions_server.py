@@ -6,7 +6,7 @@ import re
 import socket
 import threading
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Dict, Set, Tuple
 
 
 HEADER_LIMIT = 2048
@@ -43,6 +43,14 @@ def read_headers(conn: socket.socket) -> Tuple[Dict[str, str], bytes]:
     return headers, rest
 
 
+def read_run_ids(device_dir: Path) -> Set[str]:
+    p = device_dir / "latest_run_ids.txt"
+    try:
+        return {ln.strip() for ln in p.read_text(encoding="utf-8", errors="ignore").splitlines() if ln.strip()}
+    except OSError:
+        return set()
+
+
 def handle_conn(conn: socket.socket, addr, out_root: Path) -> None:
     try:
         headers, _rest = read_headers(conn)
@@ -57,6 +65,10 @@ def handle_conn(conn: socket.socket, addr, out_root: Path) -> None:
         run_id = ""
         if run_id_path.exists():
             run_id = run_id_path.read_text(encoding="utf-8", errors="ignore").strip()
+        # RUN=<id> (optional): the latest actions also answer the older runs coalesced into them
+        want = headers.get("RUN", "")
+        if want and want != run_id and want in read_run_ids(device_dir):
+            run_id = want
 
         if not actions_path.exists():
             conn.sendall(f"RUN={run_id}\nLEN=0\n\n".encode("utf-8"))
@@ -103,4 +115,4 @@ def main() -> None:
 
 
 if __name__ == "__main__":
-    main()
+    main()
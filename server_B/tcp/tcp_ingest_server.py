@@ -1,16 +1,48 @@
 #!/usr/bin/env python3
 
 import argparse
+import fcntl
+import hashlib
+import json
 import os
-import tarfile
 import re
+import shutil
 import socket
+import tempfile
 import threading
+import time
 from pathlib import Path
-from typing import Dict, Tuple
-
-
+from typing import Any, Dict, List, Optional, Tuple
+
+from bundle_index import claim_bundle, dedupe_enabled, mark_duplicate
+from ingest_admission import (
+    BUSY_LINGER_BYTES,
+    BUSY_LINGER_SEC,
+    AdmissionControl,
+    add_admission_args,
+    admission_from_args,
+    reply_busy,
+)
+from job_ledger import STATE_RECEIVED, STATE_STORED, markers_enabled, open_ledger
+from tar_stream_index import ENC_EXT, TarStreamIndexer, index_from_tarfile, write_index, zstd_available
+
+
+TAR_KINDS = ("bundle", "action_result")
 HEADER_LIMIT = 4096
+MAX_PAYLOAD = 1024 * 1024 * 1024
+READ_CHUNK = 65536
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+# resumable uploads: partial payloads live in <device_dir>/.partial until completed or expired
+PARTIAL_DIR = ".partial"
+PARTIAL_TTL_SEC = 24 * 3600
+PARTIAL_SWEEP_SEC = 600
+# delta uploads: last ingested copy of each append-only daily file, per device
+# (maintained by server_B/ingest/ingest_bundle.py; same location rule and tail size there)
+DELTA_BASE_DIR_ENV = "WK_DELTA_BASE_DIR"
+DELTA_TAIL_BYTES = 4096
+DELTA_MAX_FILES = 16
+# <upload>.delta_base/: the bases a delta upload was verified against, pinned at commit time
+DELTA_PIN_SUFFIX = ".delta_base"
 
 
 def sanitize_token(val: str) -> str:
@@ -19,7 +51,6 @@ def sanitize_token(val: str) -> str:
 
 def read_headers(conn: socket.socket) -> Tuple[Dict[str, str], bytes]:
     data = b""
-    headers: Dict[str, str] = {}
     conn.settimeout(30)
     while b"\n\n" not in data and b"\r\n\r\n" not in data:
         chunk = conn.recv(512)
@@ -29,6 +60,11 @@ def read_headers(conn: socket.socket) -> Tuple[Dict[str, str], bytes]:
         if len(data) > HEADER_LIMIT:
             raise ValueError("header too large")
 
+    return split_headers(data)
+
+
+def split_headers(data: bytes) -> Tuple[Dict[str, str], bytes]:
+    headers: Dict[str, str] = {}
     if b"\r\n\r\n" in data:
         header_bytes, rest = data.split(b"\r\n\r\n", 1)
     else:
@@ -44,86 +80,608 @@ def read_headers(conn: socket.socket) -> Tuple[Dict[str, str], bytes]:
     return headers, rest
 
 
-def read_exact(conn: socket.socket, need: int, first: bytes) -> bytes:
-    if need <= 0:
-        return b""
-    buf = bytearray(first[:need])
-    while len(buf) < need:
-        chunk = conn.recv(min(65536, need - len(buf)))
-        if not chunk:
-            break
-        buf.extend(chunk)
-    return bytes(buf)
+class UploadRequest:
+    __slots__ = ("kind", "device_id", "run_id", "length", "sha256", "op", "offset", "resume", "enc", "delta")
+
+    def __init__(self,
+                 kind: str,
+                 device_id: str,
+                 run_id: str,
+                 length: int,
+                 sha256: Optional[str],
+                 op: str = "upload",
+                 offset: Optional[int] = None,
+                 resume: bool = False,
+                 enc: str = "gzip",
+                 delta: Optional[List[Tuple[str, int, str]]] = None) -> None:
+        self.kind = kind
+        self.device_id = device_id
+        self.run_id = run_id
+        self.length = length
+        self.sha256 = sha256
+        self.op = op
+        self.offset = offset
+        self.resume = resume
+        self.enc = enc
+        self.delta = delta or []
+
+
+class UploadError(Exception):
+    """Upload rejected once the request was accepted; str(exc) is the reply reason."""
+
+
+def parse_upload_headers(headers: Dict[str, str]) -> Optional[UploadRequest]:
+    """Validated request, or None when it must be rejected before reading the payload."""
+    kind = sanitize_token(headers.get("TYPE", ""))
+    device_id = sanitize_token(headers.get("DEVICE", ""))
+    run_id = sanitize_token(headers.get("RUN", ""))
+    length_raw = headers.get("LEN", "0")
+    try:
+        length = int(length_raw)
+    except ValueError:
+        length = -1
+
+    if not kind or not device_id or not run_id or length < 0:
+        return None
+    if length > MAX_PAYLOAD:
+        return None
+    # optional: board-side sha256 of the payload, verified before the rename
+    sha256 = headers.get("SHA256", "").strip().lower() or None
+    if sha256 is not None and not SHA256_RE.match(sha256):
+        return None
+    # optional resumable extension: OP=query asks for the committed offset, OFFSET=<n>
+    # sends payload bytes [n, LEN) of a partial upload, RESUME=1 keeps the partial on a drop
+    op = headers.get("OP", "upload").strip().lower() or "upload"
+    if op not in ("upload", "query"):
+        return None
+    offset: Optional[int] = None
+    if "OFFSET" in headers:
+        try:
+            offset = int(headers["OFFSET"])
+        except ValueError:
+            return None
+        if offset < 0 or offset > length:
+            return None
+    resume = op == "query" or offset is not None or headers.get("RESUME", "").strip() == "1"
+    # optional: ENC=zstd for .tar.zst bundles (default gzip, the only encoding old boards send)
+    enc = headers.get("ENC", "gzip").strip().lower() or "gzip"
+    if enc not in ENC_EXT or (enc == "zstd" and not zstd_available()):
+        return None
+    # optional: DELTA=<file>:<base_len>:<tail_sha256>[,...] for files sent as appended bytes only
+    delta = parse_delta_header(headers.get("DELTA", ""))
+    if delta is None:
+        return None
+    return UploadRequest(kind, device_id, run_id, length, sha256, op, offset, resume, enc, delta)
+
+
+def parse_delta_header(raw: str) -> Optional[List[Tuple[str, int, str]]]:
+    out: List[Tuple[str, int, str]] = []
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split(":")
+        if len(parts) != 3 or sanitize_token(parts[0]) != parts[0] or not SHA256_RE.match(parts[2].lower()):
+            return None
+        try:
+            base_len = int(parts[1])
+        except ValueError:
+            return None
+        if base_len <= 0:
+            return None
+        out.append((parts[0], base_len, parts[2].lower()))
+    return out if len(out) <= DELTA_MAX_FILES else None
+
 
+def upload_dest(inbox_root: Path, req: UploadRequest) -> Path:
+    ext = ".bin"
+    if req.kind in TAR_KINDS:
+        ext = ENC_EXT[req.enc]
+    return inbox_root / req.device_id / f"{req.run_id}__{req.kind}{ext}"
 
-def handle_conn(conn: socket.socket, addr, inbox_root: Path) -> None:
+
+def delta_base_root(inbox_root: Path) -> Path:
+    """$WK_DELTA_BASE_DIR, else storage/delta_base next to the inbox (and the runs root)."""
+    env = os.environ.get(DELTA_BASE_DIR_ENV, "").strip()
+    return Path(env) if env else inbox_root.parent / "delta_base"
+
+
+def tail_sha256(path: Path, length: int) -> Optional[str]:
+    """sha256 of the DELTA_TAIL_BYTES ending at offset length, or None if the file is shorter."""
     try:
-        headers, rest = read_headers(conn)
-        kind = sanitize_token(headers.get("TYPE", ""))
-        device_id = sanitize_token(headers.get("DEVICE", ""))
-        run_id = sanitize_token(headers.get("RUN", ""))
-        length_raw = headers.get("LEN", "0")
+        with path.open("rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < length:
+                return None
+            start = max(0, length - DELTA_TAIL_BYTES)
+            f.seek(start)
+            return hashlib.sha256(f.read(length - start)).hexdigest()
+    except OSError:
+        return None
+
+
+def delta_bases_match(inbox_root: Path, req: UploadRequest) -> bool:
+    base_dir = delta_base_root(inbox_root) / req.device_id
+    return all(tail_sha256(base_dir / name, base_len) == tail for name, base_len, tail in req.delta)
+
+
+def pin_delta_bases(dest: Path, req: UploadRequest) -> None:
+    """
+    Hard-link (or copy, across filesystems) the DELTA= bases into <dest>.delta_base/ and
+    re-check them there. Bases are only ever replaced or unlinked, never rewritten, so the
+    pinned bytes are the ones checked here; ingest_bundle.py rebuilds against them even if
+    the device's bases move on before the watcher gets to this bundle.
+    """
+    base_dir = delta_base_root(dest.parent.parent) / req.device_id
+    pin = Path(str(dest) + DELTA_PIN_SUFFIX)
+    shutil.rmtree(pin, ignore_errors=True)
+    pin.mkdir(parents=True)
+    for name, base_len, tail in req.delta:
         try:
-            length = int(length_raw)
-        except ValueError:
-            length = -1
+            os.link(base_dir / name, pin / name)
+        except OSError:
+            try:
+                shutil.copyfile(base_dir / name, pin / name)
+            except OSError:
+                pass
+        if tail_sha256(pin / name, base_len) != tail:
+            shutil.rmtree(pin, ignore_errors=True)
+            raise UploadError("delta_base_mismatch")
+
+
+def remove_delta_pin(dest: Path) -> None:
+    shutil.rmtree(Path(str(dest) + DELTA_PIN_SUFFIX), ignore_errors=True)
+
+
+def reply_delta_query(inbox_root: Path, headers: Dict[str, str]) -> bytes:
+    """
+    OP=delta_query DEVICE=<id> FILES=<name>[,...] -> "OK" then one "<name>=<len>:<tail_sha256>"
+    line per file the server holds a base copy of (unknown files are left out).
+    """
+    device_id = sanitize_token(headers.get("DEVICE", ""))
+    names = [n.strip() for n in headers.get("FILES", "").split(",") if n.strip()]
+    if not device_id or not names or len(names) > DELTA_MAX_FILES:
+        return b"ERR\n"
+    base_dir = delta_base_root(inbox_root) / device_id
+    lines = ["OK"]
+    for name in names:
+        if sanitize_token(name) != name:
+            continue
+        try:
+            size = (base_dir / name).stat().st_size
+        except OSError:
+            continue
+        tail = tail_sha256(base_dir / name, size) if size > 0 else None
+        if tail is not None:
+            lines.append(f"{name}={size}:{tail}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
 
-        if not kind or not device_id or not run_id or length < 0:
-            conn.sendall(b"ERR\n")
-            return
 
-        if length > 1024 * 1024 * 1024:
-            conn.sendall(b"ERR\n")
-            return
+def partial_paths(inbox_root: Path, req: UploadRequest) -> Tuple[Path, Path]:
+    """(<device_dir>/.partial/<name>.part, its .part.json sidecar holding LEN/SHA256)."""
+    dest = upload_dest(inbox_root, req)
+    part = dest.parent / PARTIAL_DIR / (dest.name + ".part")
+    return part, Path(str(part) + ".json")
 
-        payload = read_exact(conn, length, rest)
-        if len(payload) != length:
-            conn.sendall(b"ERR\n")
+
+def read_partial_meta(meta: Path) -> Dict[str, Any]:
+    try:
+        obj = json.loads(meta.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+    return obj if isinstance(obj, dict) else {}
+
+
+def partial_matches(meta: Dict[str, Any], req: UploadRequest) -> bool:
+    """A partial is only resumed by the same payload: same LEN and same SHA256 (or both absent)."""
+    return meta.get("len") == req.length and meta.get("sha256") == req.sha256
+
+
+def query_offset(inbox_root: Path, req: UploadRequest) -> Optional[int]:
+    """Bytes of (DEVICE, RUN, TYPE) already stored; 0 if none/mismatched, None while being written."""
+    part, meta_path = partial_paths(inbox_root, req)
+    try:
+        fd = os.open(part, os.O_RDONLY)
+    except OSError:
+        return 0
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            return None
+        if not partial_matches(read_partial_meta(meta_path), req):
+            return 0
+        return min(os.fstat(fd).st_size, req.length)
+    finally:
+        os.close(fd)
+
+
+def sweep_partials(inbox_root: Path, ttl_sec: float = PARTIAL_TTL_SEC) -> int:
+    """Drop partial uploads untouched for ttl_sec (skipping ones being written). Returns #removed."""
+    now = time.time()
+    removed = 0
+    for part in inbox_root.glob(f"*/{PARTIAL_DIR}/*.part"):
+        try:
+            if now - part.stat().st_mtime < ttl_sec:
+                continue
+            fd = os.open(part, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            part.unlink()
+            removed += 1
+        except OSError:
+            continue
+        finally:
+            os.close(fd)
+        try:
+            Path(str(part) + ".json").unlink()
+        except OSError:
+            pass
+    # sidecars whose partial is gone
+    for meta in inbox_root.glob(f"*/{PARTIAL_DIR}/*.part.json"):
+        try:
+            if not meta.with_suffix("").exists() and now - meta.stat().st_mtime >= ttl_sec:
+                meta.unlink()
+        except OSError:
+            pass
+    return removed
+
+
+class UploadSink:
+    """
+    Streams a payload into a unique .tmp next to the destination, hashing as it goes;
+    tar kinds are also decompressed + indexed on the fly (TarStreamIndexer), so the archive is
+    never re-read for validation. commit() checks size + SHA256 header and only then
+    renames; abort() drops the tmp.
+    """
+
+    def __init__(self, inbox_root: Path, req: UploadRequest) -> None:
+        self.req = req
+        self.dest = upload_dest(inbox_root, req)
+        self.dest.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(self.dest.parent), prefix=self.dest.name + ".", suffix=".tmp")
+        self.tmp = Path(tmp)
+        os.chmod(tmp, 0o644)  # mkstemp creates 0600; keep the old inbox file mode
+        self._f = os.fdopen(fd, "wb")
+        self._sha = hashlib.sha256()
+        self.size = 0
+        self.indexer: Optional[TarStreamIndexer] = TarStreamIndexer(req.enc) if req.kind in TAR_KINDS else None
+
+    @property
+    def remaining(self) -> int:
+        return self.req.length - self.size
+
+    def write(self, chunk: bytes) -> None:
+        if len(chunk) > self.remaining:
+            chunk = chunk[:self.remaining]
+        self._f.write(chunk)
+        self._sha.update(chunk)
+        if self.indexer is not None:
+            self.indexer.feed(chunk)
+            if self.indexer.too_large:
+                # decompression bomb: stop receiving instead of inflating the rest
+                raise UploadError("too_large_uncompressed")
+        self.size += len(chunk)
+
+    def hexdigest(self) -> str:
+        return self._sha.hexdigest()
+
+    def commit(self) -> Path:
+        self._f.close()
+        if self.size != self.req.length:
+            self.abort()
+            raise UploadError("short_payload")
+        if self.req.sha256 is not None and self.hexdigest() != self.req.sha256:
+            self.abort()
+            raise UploadError("sha256_mismatch")
+        if self.req.delta:
+            try:
+                pin_delta_bases(self.dest, self.req)
+            except UploadError:
+                self.abort()
+                raise
+        os.replace(self.tmp, self.dest)
+        finalize_upload(self.dest, self.req.kind, self.indexer, self.hexdigest())
+        return self.dest
+
+    def abort(self) -> None:
+        try:
+            self._f.close()
+        except Exception:
+            pass
+        try:
+            self.tmp.unlink()
+        except Exception:
+            pass
+
+
+class ResumableSink(UploadSink):
+    """
+    UploadSink over a persistent <device_dir>/.partial/<name>.part (flock'ed while written).
+    A resumed request starts at OFFSET (default 0); the stored prefix is re-read once to
+    restore the SHA-256 and tar index state. abort() keeps the bytes received so far, so
+    a dropped link resumes instead of resending; sweep_partials() expires leftovers.
+    """
+
+    def __init__(self, inbox_root: Path, req: UploadRequest) -> None:
+        self.req = req
+        self.dest = upload_dest(inbox_root, req)
+        self.part, self.meta = partial_paths(inbox_root, req)
+        self.tmp = self.part
+        self.part.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # lost a race with a commit/sweep that renamed or unlinked this inode
+            if os.fstat(fd).st_ino != os.stat(self.part).st_ino:
+                raise OSError("stale partial")
+        except OSError:
+            os.close(fd)
+            raise UploadError("busy")
+        self._f = os.fdopen(fd, "r+b")
+        self._sha = hashlib.sha256()
+        self.size = 0
+        self.indexer = TarStreamIndexer(req.enc) if req.kind in TAR_KINDS else None
+
+        meta = read_partial_meta(self.meta)
+        have = os.fstat(fd).st_size if partial_matches(meta, req) else 0
+        start = req.offset or 0
+        if start > have:
+            self._f.close()
+            raise UploadError(f"offset_mismatch have={have}")
+        self._f.truncate(start)
+        self._replay(start)
+        self._f.seek(start)
+        meta = meta if partial_matches(meta, req) else {}
+        meta.update({
+            "len": req.length,
+            "sha256": req.sha256,
+            "kind": req.kind,
+            "device": req.device_id,
+            "run": req.run_id,
+            "created": meta.get("created") or int(time.time()),
+        })
+        tmp = Path(str(self.meta) + ".tmp")
+        tmp.write_text(json.dumps(meta, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp, self.meta)
+
+    def _replay(self, n: int) -> None:
+        self._f.seek(0)
+        while self.size < n:
+            chunk = self._f.read(min(READ_CHUNK, n - self.size))
+            if not chunk:
+                break
+            self._sha.update(chunk)
+            if self.indexer is not None:
+                self.indexer.feed(chunk)
+            self.size += len(chunk)
+
+    def commit(self) -> Path:
+        if self.size != self.req.length:
+            self.abort()
+            raise UploadError("short_payload")
+        if self.req.sha256 is not None and self.hexdigest() != self.req.sha256:
+            self.discard()
+            raise UploadError("sha256_mismatch")
+        if self.req.delta:
+            try:
+                pin_delta_bases(self.dest, self.req)
+            except UploadError:
+                self.discard()  # the board rebuilds with full files
+                raise
+        self._f.flush()
+        os.replace(self.part, self.dest)
+        self._f.close()  # drops the flock only after the rename
+        try:
+            self.meta.unlink()
+        except OSError:
+            pass
+        finalize_upload(self.dest, self.req.kind, self.indexer, self.hexdigest())
+        return self.dest
+
+    def abort(self) -> None:
+        """Keep what arrived: flush + fsync so the offset a later query reports is on disk."""
+        if self._f.closed:
             return
+        if self.size == 0 or (self.indexer is not None and self.indexer.too_large):
+            self.discard()
+            return
+        try:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        except Exception:
+            pass
+        try:
+            self._f.close()
+        except Exception:
+            pass
 
-        device_dir = inbox_root / device_id
-        device_dir.mkdir(parents=True, exist_ok=True)
+    def discard(self) -> None:
+        for p in (self.part, self.meta):
+            try:
+                p.unlink()
+            except OSError:
+                pass
+        try:
+            self._f.close()
+        except Exception:
+            pass
+
+
+def open_sink(inbox_root: Path, req: UploadRequest) -> UploadSink:
+    return ResumableSink(inbox_root, req) if req.resume else UploadSink(inbox_root, req)
 
-        ext = ".bin"
-        if kind in ("bundle", "action_result"):
-            ext = ".tar.gz"
 
-        name = f"{run_id}__{kind}{ext}"
-        dest = device_dir / name
-        tmp = Path(str(dest) + ".tmp")
+def reply_offset(inbox_root: Path, req: UploadRequest) -> bytes:
+    offset = query_offset(inbox_root, req)
+    if offset is None:
+        return reply_err("busy")
+    return f"OFFSET={offset}\n".encode("utf-8")
+
+
+def receive_into(conn: socket.socket, sink: UploadSink, first: bytes) -> None:
+    if first:
+        sink.write(first)
+    while sink.remaining > 0:
+        chunk = conn.recv(min(READ_CHUNK, sink.remaining))
+        if not chunk:
+            break
+        sink.write(chunk)
 
-        with tmp.open("wb") as f:
-            f.write(payload)
-        os.replace(tmp, dest)
-        done = Path(str(dest) + ".done")
 
-        if kind in ("bundle", "action_result"):
+def skip_duplicate_bundle(dest: Path, sha256: str) -> bool:
+    """
+    True when the same bundle content was received before (bundle_index.py): the upload
+    is acknowledged as skip_duplicate and never reaches the watcher.
+    """
+    device_id = dest.parent.name
+    run_id = dest.name.split("__", 1)[0]
+    try:
+        prev = claim_bundle(dest.parent.parent, sha256, device_id, run_id, dest.name)
+    except Exception:
+        return False  # index unavailable: process normally
+    if prev is None:
+        return False
+    if prev.get("device_id") == device_id and prev.get("name") == dest.name and prev.get("status") == "pending":
+        # retry after a lost OK, original still queued: this file *is* the original
+        return False
+    try:
+        mark_duplicate(dest, device_id, run_id, prev, marker=markers_enabled())
+    except Exception:
+        return False
+    record_job(dest, "bundle", "skip_duplicate", sha256, detail={
+        "duplicate_of": prev.get("name"),
+        "original_device_id": prev.get("device_id"),
+        "original_run_id": prev.get("run_id"),
+    })
+    return True
+
+
+def record_job(dest: Path, kind: str, state: str, sha256: Optional[str] = None,
+               error: str = "", detail: Optional[Dict[str, Any]] = None) -> bool:
+    """Add the upload to the job ledger (job_ledger.py); False when it is disabled or unavailable."""
+    ledger = open_ledger(dest.parent.parent)
+    if ledger is None:
+        return False
+    try:
+        size = dest.stat().st_size if dest.exists() else None
+        ledger.record_upload(dest, kind, dest.name.split("__", 1)[0], sha256, size, state, error, detail)
+    except Exception as exc:
+        print(f"[tcp_ingest] job ledger error {dest.name}: {exc}", flush=True)
+        return False
+    return True
+
+
+def finalize_upload(dest: Path,
+                    kind: str,
+                    indexer: Optional[TarStreamIndexer] = None,
+                    sha256: Optional[str] = None) -> None:
+    """
+    Validate tar kinds, write the <name>.index.json member index and then the .done
+    marker the watcher waits for. The streamed gzip/zstd index is used when available;
+    other tar compressions sent as ENC=gzip fall back to one tarfile pass.
+    Valid bundles already received before are marked skip_duplicate instead.
+    Every outcome is also recorded in the job ledger; with WK_INBOX_MARKERS=0 the
+    ledger row replaces the .done marker.
+    """
+    done = Path(str(dest) + ".done")
+
+    if kind in TAR_KINDS:
+        try:
+            if indexer is not None and indexer.finish():
+                index = indexer.to_index(dest, sha256)
+            elif indexer is not None and indexer.error != "not a gzip stream":
+                raise ValueError(indexer.error)
+            else:
+                index = index_from_tarfile(dest, sha256)
+            write_index(dest, index)
+        except Exception as exc:
+            bad = Path(str(dest) + ".bad")
             try:
-                with tarfile.open(dest, "r:*") as tar:
-                    tar.getmembers()
-            except Exception as exc:
-                bad = Path(str(dest) + ".bad")
+                os.replace(dest, bad)
+            except Exception:
                 try:
-                    os.replace(dest, bad)
+                    dest.unlink()
                 except Exception:
-                    try:
-                        dest.unlink()
-                    except Exception:
-                        pass
-                msg = str(exc).replace("\n", " ").strip()
+                    pass
+            remove_delta_pin(dest)
+            msg = str(exc).replace("\n", " ").strip()
+            if not record_job(dest, kind, "skip_bad_bundle", sha256, error=f"bad_tar {msg}") or markers_enabled():
                 done.write_text(f"error:bad_tar {msg}\n", encoding="utf-8")
-            else:
-                done.write_text("ok\n", encoding="utf-8")
-        else:
-            done.write_text("ok\n", encoding="utf-8")
+            return
+        if kind == "bundle" and sha256 and dedupe_enabled() and skip_duplicate_bundle(dest, sha256):
+            remove_delta_pin(dest)
+            return
+    # the .done marker is what marker-only watchers (WK_JOB_LEDGER=0) wait for
+    state = STATE_RECEIVED if kind in TAR_KINDS else STATE_STORED
+    if not record_job(dest, kind, state, sha256) or markers_enabled():
+        done.write_text("ok\n", encoding="utf-8")
 
+
+def reply_err(reason: str = "") -> bytes:
+    return (f"ERR {reason}\n" if reason else "ERR\n").encode("utf-8")
+
+
+def linger_input(conn: socket.socket, timeout: float = BUSY_LINGER_SEC, limit: int = BUSY_LINGER_BYTES) -> None:
+    """After an early reply: send FIN, then drop what the peer still sends for a moment."""
+    try:
+        conn.shutdown(socket.SHUT_WR)
+        deadline = time.time() + timeout
+        while limit > 0 and time.time() < deadline:
+            conn.settimeout(max(0.05, deadline - time.time()))
+            chunk = conn.recv(min(READ_CHUNK, limit))
+            if not chunk:
+                break
+            limit -= len(chunk)
+    except Exception:
+        pass
+
+
+def handle_conn(conn: socket.socket, addr, inbox_root: Path, admission: Optional[AdmissionControl] = None) -> None:
+    sink: Optional[UploadSink] = None
+    try:
+        headers, rest = read_headers(conn)
+        if headers.get("OP", "").strip().lower() == "delta_query":
+            conn.sendall(reply_delta_query(inbox_root, headers))
+            return
+        req = parse_upload_headers(headers)
+        if req is None:
+            conn.sendall(b"ERR\n")
+            return
+        retry_after = admission.check(req.device_id, req.kind, req.op, req.offset) if admission else None
+        if retry_after is not None:
+            # before reading the payload: the rest of it is never transferred
+            conn.sendall(reply_busy(retry_after))
+            linger_input(conn)
+            return
+        if req.op == "query":
+            conn.sendall(reply_offset(inbox_root, req))
+            return
+        if req.delta and not delta_bases_match(inbox_root, req):
+            # the board rebuilds the bundle with full files
+            conn.sendall(reply_err("delta_base_mismatch"))
+            return
+
+        sink = open_sink(inbox_root, req)
+        receive_into(conn, sink, rest)
+        sink.commit()
+        sink = None
         conn.sendall(b"OK\n")
+    except UploadError as exc:
+        try:
+            conn.sendall(reply_err(str(exc)))
+        except Exception:
+            pass
     except Exception:
         try:
             conn.sendall(b"ERR\n")
         except Exception:
             pass
     finally:
+        if sink is not None:
+            sink.abort()
         conn.close()
 
 
@@ -132,9 +690,23 @@ def parse_args() -> argparse.Namespace:
     ap.add_argument("--host", default="0.0.0.0")
     ap.add_argument("--port", type=int, default=18080)
     ap.add_argument("--inbox", default="/home/xrh/qwen3_os_fault/storage/tcp_inbox")
+    ap.add_argument("--partial_ttl_sec", type=float, default=PARTIAL_TTL_SEC,
+                    help="drop resumable partial uploads untouched for this long")
+    add_admission_args(ap)
     return ap.parse_args()
 
 
+def partial_sweeper(inbox_root: Path, ttl_sec: float, interval: float = PARTIAL_SWEEP_SEC) -> None:
+    while True:
+        try:
+            n = sweep_partials(inbox_root, ttl_sec)
+            if n:
+                print(f"[tcp_ingest] expired partial uploads: {n}")
+        except Exception:
+            pass
+        time.sleep(interval)
+
+
 def main() -> None:
     args = parse_args()
     inbox_root = Path(args.inbox)
@@ -145,13 +717,17 @@ def main() -> None:
     srv.bind((args.host, args.port))
     srv.listen(16)
 
-    print(f"[tcp_ingest] listen {args.host}:{args.port} inbox={inbox_root}")
+    admission = admission_from_args(inbox_root, args)
+    admit_note = (f" admit_max_queue={args.admit_max_queue} admit_rate={args.admit_device_rate_per_min}/min"
+                  if admission is not None else "")
+    print(f"[tcp_ingest] listen {args.host}:{args.port} inbox={inbox_root}{admit_note}")
+    threading.Thread(target=partial_sweeper, args=(inbox_root, args.partial_ttl_sec), daemon=True).start()
 
     while True:
         conn, addr = srv.accept()
-        t = threading.Thread(target=handle_conn, args=(conn, addr, inbox_root), daemon=True)
+        t = threading.Thread(target=handle_conn, args=(conn, addr, inbox_root, admission), daemon=True)
         t.start()
 
 
 if __name__ == "__main__":
-    main()
+    main()
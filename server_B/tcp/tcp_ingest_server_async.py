@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+"""
+asyncio variant of tcp_ingest_server.py (same TYPE/DEVICE/RUN/LEN protocol, same inbox layout).
+- at most --max_uploads payloads are received at once; further uploads wait with the payload
+  unread (TCP flow control pushes back on the board) up to --queue_timeout_sec. Headers, OP=query,
+  OP=delta_query and admission BUSY replies are handled without a slot
+- payloads stream into the .tmp file (UploadSink, shared with the thread server) with an
+  incremental SHA-256; an optional SHA256= header is verified before the rename. Chunk writes
+  (file, hash, streaming tar index) run in the default executor, so the loop only does socket I/O
+- every read has a --read_timeout_sec deadline
+- SIGTERM/SIGINT: stop accepting, let in-flight uploads finish (up to --drain_sec);
+  a fully received payload is always written out (its ack is lost only if drain_sec expires)
+- --stats_port: JSON counters (plain `nc host port`, or HTTP GET for curl)
+- resumable extension (OP=query / OFFSET= / RESUME=1, see ResumableSink); partials older
+  than --partial_ttl_sec are swept every PARTIAL_SWEEP_SEC
+- delta uploads (OP=delta_query / DELTA=, see reply_delta_query / delta_bases_match)
+- admission control: `BUSY RETRY_AFTER=<sec>` while the watcher is backed up or a device
+  exceeds its bundle rate (ingest_admission.py, --admit_* options)
+"""
+
+import argparse
+import asyncio
+import json
+import signal
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from ingest_admission import (
+    BUSY_LINGER_BYTES,
+    BUSY_LINGER_SEC,
+    AdmissionControl,
+    add_admission_args,
+    admission_from_args,
+    reply_busy,
+)
+from tcp_ingest_server import (
+    HEADER_LIMIT,
+    PARTIAL_SWEEP_SEC,
+    PARTIAL_TTL_SEC,
+    READ_CHUNK,
+    UploadError,
+    UploadRequest,
+    UploadSink,
+    delta_bases_match,
+    open_sink,
+    parse_upload_headers,
+    reply_delta_query,
+    reply_err,
+    reply_offset,
+    split_headers,
+    sweep_partials,
+)
+
+
+class IngestStats:
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.accepted = 0
+        self.active_conns = 0
+        self.waiting = 0
+        self.active_uploads = 0
+        self.peak_uploads = 0
+        self.ok = 0
+        self.err = 0
+        self.timeouts = 0
+        self.queue_timeouts = 0
+        self.bytes_in = 0
+        self.rejected = 0
+        self.queries = 0
+        self.resumed = 0
+        self.busy = 0
+
+    def snapshot(self, max_uploads: int, draining: bool) -> Dict[str, Any]:
+        return {
+            "uptime_sec": int(time.time() - self.started),
+            "max_uploads": max_uploads,
+            "draining": draining,
+            "accepted": self.accepted,
+            "active_conns": self.active_conns,
+            "waiting": self.waiting,
+            "active_uploads": self.active_uploads,
+            "peak_uploads": self.peak_uploads,
+            "ok": self.ok,
+            "err": self.err,
+            "timeouts": self.timeouts,
+            "queue_timeouts": self.queue_timeouts,
+            "bytes_in": self.bytes_in,
+            "rejected": self.rejected,
+            "queries": self.queries,
+            "resumed": self.resumed,
+            "busy": self.busy,
+        }
+
+
+class AsyncIngestServer:
+    def __init__(self,
+                 inbox_root: Path,
+                 max_uploads: int = 32,
+                 read_timeout: float = 30.0,
+                 queue_timeout: float = 120.0,
+                 admission: Optional[AdmissionControl] = None) -> None:
+        self.inbox_root = inbox_root
+        self.admission = admission
+        self.max_uploads = max(1, max_uploads)
+        self.read_timeout = read_timeout
+        self.queue_timeout = queue_timeout
+        self.stats = IngestStats()
+        self.draining = False
+        self._slots = asyncio.Semaphore(self.max_uploads)
+        self._tasks: Set["asyncio.Task[Any]"] = set()
+        self._queued: Set["asyncio.Task[Any]"] = set()
+
+    async def _read_headers(self, reader: asyncio.StreamReader) -> Tuple[Dict[str, str], bytes]:
+        data = b""
+        while b"\n\n" not in data and b"\r\n\r\n" not in data:
+            chunk = await asyncio.wait_for(reader.read(512), self.read_timeout)
+            if not chunk:
+                break
+            data += chunk
+            if len(data) > HEADER_LIMIT:
+                raise ValueError("header too large")
+        return split_headers(data)
+
+    @staticmethod
+    async def _write(sink: UploadSink, chunk: bytes) -> None:
+        # write + SHA-256 + streaming decompress/tar index: off the loop, which only does socket I/O
+        fut = asyncio.get_running_loop().run_in_executor(None, sink.write, chunk)
+        try:
+            await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # the caller aborts the sink next; never close its file under a running write
+            try:
+                await fut
+            except Exception:
+                pass
+            raise
+
+    async def _receive_into(self, reader: asyncio.StreamReader, sink: UploadSink, first: bytes) -> None:
+        if first:
+            await self._write(sink, first)
+        while sink.remaining > 0:
+            chunk = await asyncio.wait_for(reader.read(min(READ_CHUNK, sink.remaining)), self.read_timeout)
+            if not chunk:
+                break
+            await self._write(sink, chunk)
+            self.stats.bytes_in += len(chunk)
+
+    async def handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        if task is not None:
+            self._tasks.add(task)
+        self.stats.accepted += 1
+        self.stats.active_conns += 1
+        reply = b"ERR\n"
+        try:
+            if self.draining:
+                return
+            reply = await self._receive(reader, task)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+        except Exception:
+            pass
+        finally:
+            if reply.startswith(b"OK\n") or reply.startswith(b"OFFSET="):
+                self.stats.ok += 1
+            elif not reply.startswith(b"BUSY"):
+                self.stats.err += 1
+            self.stats.active_conns -= 1
+            try:
+                writer.write(reply)
+                await asyncio.wait_for(writer.drain(), self.read_timeout)
+                if reply.startswith(b"BUSY"):
+                    await self._linger(reader, writer)
+            except Exception:
+                pass
+            writer.close()
+            if task is not None:
+                self._tasks.discard(task)
+
+    async def _linger(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Half-close and drop the unread payload for a moment, so the reply is not lost to a RST."""
+        writer.write_eof()
+        left = BUSY_LINGER_BYTES
+        deadline = time.time() + BUSY_LINGER_SEC
+        while left > 0:
+            chunk = await asyncio.wait_for(reader.read(min(READ_CHUNK, left)), max(0.05, deadline - time.time()))
+            if not chunk:
+                break
+            left -= len(chunk)
+
+    async def _acquire_slot(self, task: Optional["asyncio.Task[Any]"]) -> bool:
+        """
+        Wait for an upload slot with the payload still unread: it stays in the kernel
+        buffers and the sender is throttled by TCP instead of our RAM.
+        """
+        self.stats.waiting += 1
+        if task is not None:
+            self._queued.add(task)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats.queue_timeouts += 1
+            return False
+        except asyncio.CancelledError:
+            # shutdown: nothing of the payload was accepted yet
+            return False
+        finally:
+            self.stats.waiting -= 1
+            if task is not None:
+                self._queued.discard(task)
+        self.stats.active_uploads += 1
+        self.stats.peak_uploads = max(self.stats.peak_uploads, self.stats.active_uploads)
+        return True
+
+    async def _receive(self, reader: asyncio.StreamReader, task: Optional["asyncio.Task[Any]"] = None) -> bytes:
+        # headers, queries and BUSY need no upload slot; only the payload receive holds one
+        headers, rest = await self._read_headers(reader)
+        self.stats.bytes_in += len(rest)
+        loop = asyncio.get_running_loop()
+        if headers.get("OP", "").strip().lower() == "delta_query":
+            self.stats.queries += 1
+            return await loop.run_in_executor(None, reply_delta_query, self.inbox_root, headers)
+        req = parse_upload_headers(headers)
+        if req is None:
+            return b"ERR\n"
+        if self.admission is not None:
+            # the backlog read may wait on the ledger's SQLite lock
+            retry_after = await loop.run_in_executor(
+                None, self.admission.check, req.device_id, req.kind, req.op, req.offset)
+            if retry_after is not None:
+                self.stats.busy += 1
+                return reply_busy(retry_after)
+        if req.op == "query":
+            self.stats.queries += 1
+            return await loop.run_in_executor(None, reply_offset, self.inbox_root, req)
+        if req.delta and not await loop.run_in_executor(None, delta_bases_match, self.inbox_root, req):
+            self.stats.rejected += 1
+            return reply_err("delta_base_mismatch")
+
+        if not await self._acquire_slot(task):
+            return b"ERR\n"
+        try:
+            return await self._receive_payload(reader, req, rest)
+        finally:
+            self.stats.active_uploads -= 1
+            self._slots.release()
+
+    async def _open_sink(self, factory: Callable[[Path, UploadRequest], UploadSink],
+                         req: UploadRequest) -> UploadSink:
+        """factory(inbox_root, req) in the executor (mkdir, mkstemp, flock, prefix replay)."""
+        fut = asyncio.get_running_loop().run_in_executor(None, factory, self.inbox_root, req)
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # still opening: abort the sink once it exists, or its tmp file / flock leaks
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception() is not None or f.result().abort())
+            raise
+
+    async def _receive_payload(self, reader: asyncio.StreamReader, req: UploadRequest, rest: bytes) -> bytes:
+        loop = asyncio.get_running_loop()
+        try:
+            if req.resume:
+                # re-reads the stored prefix to restore hash/index state
+                sink = await self._open_sink(open_sink, req)
+                if req.offset:
+                    self.stats.resumed += 1
+            else:
+                sink = await self._open_sink(UploadSink, req)
+        except UploadError as exc:
+            self.stats.rejected += 1
+            return reply_err(str(exc))
+        try:
+            await self._receive_into(reader, sink, rest)
+        except UploadError as exc:
+            sink.abort()
+            self.stats.rejected += 1
+            return reply_err(str(exc))
+        except BaseException:
+            sink.abort()
+            raise
+        # rename + tar validation block; run off-loop and never abandon it half way
+        try:
+            await asyncio.shield(loop.run_in_executor(None, sink.commit))
+        except UploadError as exc:
+            self.stats.rejected += 1
+            return reply_err(str(exc))
+        except Exception as exc:
+            # rename / finalize_upload failed (disk full, ledger write): answer instead of dropping the link
+            print(f"[tcp_ingest_async] commit failed device={req.device_id} run={req.run_id}: {exc!r}", flush=True)
+            self.stats.rejected += 1
+            return reply_err("server_error")
+        return b"OK\n"
+
+    async def handle_stats(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                first = await asyncio.wait_for(reader.readline(), 0.5)
+            except asyncio.TimeoutError:
+                first = b""
+            body = json.dumps(self.stats.snapshot(self.max_uploads, self.draining)).encode("utf-8") + b"\n"
+            if first.startswith(b"GET"):
+                writer.write(
+                    b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+                )
+            writer.write(body)
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    async def drain(self, drain_sec: float) -> int:
+        """Wait for in-flight connections; cancel what is left after drain_sec. Returns #cancelled."""
+        self.draining = True
+        for t in list(self._queued):
+            t.cancel()
+        pending = {t for t in self._tasks if not t.done()}
+        if not pending:
+            return 0
+        _, still = await asyncio.wait(pending, timeout=drain_sec)
+        for t in still:
+            t.cancel()
+        if still:
+            await asyncio.wait(still, timeout=5)
+        return len(still)
+
+
+def parse_args() -> argparse.Namespace:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="0.0.0.0")
+    ap.add_argument("--port", type=int, default=18080)
+    ap.add_argument("--inbox", default="/home/xrh/qwen3_os_fault/storage/tcp_inbox")
+    ap.add_argument("--max_uploads", type=int, default=32, help="concurrent payload receives")
+    ap.add_argument("--backlog", type=int, default=512)
+    ap.add_argument("--read_timeout_sec", type=float, default=30.0)
+    ap.add_argument("--queue_timeout_sec", type=float, default=120.0)
+    ap.add_argument("--drain_sec", type=float, default=60.0)
+    ap.add_argument("--stats_host", default="127.0.0.1")
+    ap.add_argument("--stats_port", type=int, default=18090, help="0 disables the stats endpoint")
+    ap.add_argument("--partial_ttl_sec", type=float, default=PARTIAL_TTL_SEC,
+                    help="drop resumable partial uploads untouched for this long")
+    add_admission_args(ap)
+    return ap.parse_args()
+
+
+async def sweep_loop(inbox_root: Path, ttl_sec: float) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            n = await loop.run_in_executor(None, sweep_partials, inbox_root, ttl_sec)
+            if n:
+                print(f"[tcp_ingest_async] expired partial uploads: {n}", flush=True)
+        except Exception:
+            pass
+        await asyncio.sleep(PARTIAL_SWEEP_SEC)
+
+
+async def serve(args: argparse.Namespace) -> None:
+    inbox_root = Path(args.inbox)
+    inbox_root.mkdir(parents=True, exist_ok=True)
+    app = AsyncIngestServer(inbox_root, args.max_uploads, args.read_timeout_sec, args.queue_timeout_sec,
+                            admission_from_args(inbox_root, args))
+
+    srv = await asyncio.start_server(app.handle_conn, args.host, args.port, backlog=args.backlog, reuse_address=True)
+    stats_srv: Optional[asyncio.AbstractServer] = None
+    if args.stats_port > 0:
+        stats_srv = await asyncio.start_server(app.handle_stats, args.stats_host, args.stats_port, reuse_address=True)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    stats_note = f" stats={args.stats_host}:{args.stats_port}" if stats_srv is not None else ""
+    print(
+        f"[tcp_ingest_async] listen {args.host}:{args.port} inbox={inbox_root} "
+        f"max_uploads={app.max_uploads}{stats_note}",
+        flush=True,
+    )
+
+    sweeper = asyncio.create_task(sweep_loop(inbox_root, args.partial_ttl_sec))
+    await stop.wait()
+    sweeper.cancel()
+    print(f"[tcp_ingest_async] shutdown: draining in-flight={len(app._tasks)}", flush=True)
+    srv.close()
+    cancelled = await app.drain(args.drain_sec)
+    await srv.wait_closed()
+    if stats_srv is not None:
+        stats_srv.close()
+        await stats_srv.wait_closed()
+    print(f"[tcp_ingest_async] stopped cancelled={cancelled} stats={json.dumps(app.stats.snapshot(app.max_uploads, True))}", flush=True)
+
+
+def main() -> None:
+    asyncio.run(serve(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
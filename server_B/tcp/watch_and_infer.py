@@ -2,14 +2,45 @@
 import argparse
 import json
 import os
+import queue
 import socket
+import subprocess
 import sys
 import time
-import subprocess
 import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Set
+
+from bundle_index import bundle_sha256, resolve_bundle
+from inbox_notify import InboxNotifier
+from job_ledger import JobLedger, markers_enabled, open_ledger
+from tar_stream_index import ENC_EXT, zstd_stream_reader
+
+SERVER_B = Path(__file__).resolve().parents[1]
+for _p in (SERVER_B / "orchestrator", SERVER_B / "ingest"):
+    if str(_p) not in sys.path:
+        sys.path.insert(0, str(_p))
+
+from ingest_bundle import RunDirExists, remove_delta_pin
+from run_closed_loop import InferOptions, export_actions, extract_features, infer, ingest, run_pipeline
+from closed_loop_infer_run import read_run_window, windows_touch
+from load_ladder import LEVELS, LoadLadder, ladder_from_env
+from stage_deadline import DeadlinePolicy, StageDeadlineExceeded, job_timeout, policy_from_env, run_with_deadline
+from work_lease import Lease, lease_ttl, read_lease, try_acquire, worker_id
 
+INBOX_KINDS = ("bundle", "action_result")
+WATCH_LEASE_NAME = ".watch_lease"
 MAX_ERROR_BYTES = 2048
+# cooperative cancellation of superseded in-flight inference (WK_INFER_CANCEL=0: let it finish)
+INFER_CANCEL = os.environ.get("WK_INFER_CANCEL", "1").strip() != "0"
+PROBE_SEC = 1.0
+# bursts: an older bundle of the device still in the pipeline whose run window overlaps the
+# newer one, or ends at most WK_COALESCE_GAP_SEC before it, is merged into it (WK_COALESCE=0: off)
+COALESCE = os.environ.get("WK_COALESCE", "1").strip() != "0"
+COALESCE_GAP_SEC = float(os.environ.get("WK_COALESCE_GAP_SEC", "30"))
 def now_utc() -> str:
     return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
@@ -38,10 +69,14 @@ def unlink_if_exists(p: Path) -> None:
 
 
 def parse_name(filename: str):
-    if filename.endswith("__bundle.tar.gz"):
-        return filename[:-len("__bundle.tar.gz")], "bundle"
-    if filename.endswith("__action_result.tar.gz"):
-        return filename[:-len("__action_result.tar.gz")], "action_result"
+    # <run_id>__<kind>.tar.gz, or .tar.zst for ENC=zstd uploads
+    for ext in ENC_EXT.values():
+        if not filename.endswith(ext):
+            continue
+        stem = filename[:-len(ext)]
+        for kind in INBOX_KINDS:
+            if stem.endswith("__" + kind):
+                return stem[:-len("__" + kind)], kind
     return None, None
 
 def safe_read_text(p: Path) -> str:
@@ -50,9 +85,12 @@ def safe_read_text(p: Path) -> str:
     except Exception:
         return ""
 
-def write_latest(out_root: Path, device_id: str, run_id: str, actions_data: bytes) -> None:
+def write_latest(out_root: Path, device_id: str, run_id: str, actions_data: bytes,
+                 run_ids: Sequence[str] = ()) -> None:
+    # latest_run_ids.txt: every run_id the actions answer (coalesced bursts), see tcp_actions_server.py
     dev = out_root / device_id
     atomic_write(dev / "latest_actions_device.txt", actions_data)
+    atomic_write(dev / "latest_run_ids.txt", ("\n".join([run_id, *run_ids]) + "\n").encode("utf-8"))
     atomic_write(dev / "latest_run_id.txt", (run_id + "\n").encode("utf-8"))
 
 def write_status(out_root: Path, device_id: str, status: str) -> None:
@@ -78,16 +116,36 @@ def parse_run_dir(stdout: str):
             return line.split("=", 1)[1].strip()
     return None
 
-def run_closed_loop(repo_root: Path, bundle_path: Path, runs_root: Path):
+def run_closed_loop_subprocess(repo_root: Path, bundle_path: Path, runs_root: Path, opts: Optional[InferOptions] = None):
     script = repo_root / "server_B" / "orchestrator" / "run_closed_loop.py"
     cmd = [sys.executable, str(script), "--bundle", str(bundle_path), "--out_root", str(runs_root)]
-    proc = subprocess.run(cmd, text=True, capture_output=True)
+    timeout = None
+    if opts is not None and opts.degrade_level is not None:
+        cmd += ["--degrade_level", str(opts.degrade_level), "--queue_wait_sec", str(opts.queue_wait_sec or 0)]
+    if opts is not None and opts.deadlines:
+        cmd += ["--deadlines", ",".join("%s=%g" % kv for kv in opts.deadlines.items())]
+        timeout = job_timeout(opts.deadlines)
+    try:
+        proc = subprocess.run(cmd, text=True, capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # a hung stage the in-process watchdog could not stop: the child is killed
+        raise StageDeadlineExceeded("job")
     if proc.returncode != 0:
         stderr = (proc.stderr or "").strip()
         raise RuntimeError("run_closed_loop rc=%s stderr=%s" % (proc.returncode, stderr[:1024]))
     rd = parse_run_dir(proc.stdout or "")
     return Path(rd).expanduser().resolve() if rd else None
 
+def run_closed_loop(repo_root: Path, bundle_path: Path, runs_root: Path, opts: Optional[InferOptions] = None):
+    # in-process by default: the model stays loaded between bundles;
+    # WK_PIPELINE_SUBPROCESS=1 restores one isolated interpreter per bundle
+    if os.environ.get("WK_PIPELINE_SUBPROCESS", "0").strip() == "1":
+        return run_closed_loop_subprocess(repo_root, bundle_path, runs_root, opts)
+    res = run_pipeline(bundle=bundle_path, out_root=runs_root, opts=opts)
+    print("[watcher] pipeline run_id=%s infer=%s timings_ms=%s" % (
+        res.run_dir.name, res.infer.status, json.dumps(res.timings_ms)), flush=True)
+    return res.run_dir
+
 def find_actions(run_dir: Path):
     p = run_dir / "_server_out" / "actions_device.txt"
     if p.exists():
@@ -114,11 +172,23 @@ def mark_infer(item: Path, status: str, device_id: str = "", run_id: str = "", e
         encoding="utf-8",
     )
 
-def mark_server_out_infer_done(run_dir: Path, status: str) -> None:
+def record_bundle_outcome(inbox_root: Path, item: Path, status: str, run_dir: str = "") -> None:
+    """Tell the duplicate index (bundle_index.py) what became of this upload; call before cleanup."""
+    sha = bundle_sha256(item)
+    if not sha:
+        return
+    try:
+        resolve_bundle(inbox_root, sha, status, run_dir)
+    except Exception:
+        pass
+
+def mark_server_out_infer_done(run_dir: Optional[Path], status: str) -> None:
     """Write _server_out/.infer_done so demo_stage2.ps1 can reliably detect Stage2 completion.
 
     We keep this marker separate from the inbox-side *.infer_done used for dedup/cleanup.
     """
+    if run_dir is None:
+        return
     try:
         out_dir = Path(run_dir) / "_server_out"
         out_dir.mkdir(parents=True, exist_ok=True)
@@ -132,13 +202,14 @@ def cleanup_inbox_item(item: Path, delete_infer_done: bool = False) -> None:
     infer = Path(str(item) + ".infer_done")
     unlink_if_exists(item)
     unlink_if_exists(done)
+    unlink_if_exists(Path(str(item) + ".index.json"))
+    remove_delta_pin(item)
     if delete_infer_done:
         unlink_if_exists(infer)
 
-def safe_extract_tar(tar: tarfile.TarFile, dst: Path) -> None:
-    dst.mkdir(parents=True, exist_ok=True)
-    members = []
-    for m in tar.getmembers():
+def safe_members(tar: tarfile.TarFile):
+    # lazy, so it also works on stream-mode ("r|") archives
+    for m in tar:
         name = (m.name or "").lstrip("/")
         if not name:
             continue
@@ -150,8 +221,11 @@ def safe_extract_tar(tar: tarfile.TarFile, dst: Path) -> None:
         if name.startswith("./"):
             name = name[2:]
         m.name = name
-        members.append(m)
-    tar.extractall(dst, members=members)
+        yield m
+
+def safe_extract_tar(tar: tarfile.TarFile, dst: Path) -> None:
+    dst.mkdir(parents=True, exist_ok=True)
+    tar.extractall(dst, members=safe_members(tar))
 
 def unpack_action_result(tar_path: Path, run_dir: Path) -> Path:
     out_dir = run_dir / "_action_result"
@@ -159,8 +233,12 @@ def unpack_action_result(tar_path: Path, run_dir: Path) -> Path:
     marker = out_dir / ".unpack_done"
     if marker.exists():
         return out_dir
-    with tarfile.open(tar_path, "r:*") as tar:
-        safe_extract_tar(tar, out_dir)
+    if tar_path.name.endswith(ENC_EXT["zstd"]):
+        with tar_path.open("rb") as f, tarfile.open(fileobj=zstd_stream_reader(f), mode="r|") as tar:
+            safe_extract_tar(tar, out_dir)
+    else:
+        with tarfile.open(tar_path, "r:*") as tar:
+            safe_extract_tar(tar, out_dir)
     atomic_write(marker, (now_utc() + "\n").encode("utf-8"))
     return out_dir
 
@@ -182,17 +260,724 @@ def cleanup_processed_marks(device_dir: Path, keep_max: int, keep_days: int) ->
         old = (cutoff is not None and mtime < cutoff)
         if not (over or old):
             continue
-        base = Path(str(mark)[:-len(".infer_done")])  # -> *.tar.gz
+        base = Path(str(mark)[:-len(".infer_done")])  # -> *.tar.gz / *.tar.zst
         unlink_if_exists(base)
         unlink_if_exists(Path(str(base) + ".done"))
+        unlink_if_exists(Path(str(base) + ".index.json"))
+        remove_delta_pin(base)
         unlink_if_exists(mark)
 
+class DeviceClaims:
+    """
+    Per-device leases (work_lease.py, <inbox>/<device_id>/.watch_lease) so several watchers,
+    on one host or on hosts sharing the inbox, split the devices between them. A device is
+    claimed for a scan and held while it has jobs in flight; a crashed watcher's devices are
+    taken over once its lease expires (at once on the same host).
+    """
+
+    def __init__(self, inbox_root: Path, ttl: Optional[float] = None,
+                 on_acquire: Optional[Callable[[str], None]] = None) -> None:
+        self.inbox_root = inbox_root
+        self.ttl = ttl or lease_ttl()
+        self.owner = "watch_and_infer@" + worker_id()
+        self.on_acquire = on_acquire
+        self._held: Dict[str, Lease] = {}
+        self._lock = threading.Lock()
+
+    def lease_path(self, device: str) -> Path:
+        return self.inbox_root / device / WATCH_LEASE_NAME
+
+    def claim(self, device: str) -> bool:
+        with self._lock:
+            lease = self._held.get(device)
+            if lease is not None and not lease.lost.is_set():
+                return True
+            self._held.pop(device, None)
+        lease = try_acquire(self.lease_path(device), self.ttl, owner=self.owner)
+        if lease is None:
+            return False
+        if lease.reclaimed:
+            print("[watcher] reclaimed expired lease device=%s" % device, flush=True)
+        with self._lock:
+            self._held[device] = lease
+        if self.on_acquire is not None:
+            try:
+                self.on_acquire(device)
+            except Exception as exc:
+                print("[watcher] lease on_acquire error device=%s: %s" % (device, exc), flush=True)
+        return True
+
+    def held(self, device: str) -> bool:
+        with self._lock:
+            lease = self._held.get(device)
+        return lease is not None and lease.check()
+
+    def owner_of(self, device: str) -> str:
+        info = read_lease(self.lease_path(device))
+        return str((info or {}).get("owner") or "")
+
+    def release_idle(self, busy: Set[str]) -> None:
+        with self._lock:
+            idle = [d for d in self._held if d not in busy]
+            leases = [self._held.pop(d) for d in idle]
+        for lease in leases:
+            lease.release()
+
+
+@dataclass
+class WatchContext:
+    inbox_root: Path
+    out_root: Path
+    runs_root: Path
+    repo_root: Path
+    delete_infer_done: bool = False
+    ledger: Optional[JobLedger] = None
+    markers: bool = True
+    claims: Optional[DeviceClaims] = None
+    ladder: Optional[LoadLadder] = None
+    deadlines: Optional[DeadlinePolicy] = None
+
+    def stage_budgets(self, device_id: str) -> Optional[Dict[str, float]]:
+        return self.deadlines.budgets(device_id) if self.deadlines is not None else None
+
+    def infer_options(self, landed_at: float, cancel: Optional[Callable[[], bool]] = None,
+                      device_id: str = "") -> InferOptions:
+        """
+        Per-job options: overload ladder step for a bundle uploaded at landed_at (epoch sec),
+        cancel hook and the stage deadlines of the device's priority class.
+        """
+        opts = InferOptions(cancel=cancel if INFER_CANCEL else None, deadlines=self.stage_budgets(device_id))
+        if self.ladder is None:
+            return opts
+        wait = max(0.0, time.time() - landed_at)
+        prev = self.ladder.level
+        level = self.ladder.observe(wait)
+        if level != prev:
+            print("[watcher] degrade level %d -> %d (%s) queue_wait=%.0fs ewma=%.0fs" % (
+                prev, level, LEVELS[level], wait, self.ladder.ewma or 0.0), flush=True)
+        opts.degrade_level = level
+        opts.queue_wait_sec = round(wait, 1)
+        return opts
+
+    def owns(self, item: Path) -> bool:
+        """False once this watcher lost the device lease: the new owner redoes the job."""
+        if self.claims is None or self.claims.held(item.parent.name):
+            return True
+        print("[watcher] lease lost device=%s item=%s: left to the new owner" % (item.parent.name, item.name), flush=True)
+        return False
+
+    def mark_infer(self, item: Path, status: str, device_id: str = "", run_id: str = "", extra: dict = None) -> None:
+        """Record the outcome in the job ledger and, unless WK_INBOX_MARKERS=0, as <item>.infer_done."""
+        if self.ledger is not None:
+            extra = extra or {}
+            detail = {k: v for k, v in extra.items() if k not in ("run_dir", "reason")}
+            try:
+                self.ledger.set_state(item, status, run_id=run_id, run_dir=str(extra.get("run_dir") or ""),
+                                      error=str(extra.get("reason") or ""), detail=detail or None)
+            except Exception as exc:
+                print("[watcher] job ledger error %s: %s" % (item.name, exc), flush=True)
+        if self.markers or self.ledger is None:
+            mark_infer(item, status, device_id=device_id, run_id=run_id, extra=extra)
+
+    def mark_state(self, item: Path, state: str, run_id: str = "") -> None:
+        if self.ledger is None:
+            return
+        try:
+            self.ledger.set_state(item, state, run_id=run_id, worker=self.claims.owner if self.claims else "")
+        except Exception:
+            pass
+
+DEFAULT_ACTION_LINES = [
+    "dmesg | tail -n 200",
+    "cat /proc/loadavg",
+    "cat /proc/meminfo | head -n 40",
+    "ps -A | head -n 80",
+    "top -n 1 | head -n 80",
+]
+
+def publish_bundle_ok(wctx: WatchContext, item: Path, device_id: str, run_id: str, run_dir: Path,
+                      update_latest: bool = True, timings: Optional[Dict[str, float]] = None,
+                      degrade_level: Optional[int] = None, coalesced: Sequence[str] = ()) -> None:
+    if not wctx.owns(item):
+        return
+    actions_path = find_actions(run_dir)
+    if not actions_path:
+        raise FileNotFoundError("actions_device.txt missing for run_id=%s" % run_id)
+    data = actions_path.read_bytes()
+    if not data.strip():
+        # tolerate empty actions_device.txt: synthesize a minimal default so the pipeline can proceed
+        data = ("\n".join(DEFAULT_ACTION_LINES) + "\n").encode("utf-8")
+        try:
+            actions_path.write_bytes(data)
+        except Exception:
+            pass
+
+    if update_latest:
+        write_latest(wctx.out_root, device_id, run_id, data, coalesced)
+        write_status(wctx.out_root, device_id, "llm_ok")
+        clear_error(wctx.out_root, device_id)
+    extra = {"run_dir": str(run_dir)}
+    if timings:
+        extra["timings_ms"] = timings
+    if degrade_level:
+        extra["degrade_level"] = LEVELS[degrade_level]
+    if coalesced:
+        extra["coalesced"] = list(coalesced)
+    wctx.mark_infer(item, "ok", device_id=device_id, run_id=run_id, extra=extra)
+    record_bundle_outcome(wctx.inbox_root, item, "ok", str(run_dir))
+    mark_server_out_infer_done(run_dir, 'ok')
+    cleanup_inbox_item(item, delete_infer_done=wctx.delete_infer_done)
+    print("[watcher] bundle ok device=%s run_id=%s" % (device_id, run_id), flush=True)
+
+def publish_bundle_error(wctx: WatchContext, item: Path, device_id: str, run_id: str,
+                         run_dir: Optional[Path], exc: BaseException, update_latest: bool = True) -> None:
+    if not wctx.owns(item):
+        return
+    reason = str(exc)
+    # run_dir exists 这种是历史重复包：不写 fallback，不覆盖 latest，只做 skip
+    if isinstance(exc, RunDirExists) or "run_dir exists:" in reason:
+        wctx.mark_infer(item, "skip_exists_run_dir", device_id=device_id, run_id=run_id, extra={"reason": reason[:512]})
+        record_bundle_outcome(wctx.inbox_root, item, "skip_exists_run_dir", str(wctx.runs_root / run_id))
+        mark_server_out_infer_done(run_dir, 'skip_exists_run_dir')
+        # 这种重复包也没必要留在 inbox
+        cleanup_inbox_item(item, delete_infer_done=wctx.delete_infer_done)
+        print("[watcher] bundle skip_exists device=%s run_id=%s" % (device_id, run_id), flush=True)
+        return
+    if update_latest:
+        fallback = ("echo INFER_FAILED device=%s run=%s\n" % (device_id, run_id)).encode("utf-8")
+        write_latest(wctx.out_root, device_id, run_id, fallback)
+        write_error(wctx.out_root, device_id, reason)
+        write_status(wctx.out_root, device_id, "fallback")
+    wctx.mark_infer(item, "error", device_id=device_id, run_id=run_id, extra={"reason": reason[:1024]})
+    # lets a re-upload of the same bundle be processed again
+    record_bundle_outcome(wctx.inbox_root, item, "error")
+    mark_server_out_infer_done(run_dir, 'error')
+    print("[watcher] bundle error device=%s run_id=%s reason=%s" % (device_id, run_id, reason), flush=True)
+
+def publish_bundle_cancelled(wctx: WatchContext, item: Path, device_id: str, run_id: str,
+                             run_dir: Optional[Path], superseded_by: str = "") -> None:
+    """Inference aborted mid-run because a newer bundle of the device arrived."""
+    if not wctx.owns(item):
+        return
+    extra = {"superseded_by": superseded_by} if superseded_by else None
+    wctx.mark_infer(item, "cancelled_superseded", device_id=device_id, run_id=run_id, extra=extra)
+    record_bundle_outcome(wctx.inbox_root, item, "cancelled_superseded")
+    mark_server_out_infer_done(run_dir, 'cancelled_superseded')
+    cleanup_inbox_item(item, delete_infer_done=wctx.delete_infer_done)
+    print("[watcher] bundle cancelled_superseded device=%s run_id=%s superseded_by=%s" % (device_id, run_id, superseded_by), flush=True)
+
+def publish_bundle_coalesced(wctx: WatchContext, item: Path, device_id: str, run_id: str,
+                             run_dir: Optional[Path], into_run_id: str, into_run_dir: Path) -> None:
+    """Older bundle of a burst merged into into_run_id: it gets that run's diagnosis and actions."""
+    if not wctx.owns(item):
+        return
+    actions_path = find_actions(into_run_dir)
+    if run_dir is not None and actions_path is not None:
+        try:
+            out_dir = Path(run_dir) / "_server_out"
+            out_dir.mkdir(parents=True, exist_ok=True)
+            (out_dir / "actions_device.txt").write_bytes(actions_path.read_bytes())
+            (out_dir / "coalesced_into.txt").write_text(into_run_id + "\n", encoding="utf-8")
+        except Exception:
+            pass
+    wctx.mark_infer(item, "ok", device_id=device_id, run_id=run_id,
+                    extra={"run_dir": str(into_run_dir), "coalesced_into": into_run_id})
+    record_bundle_outcome(wctx.inbox_root, item, "ok", str(into_run_dir))
+    mark_server_out_infer_done(run_dir, 'coalesced')
+    cleanup_inbox_item(item, delete_infer_done=wctx.delete_infer_done)
+    print("[watcher] bundle coalesced device=%s run_id=%s into=%s" % (device_id, run_id, into_run_id), flush=True)
+
+def publish_bundle_stale(wctx: WatchContext, item: Path, device_id: str, run_id: str,
+                         run_dir: Optional[Path], superseded_by: str = "") -> None:
+    if not wctx.owns(item):
+        return
+    extra = {"superseded_by": superseded_by} if superseded_by else None
+    wctx.mark_infer(item, "skip_stale", device_id=device_id, run_id=run_id, extra=extra)
+    record_bundle_outcome(wctx.inbox_root, item, "skip_stale")
+    mark_server_out_infer_done(run_dir, 'skip_stale')
+    cleanup_inbox_item(item, delete_infer_done=wctx.delete_infer_done)
+    print("[watcher] bundle skip_stale device=%s run_id=%s superseded_by=%s" % (device_id, run_id, superseded_by), flush=True)
+
+
+class NewerBundleProbe:
+    """
+    Cancel hook for the one-bundle-at-a-time path (no DevicePipeline to flag supersession):
+    true once a newer bundle of the same device sits in the inbox. Globs at most every PROBE_SEC.
+    """
+
+    def __init__(self, device_dir: Path, item: Path) -> None:
+        self.device_dir = device_dir
+        self.item = item
+        self.mtime = item.stat().st_mtime
+        self.newer = ""  # run_id of the superseding bundle
+        self._checked = 0.0
+
+    def __call__(self) -> bool:
+        if self.newer:
+            return True
+        now = time.monotonic()
+        if now - self._checked < PROBE_SEC:
+            return False
+        self._checked = now
+        try:
+            for p in self.device_dir.iterdir():
+                run_id, kind = parse_name(p.name)
+                if kind != "bundle" or p == self.item or os.path.exists(str(p) + ".infer_done"):
+                    continue
+                if p.stat().st_mtime > self.mtime:
+                    self.newer = run_id
+                    return True
+        except OSError:
+            pass
+        return False
+
+
+class BundleJob:
+    __slots__ = ("device_id", "run_id", "item", "mtime", "run_dir", "ctx", "error", "superseded_by", "on_gpu",
+                 "timings", "queued_at", "degrade_level", "held", "held_by", "members", "done")
+
+    def __init__(self, device_id: str, run_id: str, item: Path, mtime: float) -> None:
+        self.device_id = device_id
+        self.run_id = run_id
+        self.item = item
+        self.mtime = mtime
+        self.run_dir: Optional[Path] = None
+        self.ctx = None
+        self.error: Optional[BaseException] = None
+        self.superseded_by = ""
+        self.on_gpu = False
+        self.timings: Dict[str, float] = {}
+        self.queued_at = 0.0
+        self.degrade_level: Optional[int] = None
+        self.held: List["BundleJob"] = []     # superseded older jobs this one publishes (coalescing)
+        self.held_by = ""                     # run_id of the job that publishes this one
+        self.members: List["BundleJob"] = []  # held jobs merged into this job's run context
+        self.done = False
+
+
+class DevicePipeline:
+    """
+    Staged bundle processing, overlapping devices:
+      prep    worker pool (--workers): ingest + feature extraction, single-flight per device
+      gpu     one thread fed by a bounded queue (--gpu_queue) of prepared jobs: inference + actions export
+      publish one thread: latest_* files, .infer_done markers, inbox cleanup
+    Newest bundle wins per device: a newer bundle marks the device's older jobs as superseded.
+    Jobs not on the GPU yet become skip_stale at the next stage boundary; a job on the GPU is
+    cancelled cooperatively (per token / between stages, cancelled_superseded). A job that
+    finishes anyway (WK_INFER_CANCEL=0, or done before it noticed) does not overwrite the
+    latest_* of a newer published bundle.
+    With coalescing (WK_COALESCE) a superseded job is held by the newer one instead of being
+    published right away. Once the newer job is ingested, held jobs whose run windows overlap
+    or touch its window (within WK_COALESCE_GAP_SEC) become members: one inference runs on
+    the union window and its result is published to every member run_id as well. Held jobs
+    that do not touch the window are published skip_stale.
+    """
+
+    def __init__(self, wctx: WatchContext, workers: int, gpu_queue: int) -> None:
+        self.wctx = wctx
+        self._lock = threading.Lock()
+        self._prep = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="watch_prep")
+        self._gpu_q: "queue.Queue[BundleJob]" = queue.Queue(maxsize=max(1, gpu_queue))
+        self._pub_q: "queue.Queue[tuple]" = queue.Queue()
+        self._active: Dict[str, BundleJob] = {}    # inbox item -> job, until published
+        self._preparing: Set[str] = set()          # devices with a job in prep
+        self._waiting: Dict[str, BundleJob] = {}   # device -> next job to prep
+        self._published: Dict[str, float] = {}     # device -> bundle mtime behind latest_*
+        threading.Thread(target=self._gpu_loop, name="watch_gpu", daemon=True).start()
+        threading.Thread(target=self._publish_loop, name="watch_publish", daemon=True).start()
+
+    def is_active(self, item: Path) -> bool:
+        with self._lock:
+            return str(item) in self._active
+
+    def busy_devices(self) -> Set[str]:
+        """Inbox dir names with jobs not published yet (their device leases are kept)."""
+        with self._lock:
+            return {job.item.parent.name for job in self._active.values()}
+
+    def submit(self, device_id: str, run_id: str, item: Path) -> None:
+        try:
+            mtime = item.stat().st_mtime
+        except OSError:
+            return
+        job = BundleJob(device_id, run_id, item, mtime)
+        stale = []
+        start = False
+        with self._lock:
+            if str(item) in self._active:
+                return
+            for other in self._active.values():
+                if other.device_id != device_id:
+                    continue
+                if other.mtime > mtime:
+                    job.superseded_by = other.run_id
+                elif not other.superseded_by and (INFER_CANCEL or not other.on_gpu):
+                    other.superseded_by = run_id
+                    if COALESCE:
+                        other.held_by = run_id
+                        job.held.append(other)
+                    if other.on_gpu:
+                        print("[watcher] cancel device=%s run_id=%s superseded_by=%s" % (
+                            device_id, other.run_id, run_id), flush=True)
+            self._active[str(item)] = job
+            if job.superseded_by:
+                stale.append(job)
+            elif device_id in self._preparing:
+                prev = self._waiting.pop(device_id, None)
+                if prev is not None and not prev.held_by:
+                    stale.append(prev)
+                self._waiting[device_id] = job
+            else:
+                self._preparing.add(device_id)
+                start = True
+        for s in stale:
+            self._pub_q.put(("stale", s))
+        if start:
+            print("[watcher] bundle ready device=%s run_id=%s" % (device_id, run_id), flush=True)
+            self._prep.submit(self._prep_job, job)
+
+    def _prep_job(self, job: BundleJob) -> None:
+        try:
+            self.wctx.mark_state(job.item, "prep", job.run_id)
+            if not job.superseded_by:
+                t0 = time.perf_counter()
+                job.run_dir = ingest(job.item, self.wctx.runs_root).run_dir
+                job.timings["ingest"] = round((time.perf_counter() - t0) * 1000.0, 3)
+            if not job.superseded_by and job.held:
+                self._coalesce(job)
+            if not job.superseded_by:
+                t0 = time.perf_counter()
+                budgets = self.wctx.stage_budgets(job.device_id) or {}
+                member_dirs = [m.run_dir for m in job.members]
+                job.ctx = run_with_deadline(lambda: extract_features(job.run_dir, member_dirs),
+                                            budgets.get("features"), "features")
+                job.timings["features"] = round((time.perf_counter() - t0) * 1000.0, 3)
+            if job.superseded_by:
+                self._pub_q.put(("stale", job))
+            else:
+                job.queued_at = time.perf_counter()
+                self._gpu_q.put(job)  # blocks while the GPU queue is full
+        except Exception as exc:
+            job.error = exc
+            self._pub_q.put(("error", job))
+        finally:
+            self._next_prep(job.device_id)
+
+    def _coalesce(self, job: BundleJob) -> None:
+        """Take over every job held below this one and pick the members (transitively touching windows)."""
+        pending: List[BundleJob] = []
+        todo = list(job.held)
+        while todo:
+            h = todo.pop()
+            if h.done or h in pending:
+                continue
+            pending.append(h)
+            todo.extend(h.held)
+        windows = {}
+        for h in pending:
+            h.held_by = job.run_id
+            if h.run_dir is None and h.error is None:
+                try:
+                    h.run_dir = ingest(h.item, self.wctx.runs_root).run_dir
+                except Exception as exc:
+                    h.error = exc
+            if h.run_dir is not None and h.error is None:
+                windows[id(h)] = read_run_window(h.run_dir)
+        window = read_run_window(job.run_dir)
+        gap_ms = int(COALESCE_GAP_SEC * 1000)
+        members: List[BundleJob] = []
+        grown = True
+        while grown:
+            grown = False
+            for h in pending:
+                w = windows.get(id(h))
+                if h in members or w is None or not windows_touch(window, w, gap_ms):
+                    continue
+                members.append(h)
+                window = (min(window[0], w[0]), max(window[1], w[1]))
+                grown = True
+        job.held = pending
+        job.members = sorted(members, key=lambda m: m.mtime, reverse=True)
+        for h in pending:
+            if h not in members:
+                h.held_by = ""
+                self._pub_q.put(("error" if h.error is not None else "cancelled" if h.on_gpu else "stale", h))
+        if members:
+            print("[watcher] coalesce device=%s run_id=%s members=%s window_ms=%s..%s" % (
+                job.device_id, job.run_id, ",".join(m.run_id for m in job.members), window[0], window[1]), flush=True)
+
+    def _next_prep(self, device_id: str) -> None:
+        with self._lock:
+            nxt = self._waiting.pop(device_id, None)
+            if nxt is None:
+                self._preparing.discard(device_id)
+                return
+        print("[watcher] bundle ready device=%s run_id=%s" % (device_id, nxt.run_id), flush=True)
+        self._prep.submit(self._prep_job, nxt)
+
+    def _gpu_loop(self) -> None:
+        while True:
+            job = self._gpu_q.get()
+            with self._lock:
+                stale = bool(job.superseded_by)
+                job.on_gpu = not stale
+            if stale:
+                job.ctx = None
+                self._pub_q.put(("stale", job))
+                continue
+            job.timings["gpu_wait"] = round((time.perf_counter() - job.queued_at) * 1000.0, 3)
+            self.wctx.mark_state(job.item, "infer")
+            try:
+                t0 = time.perf_counter()
+                res = infer(job.run_dir, job.ctx,
+                            self.wctx.infer_options(job.mtime, lambda: bool(job.superseded_by), job.device_id))
+                job.degrade_level = res.degrade_level
+                if res.deadline_exceeded:
+                    print("[watcher] deadline_exceeded device=%s run_id=%s stages=%s" % (
+                        job.device_id, job.run_id, ",".join(res.deadline_exceeded)), flush=True)
+                job.timings["infer"] = round((time.perf_counter() - t0) * 1000.0, 3)
+                if res.status == "cancelled":
+                    self._pub_q.put(("cancelled", job))
+                    continue
+                export_actions(res.out_dir)
+                self._pub_q.put(("ok", job))
+            except Exception as exc:
+                job.error = exc
+                self._pub_q.put(("error", job))
+            finally:
+                job.ctx = None
+
+    def _publish_held(self, job: BundleJob, kind: str) -> None:
+        """Publish the jobs held by job along with it: members share its outcome, the rest are stale."""
+        for h in job.held:
+            if h.done or h.held_by != job.run_id:
+                continue
+            try:
+                if h in job.members and kind == "ok":
+                    publish_bundle_coalesced(self.wctx, h.item, h.device_id, h.run_id, h.run_dir, job.run_id, job.run_dir)
+                elif h in job.members and kind == "error":
+                    publish_bundle_error(self.wctx, h.item, h.device_id, h.run_id, h.run_dir,
+                                         job.error or RuntimeError("unknown"), update_latest=False)
+                elif h.on_gpu:
+                    publish_bundle_cancelled(self.wctx, h.item, h.device_id, h.run_id, h.run_dir, job.run_id)
+                else:
+                    publish_bundle_stale(self.wctx, h.item, h.device_id, h.run_id, h.run_dir, job.run_id)
+            except Exception as exc:
+                print("[watcher] publish_error device=%s run_id=%s: %s" % (h.device_id, h.run_id, exc), flush=True)
+            finally:
+                h.done = True
+                with self._lock:
+                    self._active.pop(str(h.item), None)
+
+    def _publish_loop(self) -> None:
+        while True:
+            kind, job = self._pub_q.get()
+            parked = False
+            try:
+                if job.done:
+                    continue  # published already by the job that held it
+                if kind in ("stale", "cancelled") and job.held_by:
+                    parked = True  # published by the newer job holding it
+                    continue
+                if kind == "stale":
+                    publish_bundle_stale(self.wctx, job.item, job.device_id, job.run_id, job.run_dir, job.superseded_by)
+                    continue
+                if kind == "cancelled":
+                    publish_bundle_cancelled(self.wctx, job.item, job.device_id, job.run_id, job.run_dir, job.superseded_by)
+                    continue
+                with self._lock:
+                    newest = job.mtime >= self._published.get(job.device_id, 0.0)
+                    if newest:
+                        self._published[job.device_id] = job.mtime
+                if kind == "ok":
+                    try:
+                        publish_bundle_ok(self.wctx, job.item, job.device_id, job.run_id, job.run_dir,
+                                          update_latest=newest, timings=job.timings,
+                                          degrade_level=job.degrade_level,
+                                          coalesced=[m.run_id for m in job.members])
+                    except Exception as exc:
+                        kind, job.error = "error", exc
+                        publish_bundle_error(self.wctx, job.item, job.device_id, job.run_id, job.run_dir, exc, update_latest=newest)
+                else:
+                    publish_bundle_error(self.wctx, job.item, job.device_id, job.run_id, job.run_dir,
+                                         job.error or RuntimeError("unknown"), update_latest=newest)
+            except Exception as exc:
+                print("[watcher] publish_error device=%s run_id=%s: %s" % (job.device_id, job.run_id, exc), flush=True)
+            finally:
+                if not parked:
+                    if not job.done:
+                        job.done = True
+                        self._publish_held(job, kind)
+                    with self._lock:
+                        self._active.pop(str(job.item), None)
+
+
+def marker_ready_items(device_dir: Path, wctx: WatchContext, pipeline: Optional[DevicePipeline] = None):
+    device_id = sanitize_token(device_dir.name)
+    bundles = []
+    action_results = []
+    for item in device_dir.iterdir():
+        if item.name.endswith(".tmp") or item.name.endswith(".done") or item.name.endswith(".infer_done"):
+            continue
+        run_id, kind = parse_name(item.name)
+        if not run_id or not kind:
+            continue
+        ready = Path(str(item) + ".done")
+        infer_mark = Path(str(item) + ".infer_done")
+        if not ready.exists() or infer_mark.exists():
+            continue
+        if pipeline is not None and pipeline.is_active(item):
+            continue  # already queued/running; submit() handles supersession
+        if not safe_read_text(ready).lstrip().startswith("ok"):
+            wctx.mark_infer(item, "skip_bad_bundle", device_id=device_id, run_id=run_id)
+            cleanup_inbox_item(item, delete_infer_done=wctx.delete_infer_done)
+            continue
+        if kind == "bundle":
+            bundles.append(item)
+        elif kind == "action_result":
+            action_results.append(item)
+    return bundles, action_results
+
+def adopt_marker_items(device_dir: Path, ledger: JobLedger) -> int:
+    """Add uploads that only have a .done marker (older ingest server, ledger errors) to the ledger."""
+    known = ledger.known_names(device_dir.name)
+    n = 0
+    for done_item in device_dir.glob("*.done"):
+        base = done_item.with_suffix("")
+        if base.name in known or Path(str(base) + ".infer_done").exists() or not base.exists():
+            continue
+        run_id, kind = parse_name(base.name)
+        if not run_id or not safe_read_text(done_item).lstrip().startswith("ok"):
+            continue
+        try:
+            ledger.record_upload(base, kind, run_id, bundle_sha256(base) or None, base.stat().st_size)
+            n += 1
+        except Exception:
+            continue
+    return n
+
+def ledger_ready_items(device_dir: Path, wctx: WatchContext, pipeline: Optional[DevicePipeline] = None):
+    device_id = sanitize_token(device_dir.name)
+    bundles = []
+    action_results = []
+    for row in wctx.ledger.pending(device_dir.name):
+        item = device_dir / row["name"]
+        run_id, kind = parse_name(item.name)
+        if pipeline is not None and pipeline.is_active(item):
+            continue
+        if not run_id or not kind:
+            wctx.mark_infer(item, "skip_bad_name", device_id=device_id, run_id="")
+            continue
+        if not item.exists():
+            wctx.mark_infer(item, "skip_missing", device_id=device_id, run_id=run_id)
+            continue
+        if kind == "bundle":
+            bundles.append(item)
+        else:
+            action_results.append(item)
+    return bundles, action_results
+
+def scan_device(device_dir: Path, wctx: WatchContext, pipeline: Optional[DevicePipeline] = None,
+                full: bool = True) -> None:
+    """full=False: ledger-scheduled pass, no marker globbing (only jobs the ledger lists as received)."""
+    if wctx.claims is not None and not wctx.claims.claim(device_dir.name):
+        return  # another watcher holds this device
+    runs_root = wctx.runs_root
+    delete_infer_done = wctx.delete_infer_done
+    device_id = sanitize_token(device_dir.name)
+
+    if full or wctx.ledger is None:
+        # A) 预扫描：done!=ok 的文件，直接 infer_done=skip_bad_bundle，避免反复尝试
+        for done_item in sorted(device_dir.glob("*.done")):
+            base = done_item.with_suffix("")  # remove ".done"
+            infer_mark = Path(str(base) + ".infer_done")
+            if infer_mark.exists():
+                continue
+            done_txt = safe_read_text(done_item)
+            if done_txt.lstrip().startswith("ok"):
+                continue
+            run_id, kind = parse_name(base.name)
+            if not run_id or not kind:
+                wctx.mark_infer(base, "skip_bad_name", device_id=device_id, run_id="")
+            else:
+                wctx.mark_infer(base, "skip_bad_bundle", device_id=device_id, run_id=run_id, extra={"done_text": done_txt[:200]})
+            # done!=ok: avoid inbox growth (delete tar + .done; keep .infer_done unless configured)
+            cleanup_inbox_item(base, delete_infer_done=delete_infer_done)
+        if wctx.ledger is not None:
+            adopt_marker_items(device_dir, wctx.ledger)
+
+    # B) 只处理“最新的一个 ok bundle”，其余历史 ok bundle 标记 skip_stale，防止旧包覆盖 latest
+    if wctx.ledger is not None:
+        bundles, action_results = ledger_ready_items(device_dir, wctx, pipeline)
+    else:
+        bundles, action_results = marker_ready_items(device_dir, wctx, pipeline)
+
+    # 先把 action_result 都标记一下（不影响 latest）
+    for ar in sorted(action_results, key=lambda p: p.stat().st_mtime):
+        try:
+            run_id, _ = parse_name(ar.name)
+            print("[watcher] action_result ready device=%s run_id=%s" % (device_id, run_id), flush=True)
+            run_dir = runs_root / run_id
+            if not run_dir.exists():
+                # 通常不会发生（action_result 在推理完成后才会出现），但遇到就先不处理，留待下次
+                print("[watcher] action_result wait_run_dir device=%s run_id=%s" % (device_id, run_id), flush=True)
+                continue
+            out_dir = unpack_action_result(ar, run_dir)
+            wctx.mark_infer(ar, "ok_action_result_unpacked", device_id=device_id, run_id=run_id, extra={"out_dir": str(out_dir)})
+            cleanup_inbox_item(ar, delete_infer_done=delete_infer_done)
+        except Exception:
+            pass
+
+    if bundles and pipeline is not None and COALESCE:
+        # oldest first: each later submit holds the earlier bundle, so overlapping
+        # windows are merged into the newest one instead of being dropped as stale
+        for b in sorted(bundles, key=lambda p: p.stat().st_mtime):
+            rid, _ = parse_name(b.name)
+            pipeline.submit(device_id, rid, b)
+        return
+    if bundles:
+        newest = max(bundles, key=lambda p: p.stat().st_mtime)
+        newest_run_id, _ = parse_name(newest.name)
+        for b in bundles:
+            if b != newest:
+                try:
+                    rid, _ = parse_name(b.name)
+                    publish_bundle_stale(wctx, b, device_id, rid, None, newest_run_id)
+                except Exception:
+                    pass
+
+        run_id, _ = parse_name(newest.name)
+        if pipeline is not None:
+            pipeline.submit(device_id, run_id, newest)
+            return
+        run_dir = None  # unset when ingest fails; the marker helpers skip it
+        try:
+            print("[watcher] bundle ready device=%s run_id=%s" % (device_id, run_id), flush=True)
+            wctx.mark_state(newest, "infer", run_id)
+            probe = NewerBundleProbe(device_dir, newest)
+            run_dir = run_closed_loop(wctx.repo_root, newest, runs_root, wctx.infer_options(probe.mtime, probe, device_id))
+            if not run_dir:
+                run_dir = runs_root / run_id
+            if probe.newer:
+                publish_bundle_cancelled(wctx, newest, device_id, run_id, run_dir, probe.newer)
+            else:
+                publish_bundle_ok(wctx, newest, device_id, run_id, run_dir)
+        except Exception as exc:
+            publish_bundle_error(wctx, newest, device_id, run_id, run_dir, exc)
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--inbox", required=True)
     ap.add_argument("--out", required=True)
     ap.add_argument("--runs_root", required=True)
     ap.add_argument("--poll_sec", type=int, default=2)
+    ap.add_argument("--mode", default="auto", choices=["auto", "inotify", "poll"],
+                    help="auto: inotify on .done markers when available, else poll")
+    ap.add_argument("--rescan_sec", type=float, default=60.0,
+                    help="full scan interval (inotify mode, or polling with the job ledger)")
+    ap.add_argument("--workers", type=int, default=int(os.environ.get("WK_WATCH_WORKERS", "2")),
+                    help="ingest/feature workers overlapping inference; 0 = one bundle at a time")
+    ap.add_argument("--gpu_queue", type=int, default=4, help="prepared bundles waiting for inference")
     args = ap.parse_args()
 
     inbox_root = Path(args.inbox).expanduser().resolve()
@@ -212,141 +997,105 @@ def main():
     delete_infer_done = (os.environ.get("WK_TCP_INBOX_DELETE_INFER_DONE", "0").strip() == "1")
     loop_n = 0
 
+    ledger = open_ledger(inbox_root)
+    wctx = WatchContext(inbox_root, out_root, runs_root, repo_root, delete_infer_done, ledger, markers_enabled())
+    if os.environ.get("WK_WATCH_LEASE", "1").strip() != "0":
+        wctx.claims = DeviceClaims(inbox_root)
+        if ledger is not None:
+            # taking over a device: its prep/infer jobs of other (dead) watchers start over
+            wctx.claims.on_acquire = lambda device: ledger.requeue_active(
+                device, keep=lambda row: row["worker"] == wctx.claims.owner, reason="lease_takeover")
+        print("[watcher] device leases: owner=%s ttl=%ss" % (wctx.claims.owner, wctx.claims.ttl), flush=True)
+    if ledger is not None:
+        requeued = ledger.requeue_active() if wctx.claims is None else 0
+        print("[watcher] job ledger=%s markers=%s requeued=%d" % (ledger.db_path, int(wctx.markers), requeued), flush=True)
+    wctx.ladder = ladder_from_env()
+    try:
+        wctx.deadlines = policy_from_env()
+    except Exception as exc:
+        print("[watcher] bad stage deadline config (%s); using the defaults" % exc, flush=True)
+        wctx.deadlines = DeadlinePolicy()
+    print("[watcher] stage deadlines (normal): %s" % " ".join(
+        "%s=%g" % kv for kv in wctx.deadlines.budgets().items()), flush=True)
+    if wctx.ladder is not None:
+        print("[watcher] overload ladder: %s at queue_wait_sec=%s recover_ratio=%s" % (
+            ",".join(LEVELS[1:]), ",".join("%g" % t for t in wctx.ladder.thresholds), wctx.ladder.recover_ratio), flush=True)
+    pipeline = None
+    if args.workers > 0 and os.environ.get("WK_PIPELINE_SUBPROCESS", "0").strip() != "1":
+        pipeline = DevicePipeline(wctx, args.workers, args.gpu_queue)
+        print("[watcher] pipelined: workers=%d gpu_queue=%d" % (args.workers, args.gpu_queue), flush=True)
+
+    notifier = None
+    if args.mode in ("auto", "inotify"):
+        try:
+            notifier = InboxNotifier(inbox_root)
+        except OSError as exc:
+            if args.mode == "inotify":
+                raise
+            print("[watcher] inotify unavailable (%s); polling every %ss" % (exc, args.poll_sec), flush=True)
+    if notifier is not None:
+        print("[watcher] inotify mode: scan on .done markers, full rescan every %ss" % args.rescan_sec, flush=True)
+
+    # startup reconciliation: everything that arrived while the watcher was down
+    dirty = None  # None = all devices
+    notified: Set[str] = set()  # devices with new .done markers (inotify): scanned by marker too
+    last_full = time.time()
     while True:
+        full = dirty is None
         try:
             for device_dir in sorted(inbox_root.iterdir()):
                 if not device_dir.is_dir():
                     continue
-                device_id = sanitize_token(device_dir.name)
-
-                # A) 预扫描：done!=ok 的文件，直接 infer_done=skip_bad_bundle，避免反复尝试
-                for done_item in sorted(device_dir.glob("*.done")):
-                    base = done_item.with_suffix("")  # remove ".done"
-                    infer_mark = Path(str(base) + ".infer_done")
-                    if infer_mark.exists():
-                        continue
-                    done_txt = safe_read_text(done_item)
-                    if done_txt.lstrip().startswith("ok"):
-                        continue
-                    run_id, kind = parse_name(base.name)
-                    if not run_id or not kind:
-                        mark_infer(base, "skip_bad_name", device_id=device_id, run_id="")
-                    else:
-                        mark_infer(base, "skip_bad_bundle", device_id=device_id, run_id=run_id, extra={"done_text": done_txt[:200]})
-                    # done!=ok: avoid inbox growth (delete tar + .done; keep .infer_done unless configured)
-                    cleanup_inbox_item(base, delete_infer_done=delete_infer_done)
-
-                # B) 只处理“最新的一个 ok bundle”，其余历史 ok bundle 标记 skip_stale，防止旧包覆盖 latest
-                bundles = []
-                action_results = []
-                for item in device_dir.iterdir():
-                    if item.name.endswith(".tmp") or item.name.endswith(".done") or item.name.endswith(".infer_done"):
-                        continue
-                    run_id, kind = parse_name(item.name)
-                    if not run_id or not kind:
-                        continue
-                    ready = Path(str(item) + ".done")
-                    infer = Path(str(item) + ".infer_done")
-                    if not ready.exists() or infer.exists():
-                        continue
-                    if not safe_read_text(ready).lstrip().startswith("ok"):
-                        mark_infer(item, "skip_bad_bundle", device_id=device_id, run_id=run_id)
-                        cleanup_inbox_item(item, delete_infer_done=delete_infer_done)
-                        continue
-                    if kind == "bundle":
-                        bundles.append(item)
-                    elif kind == "action_result":
-                        action_results.append(item)
-
-                # 先把 action_result 都标记一下（不影响 latest）
-                for ar in sorted(action_results, key=lambda p: p.stat().st_mtime):
-                    try:
-                        run_id, _ = parse_name(ar.name)
-                        print("[watcher] action_result ready device=%s run_id=%s" % (device_id, run_id), flush=True)
-                        run_dir = runs_root / run_id
-                        if not run_dir.exists():
-                            # 通常不会发生（action_result 在推理完成后才会出现），但遇到就先不处理，留待下次
-                            print("[watcher] action_result wait_run_dir device=%s run_id=%s" % (device_id, run_id), flush=True)
-                            continue
-                        out_dir = unpack_action_result(ar, run_dir)
-                        mark_infer(ar, "ok_action_result_unpacked", device_id=device_id, run_id=run_id, extra={"out_dir": str(out_dir)})
-                        cleanup_inbox_item(ar, delete_infer_done=delete_infer_done)
-                    except Exception:
-                        pass
-
-                if bundles:
-                    newest = max(bundles, key=lambda p: p.stat().st_mtime)
-                    for b in bundles:
-                        if b != newest:
-                            try:
-                                rid, _ = parse_name(b.name)
-                                mark_infer(b, "skip_stale", device_id=device_id, run_id=rid)
-                                cleanup_inbox_item(b, delete_infer_done=delete_infer_done)
-                            except Exception:
-                                pass
-
-                    run_id, _ = parse_name(newest.name)
-                    try:
-                        print("[watcher] bundle ready device=%s run_id=%s" % (device_id, run_id), flush=True)
-                        run_dir = run_closed_loop(repo_root, newest, runs_root)
-                        if not run_dir:
-                            run_dir = runs_root / run_id
-                        actions_path = find_actions(run_dir)
-                        if not actions_path:
-                            raise FileNotFoundError("actions_device.txt missing for run_id=%s" % run_id)
-                        data = actions_path.read_bytes()
-                        if not data.strip():
-                            # tolerate empty actions_device.txt: synthesize a minimal default so the pipeline can proceed
-                            default_lines = [
-                                "dmesg | tail -n 200",
-                                "cat /proc/loadavg",
-                                "cat /proc/meminfo | head -n 40",
-                                "ps -A | head -n 80",
-                                "top -n 1 | head -n 80",
-                            ]
-                            data = ("\n".join(default_lines) + "\n").encode("utf-8")
-                            try:
-                                actions_path.write_bytes(data)
-                            except Exception:
-                                pass
-
-                        write_latest(out_root, device_id, run_id, data)
-                        write_status(out_root, device_id, "llm_ok")
-                        clear_error(out_root, device_id)
-                        mark_infer(newest, "ok", device_id=device_id, run_id=run_id, extra={"run_dir": str(run_dir)})
-                        mark_server_out_infer_done(run_dir, 'ok')
-                        cleanup_inbox_item(newest, delete_infer_done=delete_infer_done)
-                        print("[watcher] bundle ok device=%s run_id=%s" % (device_id, run_id), flush=True)
-                    except Exception as exc:
-                        reason = str(exc)
-                        # run_dir exists 这种是历史重复包：不写 fallback，不覆盖 latest，只做 skip
-                        if "run_dir exists:" in reason:
-                            mark_infer(newest, "skip_exists_run_dir", device_id=device_id, run_id=run_id, extra={"reason": reason[:512]})
-                            mark_server_out_infer_done(run_dir, 'skip_exists_run_dir')
-                            # 这种重复包也没必要留在 inbox
-                            cleanup_inbox_item(newest, delete_infer_done=delete_infer_done)
-                            print("[watcher] bundle skip_exists device=%s run_id=%s" % (device_id, run_id), flush=True)
-                        else:
-                            fallback = ("echo INFER_FAILED device=%s run=%s\n" % (device_id, run_id)).encode("utf-8")
-                            write_latest(out_root, device_id, run_id, fallback)
-                            write_error(out_root, device_id, reason)
-                            write_status(out_root, device_id, "fallback")
-                            mark_infer(newest, "error", device_id=device_id, run_id=run_id, extra={"reason": reason[:1024]})
-                            mark_server_out_infer_done(run_dir, 'error')
-                            print("[watcher] bundle error device=%s run_id=%s reason=%s" % (device_id, run_id, reason), flush=True)
-
+                if not full and device_dir.name not in dirty:
+                    continue
+                scan_device(device_dir, wctx, pipeline, full=full or device_dir.name in notified)
         except Exception as loop_exc:
             print("[watcher] loop_error: %s" % loop_exc, flush=True)
+        if wctx.claims is not None:
+            wctx.claims.release_idle(pipeline.busy_devices() if pipeline is not None else set())
         loop_n += 1
         if cleanup_every > 0 and (loop_n % cleanup_every == 0):
             try:
-                for device_dir in sorted(inbox_root.iterdir()):
-                    if device_dir.is_dir():
-                        cleanup_processed_marks(device_dir, keep_max=keep_max, keep_days=keep_days)
+                if ledger is not None:
+                    ledger.purge(keep_max=keep_max, keep_days=keep_days)
+                else:
+                    for device_dir in sorted(inbox_root.iterdir()):
+                        if device_dir.is_dir():
+                            cleanup_processed_marks(device_dir, keep_max=keep_max, keep_days=keep_days)
             except Exception:
                 pass
 
-        time.sleep(max(1, int(args.poll_sec)))
+        rescan = False
+        if notifier is None:
+            time.sleep(max(1, int(args.poll_sec)))
+            if ledger is None:
+                continue  # marker-only: every poll is a full pass
+            dirty = set()
+        else:
+            # a periodic full pass still retries what waits on something that raises no
+            # inotify event (action_result before its run_dir, errors)
+            timeout = max(0.0, last_full + args.rescan_sec - time.time())
+            if ledger is not None:
+                # with WK_INBOX_MARKERS=0 no .done event arrives: the ledger is polled too
+                timeout = min(timeout, max(1, int(args.poll_sec)))
+            try:
+                dirty, rescan = notifier.wait(timeout)
+                notified = set(dirty)
+            except OSError as exc:
+                print("[watcher] inotify failed (%s); back to polling" % exc, flush=True)
+                notifier.close()
+                notifier = None
+                dirty = None
+                continue
+        if ledger is not None:
+            try:
+                dirty = set(dirty) | ledger.pending_devices()
+            except Exception as exc:
+                print("[watcher] job ledger error: %s" % exc, flush=True)
+                rescan = True
+        if rescan or time.time() >= last_full + args.rescan_sec:
+            dirty = None
+            last_full = time.time()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+stage_deadline.py
+- Per-stage wall-clock budgets (seconds, 0 = unbounded) for one inference job:
+    features    run context parsing (load_run_context)
+    gpu_wait    waiting for free VRAM (caps wait_for_gpu, whose max_wait 0 means forever)
+    model_load  build_model on a cold process
+    stage1      first generate call
+    stage2      second generate call
+    v2          both generate calls of the v2 pass
+- generate() stops itself at the deadline through a stopping criterion and returns the
+  text decoded so far; stages that cannot be interrupted run under run_with_deadline(),
+  which gives up on the worker thread once its budget (+ HANG_GRACE_SEC for generate)
+  is spent, so the watcher moves on to the next job.
+- Budgets depend on the device priority class:
+    WK_STAGE_DEADLINE_SEC   "stage1=300,stage2=180,..." overrides of the normal class
+    WK_DEVICE_PRIORITY      "board0*=high,lab*=low" (fnmatch on the device id)
+    WK_STAGE_DEADLINES      JSON file {"classes": {"high": {"stage1": 600}, ...},
+                                       "devices": {"board01": "high"}}
+    WK_STAGE_DEADLINES=0    no deadlines at all
+"""
+
+import fnmatch
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+STAGES = ("features", "gpu_wait", "model_load", "stage1", "stage2", "v2")
+DEFAULT_BUDGETS = {
+    "features": 120.0,
+    "gpu_wait": 900.0,
+    "model_load": 600.0,
+    "stage1": 300.0,
+    "stage2": 180.0,
+    "v2": 480.0,
+}
+DEFAULT_PRIORITY = "normal"
+# a generate call that produced no token for this long past its deadline is hung: abandon it
+HANG_GRACE_SEC = 30.0
+# ingest + actions export around the budgeted stages (subprocess job timeout)
+JOB_SLACK_SEC = 300.0
+
+
+class StageDeadlineExceeded(RuntimeError):
+    """stage ran past its budget; partial holds the text decoded before it was stopped."""
+
+    def __init__(self, stage: str, partial: str = "") -> None:
+        super().__init__(f"deadline_exceeded: {stage}")
+        self.stage = stage
+        self.partial = partial
+
+
+def parse_budgets(text: str) -> Dict[str, float]:
+    """ "stage1=300,stage2=180" -> {"stage1": 300.0, "stage2": 180.0}; unknown stages raise ValueError."""
+    out: Dict[str, float] = {}
+    for part in (text or "").split(","):
+        if not part.strip():
+            continue
+        stage, _, sec = part.partition("=")
+        stage = stage.strip()
+        if stage not in STAGES:
+            raise ValueError(f"unknown stage {stage!r} (want one of {','.join(STAGES)})")
+        out[stage] = max(0.0, float(sec))
+    return out
+
+
+class DeadlinePolicy:
+    def __init__(self,
+                 classes: Optional[Dict[str, Dict[str, float]]] = None,
+                 devices: Optional[Dict[str, str]] = None,
+                 enabled: bool = True) -> None:
+        self.classes = classes or {}
+        self.devices = devices or {}
+        self.enabled = enabled
+
+    def priority(self, device_id: str) -> str:
+        if device_id in self.devices:
+            return self.devices[device_id]
+        for pattern, prio in self.devices.items():
+            if fnmatch.fnmatchcase(device_id, pattern):
+                return prio
+        return DEFAULT_PRIORITY
+
+    def budgets(self, device_id: str = "") -> Dict[str, float]:
+        if not self.enabled:
+            return {stage: 0.0 for stage in STAGES}
+        out = dict(DEFAULT_BUDGETS)
+        out.update(self.classes.get(DEFAULT_PRIORITY) or {})
+        prio = self.priority(device_id) if device_id else DEFAULT_PRIORITY
+        if prio != DEFAULT_PRIORITY:
+            out.update(self.classes.get(prio) or {})
+        return out
+
+
+def policy_from_env() -> DeadlinePolicy:
+    path = os.environ.get("WK_STAGE_DEADLINES", "").strip()
+    if path == "0":
+        return DeadlinePolicy(enabled=False)
+    classes: Dict[str, Dict[str, float]] = {}
+    devices: Dict[str, str] = {}
+    if path:
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+        for prio, budgets in (data.get("classes") or {}).items():
+            classes[prio] = {k: max(0.0, float(v)) for k, v in budgets.items() if k in STAGES}
+        devices.update({str(k): str(v) for k, v in (data.get("devices") or {}).items()})
+    env_budgets = parse_budgets(os.environ.get("WK_STAGE_DEADLINE_SEC", ""))
+    if env_budgets:
+        classes.setdefault(DEFAULT_PRIORITY, {}).update(env_budgets)
+    for part in os.environ.get("WK_DEVICE_PRIORITY", "").split(","):
+        pattern, sep, prio = part.partition("=")
+        if sep and pattern.strip() and prio.strip():
+            devices[pattern.strip()] = prio.strip()
+    return DeadlinePolicy(classes, devices)
+
+
+class StageClock:
+    """Deadline of the stage currently running, plus the stages that ran out of time."""
+
+    def __init__(self, budgets: Optional[Dict[str, float]] = None) -> None:
+        self.budgets = dict(budgets or {})
+        self.stage = ""
+        self.deadline: Optional[float] = None
+        self.exceeded: List[str] = []
+
+    def budget(self, stage: str) -> float:
+        return float(self.budgets.get(stage) or 0.0)
+
+    def start(self, stage: str) -> None:
+        self.stage = stage
+        budget = self.budget(stage)
+        self.deadline = time.monotonic() + budget if budget > 0 else None
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def cap_wait(self, stage: str, max_wait_sec: int) -> int:
+        """max_wait_sec for a wait loop (0 = forever), bounded by the stage budget."""
+        budget = int(self.budget(stage))
+        if budget <= 0:
+            return max_wait_sec
+        return budget if max_wait_sec <= 0 else min(max_wait_sec, budget)
+
+    def exceed(self, stage: str) -> None:
+        if stage not in self.exceeded:
+            self.exceeded.append(stage)
+
+    def info(self) -> Dict[str, Any]:
+        return {"stages": list(self.exceeded), "budgets_sec": {s: self.budget(s) for s in self.exceeded}}
+
+
+def job_timeout(budgets: Dict[str, float]) -> Optional[float]:
+    """Wall clock a whole job may take (two GPU waits, every stage, hang grace); None if any stage is unbounded."""
+    if any(float(budgets.get(s) or 0.0) <= 0 for s in STAGES):
+        return None
+    return sum(float(budgets[s]) for s in STAGES) + float(budgets["gpu_wait"]) + 3 * HANG_GRACE_SEC + JOB_SLACK_SEC
+
+
+def run_with_deadline(fn: Callable[[], Any], timeout: Optional[float], stage: str) -> Any:
+    """fn() on a daemon thread; StageDeadlineExceeded if it is still running after timeout (the thread is left behind)."""
+    if not timeout or timeout <= 0:
+        return fn()
+    box: Dict[str, Any] = {}
+
+    def _run() -> None:
+        try:
+            box["result"] = fn()
+        except BaseException as exc:
+            box["error"] = exc
+
+    t = threading.Thread(target=_run, name=f"deadline_{stage}", daemon=True)
+    t.start()
+    t.join(timeout)
+    if t.is_alive():
+        raise StageDeadlineExceeded(stage)
+    if "error" in box:
+        raise box["error"]
+    return box.get("result")
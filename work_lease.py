@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+work_lease.py
+- Time-bounded lease files for work shared by several processes or hosts (same filesystem).
+- A lease is a small JSON file (owner, token, ttl) created atomically with os.link; its
+  mtime is the heartbeat. The holder renews it every ttl/3 from a daemon thread; a lease
+  whose mtime is older than its ttl belongs to a crashed or stalled holder and may be
+  reclaimed by anyone.
+- Reclaim renames the expired file to a private name first, so of several reclaimers only
+  one wins, and puts it back if the holder renewed it in between.
+- A holder that finds its file gone or replaced marks the lease lost and must not publish
+  (lease.check() right before committing results).
+Hosts sharing a lease dir need synchronized clocks (NTP); ttl should be well above the skew.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+LEASE_TTL_ENV = "WK_LEASE_TTL_SEC"
+LEASE_TTL_SEC = 60.0
+
+
+def lease_ttl() -> float:
+    try:
+        return max(1.0, float(os.environ.get(LEASE_TTL_ENV, str(LEASE_TTL_SEC))))
+    except ValueError:
+        return LEASE_TTL_SEC
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def read_lease(path: Path) -> Optional[Dict[str, Any]]:
+    """Lease content plus its age; files from the old `.infer_lock` format have no token."""
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    try:
+        info = json.loads(path.read_text(encoding="utf-8"))
+        if not isinstance(info, dict):
+            info = {}
+    except Exception:
+        info = {}
+    info["age_sec"] = time.time() - st.st_mtime
+    info["ino"] = st.st_ino
+    return info
+
+
+def _holder_dead(info: Dict[str, Any]) -> bool:
+    """Holder on this host whose pid is gone: no need to wait for the ttl."""
+    if info.get("host") != socket.gethostname():
+        return False
+    try:
+        os.kill(int(info.get("pid") or 0), 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return int(info.get("pid") or 0) <= 0
+
+
+def _expired(info: Dict[str, Any], ttl: float) -> bool:
+    try:
+        ttl = float(info.get("ttl_sec") or ttl)
+    except (TypeError, ValueError):
+        pass
+    return info["age_sec"] > ttl or _holder_dead(info)
+
+
+def lease_live(path: Path, ttl: Optional[float] = None) -> bool:
+    info = read_lease(path)
+    return info is not None and not _expired(info, ttl or lease_ttl())
+
+
+def _unlink(p: Path) -> None:
+    try:
+        p.unlink()
+    except OSError:
+        pass
+
+
+def reclaim_expired(path: Path, ttl: Optional[float] = None) -> bool:
+    """True when `path` is free now (never existed, released, or expired and removed by us)."""
+    ttl = ttl or lease_ttl()
+    info = read_lease(path)
+    if info is None:
+        return True
+    if not _expired(info, ttl):
+        return False
+    grave = path.with_name(f"{path.name}.reclaim.{uuid.uuid4().hex}")
+    try:
+        os.rename(path, grave)
+    except FileNotFoundError:
+        return True  # released or reclaimed by someone else meanwhile
+    except OSError:
+        return False
+    try:
+        taken = read_lease(grave)
+        if taken is not None and not _expired(taken, ttl):
+            # the holder renewed between our check and the rename: give it back
+            try:
+                os.link(grave, path)
+            except FileExistsError:
+                pass
+            return False
+        return True
+    finally:
+        _unlink(grave)
+
+
+class Lease:
+    def __init__(self, path: Path, token: str, ttl: float, owner: str, reclaimed: bool = False) -> None:
+        self.path = path
+        self.token = token
+        self.ttl = ttl
+        self.owner = owner
+        self.reclaimed = reclaimed
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def check(self) -> bool:
+        """Still ours (file present with our token)? Sets `lost` when not."""
+        if self.lost.is_set():
+            return False
+        info = read_lease(self.path)
+        if info is None or info.get("token") != self.token:
+            self.lost.set()
+            return False
+        return True
+
+    def renew(self) -> bool:
+        if not self.check():
+            return False
+        try:
+            os.utime(self.path)
+        except OSError:
+            self.lost.set()
+            return False
+        return True
+
+    def _heartbeat(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            if not self.renew():
+                break
+
+    def start_heartbeat(self, interval: Optional[float] = None) -> "Lease":
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._heartbeat, args=(interval or self.ttl / 3.0,),
+                name=f"lease:{self.path.name}", daemon=True,
+            )
+            self._thread.start()
+        return self
+
+    def release(self) -> None:
+        self._stop.set()
+        if self.lost.is_set():
+            return
+        # rename first so a lease reclaimed and re-taken by someone else is never deleted
+        grave = self.path.with_name(f"{self.path.name}.release.{self.token}")
+        try:
+            os.rename(self.path, grave)
+        except OSError:
+            return
+        info = read_lease(grave)
+        if info is not None and info.get("token") != self.token:
+            try:
+                os.link(grave, self.path)
+            except FileExistsError:
+                pass
+        _unlink(grave)
+        self.lost.set()
+
+
+def try_acquire(path: Path, ttl: Optional[float] = None, owner: str = "", heartbeat: bool = True) -> Optional[Lease]:
+    """Take the lease at `path` if it is free or expired; None while someone else holds it."""
+    ttl = ttl or lease_ttl()
+    reclaimed = False
+    for _ in range(2):
+        token = uuid.uuid4().hex
+        payload = {
+            "owner": owner or worker_id(),
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "token": token,
+            "ttl_sec": ttl,
+            "acquired_utc": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }
+        tmp = path.with_name(f"{path.name}.{token}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_text(json.dumps(payload, ensure_ascii=True) + "\n", encoding="utf-8")
+            os.link(tmp, path)  # atomic create-if-absent, also on NFS
+        except FileExistsError:
+            pass
+        except OSError:
+            return None
+        else:
+            lease = Lease(path, token, ttl, payload["owner"], reclaimed)
+            return lease.start_heartbeat() if heartbeat else lease
+        finally:
+            _unlink(tmp)
+        if not reclaim_expired(path, ttl):
+            return None
+        reclaimed = True
+    return None